@@ -26,9 +26,10 @@ from IPython.core.magic_arguments import (argument, magic_arguments,
 import ppmac.util as util
 from ppmac.util import PpmacExport
 from ppmac.pp_comm import (PPComm, TimeoutError)
-from ppmac.pp_comm import GPError
+from ppmac.pp_comm import (GPError, ProgramDownloadError)
 import ppmac.gather as gather
 import ppmac.completer as completer
+import ppmac.address_index as address_index
 import ppmac.tune as tune_mod
 import ppmac.const as const
 import ppmac.clock as clock_mod
@@ -61,6 +62,7 @@ def unload_ipython_extension(ipython):
     instance = PpmacCore.instance
     if instance is not None:
         PpmacCore.instance = None
+        instance.disconnect()
         return True
 
 # end Extension Initialization #
@@ -100,7 +102,10 @@ class PpmacCore(Configurable):
 
     default_servo_period = traitlets.Float(0.442673749446657994 * 1e-3, config=True)
     use_completer_db = traitlets.Bool(True, config=True)
+    use_variable_cache = traitlets.Bool(False, config=True)
     completer_db_file = traitlets.Unicode('ppmac.db', config=True)
+    use_address_index = traitlets.Bool(False, config=True)
+    address_index_path = traitlets.Unicode('address_index', config=True)
 
     def __init__(self, shell, config):
         PpmacCore.instance = self
@@ -124,9 +129,10 @@ class PpmacCore(Configurable):
                 change_fcn(trait, None, getattr(self, trait))
 
         self.comm = None
+        self.completer = None
+        self.address_index = None
 
         if self.use_completer_db:
-            self.completer = None
             self.open_completer_db()
 
     def open_completer_db(self):
@@ -194,17 +200,71 @@ class PpmacCore(Configurable):
         if password is None:
             password = self.password
 
+        self.disconnect()
         self.comm = PPComm(host=host, port=port,
                            user=user, password=password,
                            fast_gather=self.use_fast_gather,
                            fast_gather_port=self.fast_gather_port)
 
+        if self.use_variable_cache:
+            self.comm.gpascii.enable_cache()
+
         if self.use_completer_db:
             self.completer = None
             self.open_completer_db()
 
+        self.address_index = None
+        if self.use_address_index and self.completer is not None:
+            self.load_address_index()
+
         self.shell.user_ns['conn'] = self.comm.gpascii
 
+    def load_address_index(self, rebuild=False):
+        """
+        Load the reverse address index (building it if necessary), used to
+        label fast gather data without reading the settings file
+        """
+        if rebuild:
+            print('Building the address index (this may take a while)...')
+
+        self.address_index = address_index.get_address_index(
+            self.comm.gpascii, self.completer, path=self.address_index_path,
+            rebuild=rebuild, verbose=True)
+        print('Address index loaded: %d addresses' % len(self.address_index))
+
+    @magic_arguments()
+    @argument('-r', '--rebuild', action='store_true',
+              help='Rebuild the index, even if saved for this configuration')
+    @argument('address', type=unicode, nargs='?',
+              help='Address to look up (e.g., $3000a0)')
+    def addr_index(self, magic_args, arg):
+        """
+        Load the reverse address index, or look up an address in it
+        """
+        args = parse_argstring(self.addr_index, arg)
+
+        if not args or not self.check_comm():
+            return
+
+        if self.completer is None:
+            logger.error('Completer database required')
+            return
+
+        if self.address_index is None or args.rebuild:
+            self.load_address_index(rebuild=args.rebuild)
+
+        if args.address is not None:
+            addr = address_index.parse_address(args.address)
+            print('%s: %s' % (args.address, self.address_index.lookup(addr)))
+
+    def disconnect(self):
+        """
+        Close the connection (along with its gpascii channels), if any
+        """
+        if self.comm is not None:
+            comm, self.comm = self.comm, None
+            comm.close()
+
     def check_comm(self):
         if self.comm is None:
             if self.auto_connect:
@@ -361,15 +421,19 @@ class PpmacCore(Configurable):
         else:
             pattern, value = args.pattern, None
 
-        for i in range(args.low, args.high + 1):
-            var = pattern % i
-            try:
-                if value is None:
-                    self.get_verbose(var)
-                else:
-                    self.set_verbose(var, value)
-            except GPError as ex:
-                print(ex)
+        variables = [pattern % i for i in range(args.low, args.high + 1)]
+        gpascii = self._gpascii
+        if value is not None:
+            # Assignments packed after an error are dropped by gpascii, so
+            # each is checked
+            diff = gpascii.set_variables([(var, value) for var in variables])
+            for var in variables:
+                if var in diff:
+                    print('* Failed to set %s to %s (read back: %s)' %
+                          (var, value, diff[var][1]))
+
+        for var, value in zip(variables, gpascii.get_variables(variables)):
+            print('%s=%s' % (var, value))
 
     @PpmacExport
     def shell_cmd(self, command):
@@ -399,15 +463,14 @@ class PpmacCore(Configurable):
             return
 
         range_ = range(args.first_motor, args.first_motor + args.nmotors)
+        if not range_:
+            return
 
-        def get_values(var, type_=float):
-            var = 'Motor[%%d].%s' % var
-            return [self._gpascii.get_variable(var % i, type_=type_)
-                    for i in range_]
+        def get_values(var):
+            return self._gpascii.get_array('Motor[%d..%d].%s' %
+                                           (range_[0], range_[-1], var))
 
-        act_pos = get_values('ActPos')
-        home_pos = get_values('HomePos')
-        rel_pos = [act - home for act, home in zip(act_pos, home_pos)]
+        rel_pos = get_values('ActPos') - get_values('HomePos')
 
         for m, pos in zip(range_, rel_pos):
             print('Motor %2d: %.3g' % (m, pos))
@@ -426,6 +489,8 @@ class PpmacCore(Configurable):
               help='Servo-interrupt data gathering sampling period')
     @argument('addresses', default=1, nargs='+', type=unicode,
               help='Addresses to gather')
+    @argument('-p', '--phase', action='store_true',
+              help='Gather at the phase rate (requires fast_gather)')
     def gather(self, magic_args, arg):
         """
         Gather data
@@ -449,9 +514,23 @@ class PpmacCore(Configurable):
             addr.insert(0, 'Sys.ServoCount.a')
 
         gather.gather_and_plot(self.comm.gpascii, addr,
-                               duration=args.duration, period=args.period)
+                               duration=args.duration, period=args.period,
+                               phase=args.phase)
 
     def get_gather_results(self, settings_file=None, verbose=True):
+        if self.comm.fast_gather is not None:
+            # The settings are only read when the gather configuration changes
+            if verbose:
+                print('Reading gather data... ', end='')
+                sys.stdout.flush()
+
+            settings, data = gather.get_fast_gather_results(
+                self.comm, settings_file, address_index=self.address_index)
+            if verbose:
+                print('done')
+
+            return settings, data
+
         if verbose:
             print('Reading gather settings...')
         settings = gather.read_settings_file(self.comm, settings_file)
@@ -637,8 +716,6 @@ class PpmacCore(Configurable):
 
             addresses = settings['gather.addr']
 
-        data = np.array(data)
-
         desired_addr = 'motor[%d].despos.a' % motor
         actual_addr = 'motor[%d].actpos.a' % motor
 
@@ -1245,6 +1322,8 @@ class PpmacCore(Configurable):
               help='Motor assignment')
     @argument('-M', '--macro', nargs='*', type=unicode,
               help='Macros')
+    @argument('-s', '--sftp', action='store_true',
+              help='Upload the script via sftp (for large programs)')
     def prog_run(self, magic_self, arg):
         """
         Run a motion program in a coordinate system.
@@ -1287,7 +1366,7 @@ class PpmacCore(Configurable):
         gpascii = self.comm.gpascii
         prog_run(gpascii, coord=args.coord, program=args.program,
                  variables=args.variables, macros=macros, motors=motors,
-                 filename=args.filename)
+                 filename=args.filename, via_sftp=args.sftp)
 
     @magic_arguments()
     @argument('variables', nargs='+', type=unicode,
@@ -1516,7 +1595,8 @@ class PpmacCore(Configurable):
 
         gpascii = self.comm.gpascii
 
-        devices = list(hardware.enumerate_hardware(gpascii))
+        devices = list(hardware.enumerate_hardware(gpascii,
+                                                   pool=self.comm.pool))
 
         phase_master, servo_master = clock_mod.get_clock_master(devices)
         print('Phase clock master is', phase_master)
@@ -1545,10 +1625,30 @@ class PpmacCore(Configurable):
         if not args or not self.check_comm():
             return
 
+        expr = '%s.Chan[0..%d].Dac[0..%d]' % (args.device, args.channels - 1,
+                                                args.dacs - 1)
+        try:
+            values = self._gpascii.get_array(expr, dtype=str)
+        except (GPError, TimeoutError):
+            # Read each channel on its own, so that the error (e.g., a
+            # channel which does not exist) is reported for that channel
+            values = None
+
         for chan in range(args.channels):
+            if values is None:
+                expr = '%s.Chan[%d].Dac[0..%d]' % (args.device, chan,
+                                                   args.dacs - 1)
+                try:
+                    chan_values = self._gpascii.get_array(expr, dtype=str)
+                except (GPError, TimeoutError) as ex:
+                    print('%s.Chan[%d]: %s' % (args.device, chan, ex))
+                    continue
+            else:
+                chan_values = values[chan]
+
             for dac in range(args.dacs):
                 dac_chan = '%s.Chan[%d].Dac[%d]' % (args.device, chan, dac)
-                self.get_verbose(dac_chan)
+                print('%s=%s' % (dac_chan, chan_values[dac]))
 
 
 @PpmacExport
@@ -1633,7 +1733,7 @@ def build_utility(comm, source_files, output_name,
 
 
 def prog_run(gpascii, filename='', coord=0, program=1, variables=[],
-             motors={}, macros={}):
+             motors={}, macros={}, via_sftp=False):
     '''
     Run a motion program in a coordinate system.
 
@@ -1653,36 +1753,38 @@ def prog_run(gpascii, filename='', coord=0, program=1, variables=[],
 
     Prior to evaluating the script, macros in the script file in
     the form of '$(variable)' will be replaced with 'value'
+
+    Large scripts may be uploaded via sftp by setting `via_sftp`
     '''
     gpascii.send_line('&%dabort' % (coord, ))
     gpascii.sync()
 
     if filename:
         print('Sending script: %s' % filename)
-        lines = open(filename, 'rt').readlines()
+        script = open(filename, 'rt').read()
         opening_lines = ['close all buffers',
                          'open prog %d' % program]
         closing_lines = ['close']
 
-        script = opening_lines + lines + closing_lines
-        if macros:
-            script = '\n'.join(script)
-            for variable, value in macros.items():
-                macro = '$(%s)' % variable
-                script = script.replace(macro, value)
-
-            script = script.split('\n')
+        for variable, value in macros.items():
+            macro = '$(%s)' % variable
+            script = script.replace(macro, value)
 
-        for line in script:
-            if line.rstrip():
-                print(line.rstrip())
-            try:
-                gpascii.send_line(line.strip())
-            except GPError as ex:
-                print('Failed to send script: %s' % ex)
-                return
+        script = script.split('\n')
+        try:
+            gpascii.download(script, header=opening_lines,
+                             footer=closing_lines, via_sftp=via_sftp)
+        except ProgramDownloadError as ex:
+            print('Failed to send script:')
+            for line_number, line, message in ex.errors:
+                if line_number is None:
+                    print('    %s' % message)
+                else:
+                    print('    %s:%d: %s' % (filename, line_number, message))
+                    print('        %s' % line)
+            return
 
-        gpascii.sync()
+        print('Sent %d lines' % len(script))
 
     if motors:
         coords = {coord: motors}
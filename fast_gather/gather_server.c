@@ -1,12 +1,79 @@
 /*
  * (relatively) fast gather data server
- * - a simple forking TCP server that sends raw Power PMAC gather data
+ * - a single-process TCP server that sends raw Power PMAC gather data
  *
  * Usage: gather_server [port]
  * Default port is 2332
  *
- * (Largely based - rather, copied - on beej's networking guide, 
- * the source of which is in the public domain)
+ * Clients are served concurrently from a single epoll loop, and each reply
+ * is written with a single writev(). Commands (one per line) and the
+ * packets they are answered with:
+ *   servo, phase  send servo (default) or phase gather data from now on (K)
+ *   types         the type of each gathered item (T)
+ *   data          all gathered lines (D)
+ *   all           types, then data
+ *   stream        types, then newly gathered lines as they are acquired (S)
+ *                 until gathering is disabled or the client sends anything,
+ *                 then the total line count (Z). A cancel request stopping
+ *                 the stream is then acknowledged (K), just as it is once
+ *                 the stream has ended. Each S packet carries the sample
+ *                 number of its first line. If lines are overwritten in the
+ *                 gather buffer before they can be sent, the stream ends
+ *                 with an overrun error (E) in place of Z.
+ *   stats         request statistics, as key=value lines of text (R)
+ *   subset <first line> <line count> <step> <minmax> [item ...]
+ *                 the types of the selected items (T), then every step-th
+ *                 of line count lines (0 for all) of only those items (D);
+ *                 with minmax set to 1, a pair of lines for every step lines
+ *                 instead: the minimum then the maximum of each item.
+ *                 Without item indices, all items are selected.
+ *   meta          the gather configuration (M):
+ *                   (generation) (period) (max samples) (samples) (index)
+ *                   (shared memory base address) (servo period, ms, double)
+ *                   (phase over servo period, double) (phase mode, uint8)
+ *                   (items, uint8) (type, uint16 x items)
+ *                   (address, uint32 x items)
+ *                 where the generation is a hash of the items, types,
+ *                 addresses, period and max samples, which changes whenever
+ *                 the gather is reconfigured
+ *   full          meta, then data
+ *   wait <samples> <timeout ms> <start>
+ *                 wait until gathering is disabled or, with samples nonzero,
+ *                 until that many samples have been gathered, then send the
+ *                 outcome (W) followed by the gather configuration and data,
+ *                 as with full. With start set to 1, gathering must first be
+ *                 enabled (e.g., by a motion program which is yet to run).
+ *                 On timeout (0 for none), or if the client sends anything
+ *                 before then, the wait ends with only the outcome:
+ *                   (outcome: 0 gathering disabled, 1 samples gathered,
+ *                    2 timed out, 3 cancelled) (samples)
+ *   snapshot <interval us> <count> <type> <address> [<type> <address> ...]
+ *                 read the current values of the given addresses (hex) in
+ *                 shared memory, with the same type codes as gather (and
+ *                 so, the same decoding), sending them as (V):
+ *                   (snapshot number) (Sys.ServoCount) (values)
+ *                 With count set to 1, a single snapshot is sent. Otherwise
+ *                 a snapshot is sent every interval microseconds (at most
+ *                 once per STREAM_POLL_MS) until count have been sent (0 for
+ *                 no limit) or the client sends anything, then the number
+ *                 of snapshots sent (Z). Addresses outside of the shared
+ *                 memory structure are refused with an error (E).
+ *   cancel        end a wait or snapshots early, or stop a stream (as
+ *                 above); otherwise, acknowledged (K)
+ *   encoding <delta> <zlib level>
+ *                 encode the data of subsequent data and subset replies (K):
+ *                 with delta set to 1, each 32-bit word of a line is
+ *                 replaced by its difference from the previous line; with a
+ *                 zlib level of 1-9, the result is then compressed. Encoded
+ *                 data is sent as (C) in place of (D):
+ *                   (samples) (flags: 1 delta, 2 zlib) (raw data length)
+ *                   (encoded data)
+ * Unknown commands are answered with an error code (E), as are lines too
+ * long for the input buffer (BUF_SIZE), which are discarded up to the next
+ * newline.
+ *
+ * (Socket setup largely based - rather, copied - on beej's networking
+ * guide, the source of which is in the public domain)
  *
  * Author: K Lauer (klauer@bnl.gov)
  */
@@ -18,20 +85,59 @@
 #include <unistd.h>
 #include <errno.h>
 #include <string.h>
+#include <fcntl.h>
+#include <time.h>
 #include <sys/types.h>
 #include <sys/socket.h>
+#include <sys/epoll.h>
+#include <sys/uio.h>
 #include <netinet/in.h>
+#include <netinet/tcp.h>
 #include <netdb.h>
 #include <arpa/inet.h>
-#include <sys/wait.h>
 #include <signal.h>
+#include <zlib.h>
 #include <gplib.h>  // Power PMAC-specific
 
 #define DEFAULT_PORT "2332"
-#define BACKLOG 1           // how many pending connections queue will hold
-
-// Input buffer size
-const int BUF_SIZE = 100;
+#define BACKLOG 10          // how many pending connections queue will hold
+#define MAX_EVENTS 16       // events handled per epoll_wait
+
+// Input buffer size (a line, such as a snapshot request listing many
+// addresses, must fit)
+#define BUF_SIZE 4096
+
+// While streaming (or waiting, or sending snapshots), how often (ms) the
+// gather index (or state, or time) is checked
+#define STREAM_POLL_MS 1
+
+// Pending output per client: small items (packet headers, types, etc.) are
+// copied into a per-client buffer, while gather data is sent directly from
+// the gather buffer
+#define MAX_IOV 8
+#define OUT_BUF_SIZE 2048
+
+// Error codes, sent in E packets
+#define ERR_UNKNOWN_COMMAND 1
+#define ERR_BAD_ARGUMENT 2
+#define ERR_NO_MEMORY 3
+#define ERR_ENCODING 4
+#define ERR_BAD_ADDRESS 5
+#define ERR_OVERRUN 6
+#define ERR_LINE_TOO_LONG 7
+
+// Data encoding flags
+#define ENCODE_DELTA 1
+#define ENCODE_ZLIB 2
+
+// Outcomes of a wait, sent in W packets
+#define WAIT_DISABLED 0
+#define WAIT_SAMPLES 1
+#define WAIT_TIMEOUT 2
+#define WAIT_CANCELLED 3
+
+// Gather.Items is an unsigned char
+#define MAX_ITEMS 256
 
 // Gather types as strings
 #define N_GATHER_TYPES 8
@@ -81,110 +187,1163 @@ from http://forums.deltatau.com/archive/index.php?thread-933.html :
  More generally, the value in bits 6-10 is 32 minus the number of bits in the element.
 */
 
-// Ensures that the full buffer is sent
-int send_all(int s, const char *buf, unsigned int len)
-{
-    unsigned int total = 0;        // how many bytes we've sent
-    unsigned int bytesleft = len; // how many we have left to send
-    int n;
+enum request_type {
+    REQ_SERVO,
+    REQ_PHASE,
+    REQ_TYPES,
+    REQ_DATA,
+    REQ_ALL,
+    REQ_STREAM,
+    REQ_STATS,
+    REQ_SUBSET,
+    REQ_ENCODING,
+    REQ_META,
+    REQ_FULL,
+    REQ_WAIT,
+    REQ_CANCEL,
+    REQ_SNAPSHOT,
+    REQ_UNKNOWN,
+    N_REQUEST_TYPES
+};
 
-    while(total < len) {
-        n = send(s, buf+total, bytesleft, 0);
-        if (n == -1) {
-            break; 
-        }
+const char *request_names[N_REQUEST_TYPES] = {
+    "servo",
+    "phase",
+    "types",
+    "data",
+    "all",
+    "stream",
+    "stats",
+    "subset",
+    "encoding",
+    "meta",
+    "full",
+    "wait",
+    "cancel",
+    "snapshot",
+    "unknown"
+};
 
-        total += n;
-        bytesleft -= n;
-    }
+// Service time: from receiving a request until its reply is fully written
+// (for stream, until the types packet is written; for wait, including the
+// wait; for snapshot, until the first snapshot is written)
+struct request_stats {
+    unsigned long count;
+    double total_us;
+    double max_us;
+};
+
+struct server_stats {
+    struct timespec started;
+    unsigned int clients;
+    unsigned long accepted;
+    unsigned long long bytes_sent;
+    unsigned long long encoded_raw_bytes;   // data encoded, before
+    unsigned long long encoded_bytes;       // and after encoding
+    struct request_stats requests[N_REQUEST_TYPES];
+} stats;
+
+// Servo or phase gather buffer information
+struct gather_buffer {
+    unsigned char items;
+    unsigned short *types;
+    unsigned int samples;
+    char *buffer;
+    unsigned int line_length;   // bytes per line
+    unsigned int max_lines;     // lines in the (circular) buffer
+    unsigned int period;
+    unsigned int max_samples;
+    unsigned int index;
+    unsigned int addrs[MAX_ITEMS];
+};
 
-    //*len = total; // return number actually sent here
+// Position in the gather buffer of the lines not yet streamed to a client
+struct stream_state {
+    char *buffer;
+    unsigned int line_length;   // bytes per line
+    unsigned int max_lines;     // lines in the (circular) buffer
+    unsigned int next_line;     // index of the next line to send
+    unsigned int next_sample;   // and its sample number
+    unsigned int sent;          // total lines sent
+};
 
-    return n==-1?-1:0; // return -1 on failure, 0 on success
-} 
+// Conditions ending a wait request
+struct wait_state {
+    unsigned int samples;       // samples to wait for (0 for none)
+    unsigned int start_samples; // samples when the wait began
+    bool need_start;            // gathering is yet to be enabled
+    bool timed;
+    struct timespec deadline;
+};
 
-// Send a simple string to the client
-int send_str(int client, const char *str) {
-    if (!str)
-        return -1;
+// Addresses, values and schedule of a snapshot request
+struct snapshot_state {
+    unsigned int n_items;
+    unsigned short types[MAX_ITEMS];
+    const char *addrs[MAX_ITEMS];
+    unsigned int sizes[MAX_ITEMS];
+    unsigned int count;         // snapshots to send (0 for no limit)
+    unsigned int sent;          // snapshots sent
+    unsigned int interval_us;
+    struct timespec next;       // time of the next snapshot
+    unsigned int header[2];     // (snapshot number) (servo count)
+    char values[MAX_ITEMS * sizeof(double)];
+};
 
-    return send_all(client, str, strlen(str));
-}
+// Selected items, line range and decimation of a subset request
+struct subset {
+    unsigned int first;
+    unsigned int count;
+    unsigned int step;
+    bool minmax;
+    unsigned int n_items;
+    unsigned char items[MAX_ITEMS];
+};
 
-// Send a string to the client with the packet length header
-int send_str_packet(int client, const char *str) {
-    if (!str)
-        return -1;
-    
-    unsigned int length = strlen(str);
+struct client {
+    int fd;
+    unsigned int events;        // events registered with epoll
+    bool phase;
+    unsigned int encoding;      // ENCODE_* flags for data
+    int zlib_level;
+
+    // Received, unprocessed input
+    char in_buf[BUF_SIZE];
+    unsigned int in_len;
+    bool discarding;            // the rest of a line which was too long
+
+    // Pending output
+    char out_buf[OUT_BUF_SIZE];
+    unsigned int out_len;
+    struct iovec iov[MAX_IOV];
+    int iov_count;
+    int iov_index;
+    char *scratch;              // reply data built for the request, if any
+
+    // Request awaiting completion (or -1), for the statistics
+    int request;
+    struct timespec request_start;
+
+    bool streaming;
+    struct stream_state stream;
+
+    bool waiting;
+    struct wait_state wait;
 
-    send_all(client, (char*)&length, sizeof(unsigned int));
-    return send_all(client, str, length);
+    bool snapshotting;
+    struct snapshot_state snap;
+
+    struct client *next;
+};
+
+struct client *clients = NULL;
+int epoll_fd = -1;
+
+double elapsed_us(const struct timespec *start, const struct timespec *end) {
+    return ((end->tv_sec - start->tv_sec) * 1e6 +
+            (end->tv_nsec - start->tv_nsec) * 1e-3);
+}
+
+// Advance a time by a number of microseconds
+void add_us(struct timespec *t, unsigned long us) {
+    t->tv_sec += us / 1000000;
+    t->tv_nsec += (us % 1000000) * 1000L;
+    if (t->tv_nsec >= 1000000000L) {
+        t->tv_sec++;
+        t->tv_nsec -= 1000000000L;
+    }
 }
 
-// Send the type information for each gathered item to the client
-// If phase is set, gathered phase information will be sent,
-// otherwise gathered servo information will be sent.
-bool send_types(int client, bool phase) {
+// Get the servo or phase gather buffer information
+void get_gather_buffer(bool phase, struct gather_buffer *gb) {
     GATHER *gather;
     gather = &pshm->Gather;
-    unsigned char items;
-    unsigned short *types;
-    unsigned int buf_len;
+
+    int i;
 
     if (phase) {
-        items = gather->PhaseItems;
-        types = gather->PhaseType;
+        gb->items = gather->PhaseItems;
+        gb->types = gather->PhaseType;
+        gb->samples = gather->PhaseSamples;
+        gb->buffer = (char*)gather->PhaseBuffer;
+        gb->line_length = gather->PhaseLineLength << 2;
+        gb->max_lines = gather->PhaseMaxLines;
+        gb->period = gather->PhasePeriod;
+        gb->max_samples = gather->PhaseMaxSamples;
+        gb->index = gather->PhaseIndex;
+        for (i = 0; i < gb->items; i++) {
+            gb->addrs[i] = (unsigned int)(unsigned long)gather->PhaseAddr[i];
+        }
     } else {
-        items = gather->Items;
-        types = &gather->Type[0];
+        gb->items = gather->Items;
+        gb->types = gather->Type;
+        gb->samples = gather->Samples;
+        gb->buffer = (char*)gather->Buffer;
+        gb->line_length = gather->LineLength << 2;
+        gb->max_lines = gather->MaxLines;
+        gb->period = gather->Period;
+        gb->max_samples = gather->MaxSamples;
+        gb->index = gather->Index;
+        for (i = 0; i < gb->items; i++) {
+            gb->addrs[i] = (unsigned int)(unsigned long)gather->Addr[i];
+        }
     }
+}
 
-    buf_len = sizeof(items) + sizeof(unsigned short) * items + 1;
+// 32-bit FNV-1a hash
+unsigned int fnv1a(unsigned int hash, const void *data, unsigned int len) {
+    const unsigned char *p = (const unsigned char*)data;
+    unsigned int i;
 
-    printf("client %d types request. items=%d buffer length=%d (phase=%d)\n", client, items, buf_len, phase);
-    send_all(client, (char*)&buf_len, sizeof(unsigned int));
-    send_str(client, "T");
-    send_all(client, (char*)&items, sizeof(unsigned char));
-    send_all(client, (char*)types, sizeof(unsigned short) * items);
+    for (i = 0; i < len; i++) {
+        hash = (hash ^ p[i]) * 16777619u;
+    }
+    return hash;
+}
 
-    return (items > 0);
+// Generation of the gather configuration, which changes whenever it does
+// (and, being a hash, is the same across server restarts)
+unsigned int gather_generation(struct gather_buffer *gb) {
+    unsigned int hash = 2166136261u;
+
+    hash = fnv1a(hash, &gb->items, sizeof(gb->items));
+    hash = fnv1a(hash, gb->types, sizeof(unsigned short) * gb->items);
+    hash = fnv1a(hash, gb->addrs, sizeof(unsigned int) * gb->items);
+    hash = fnv1a(hash, &gb->period, sizeof(gb->period));
+    hash = fnv1a(hash, &gb->max_samples, sizeof(gb->max_samples));
+    return hash;
 }
 
-// Send the gathered raw data to the client
-// If phase is set, gathered phase data will be sent,
-// otherwise gathered servo data will be sent.
-void send_data(int client, bool phase) {
-    GATHER *gather;
-    gather = &pshm->Gather;
-    int line_length=0;
-    unsigned int buf_len, samples, *buffer;
-    unsigned short *types;
-    unsigned char items;
-    
-    if (phase) {
-        items = gather->PhaseItems;
-        types = gather->PhaseType;
-        samples = gather->PhaseSamples;
-        buffer = gather->PhaseBuffer;
-        line_length = gather->PhaseLineLength << 2;
+// Current write index (line number) of the gather buffer
+unsigned int gather_index(GATHER *gather, bool phase) {
+    return (phase ? gather->PhaseIndex : gather->Index);
+}
+
+// Number of samples gathered so far
+unsigned int gather_samples(GATHER *gather, bool phase) {
+    return (phase ? gather->PhaseSamples : gather->Samples);
+}
+
+// Read the sample count and the write index together, retrying should a
+// sample be gathered in between
+void gather_position(GATHER *gather, bool phase, unsigned int *samples,
+                     unsigned int *index) {
+    do {
+        *samples = gather_samples(gather, phase);
+        *index = gather_index(gather, phase);
+    } while (*samples != gather_samples(gather, phase));
+}
+
+// Whether gathering is in progress
+bool gather_enabled(GATHER *gather, bool phase) {
+    return (phase ? gather->PhaseEnable : gather->Enable) != 0;
+}
+
+// Size in bytes of a gathered item of the given type
+unsigned int gather_type_size(unsigned short type) {
+    return (type == enum_doublegat ? sizeof(double) : sizeof(unsigned int));
+}
+
+// Value of a gathered item, decoded as by the client, for comparison
+double gather_value(unsigned short type, const char *p) {
+    unsigned int uint_temp, bit_start, bit_count;
+    int int_temp;
+    float flt_temp;
+    double dbl_temp;
+
+    switch (type) {
+    case enum_int32gat:
+        memcpy(&int_temp, p, sizeof(int));
+        return int_temp;
+
+    case enum_int24gat:
+        memcpy(&uint_temp, p, sizeof(unsigned int));
+        return (int)((uint_temp & 0xFFFFFF) ^ 0x800000) - 0x800000;
+
+    case enum_uint24gat:
+        memcpy(&uint_temp, p, sizeof(unsigned int));
+        return uint_temp & 0xFFFFFF;
+
+    case enum_floatgat:
+        memcpy(&flt_temp, p, sizeof(float));
+        return flt_temp;
+
+    case enum_doublegat:
+        memcpy(&dbl_temp, p, sizeof(double));
+        return dbl_temp;
+
+    case enum_uint32gat:
+    case enum_ubitsgat:
+    case enum_sbitsgat:
+        memcpy(&uint_temp, p, sizeof(unsigned int));
+        return uint_temp;
+
+    default:
+        // A part of a 32-bit word (see notes above)
+        bit_start = (type & start_mask) >> 11;
+        bit_count = 32 - ((type & bit_count_mask) >> 6);
+
+        memcpy(&uint_temp, p, sizeof(unsigned int));
+        uint_temp >>= bit_start;
+        if (bit_count < 32) {
+            uint_temp &= ((1 << bit_count) - 1);
+        }
+        return uint_temp;
+    }
+}
+
+bool output_pending(struct client *c) {
+    return (c->iov_index < c->iov_count);
+}
+
+// Queue a copy of small items (packet headers and such) to be sent
+bool queue_copy(struct client *c, const void *data, unsigned int len) {
+    struct iovec *last;
+    char *dest = c->out_buf + c->out_len;
+
+    if (len == 0) {
+        return true;
+    } else if (c->out_len + len > OUT_BUF_SIZE) {
+        return false;
+    }
+
+    memcpy(dest, data, len);
+    c->out_len += len;
+
+    last = (c->iov_count > 0 ? &c->iov[c->iov_count - 1] : NULL);
+    if (last && (char*)last->iov_base + last->iov_len == dest) {
+        // Contiguous with the previous item
+        last->iov_len += len;
+        return true;
+    } else if (c->iov_count == MAX_IOV) {
+        return false;
+    }
+
+    c->iov[c->iov_count].iov_base = dest;
+    c->iov[c->iov_count].iov_len = len;
+    c->iov_count++;
+    return true;
+}
+
+// Queue data to be sent without copying (the gather buffer)
+bool queue_ref(struct client *c, const void *data, unsigned int len) {
+    if (len == 0) {
+        return true;
+    } else if (c->iov_count == MAX_IOV) {
+        return false;
+    }
+
+    c->iov[c->iov_count].iov_base = (void*)data;
+    c->iov[c->iov_count].iov_len = len;
+    c->iov_count++;
+    return true;
+}
+
+// Queue the header of a packet:
+//   (packet length) (code)
+// where the length includes the code and the payload which follows
+bool queue_packet(struct client *c, char code, unsigned int payload_len) {
+    unsigned int buf_len = payload_len + 1;
+
+    return (queue_copy(c, &buf_len, sizeof(unsigned int)) &&
+            queue_copy(c, &code, 1));
+}
+
+bool queue_error(struct client *c, unsigned int error_code) {
+    return (queue_packet(c, 'E', sizeof(unsigned int)) &&
+            queue_copy(c, &error_code, sizeof(unsigned int)));
+}
+
+// Queue the type information for each gathered item
+bool queue_types(struct client *c, struct gather_buffer *gb) {
+    return (queue_packet(c, 'T', 1 + sizeof(unsigned short) * gb->items) &&
+            queue_copy(c, &gb->items, sizeof(unsigned char)) &&
+            queue_copy(c, gb->types, sizeof(unsigned short) * gb->items));
+}
+
+// Replace each 32-bit word of each line (but the first) by its difference
+// from the same word of the previous line
+void delta_encode(unsigned int *words, unsigned int lines,
+                  unsigned int line_words) {
+    unsigned int i;
+
+    for (i = lines * line_words; i-- > line_words; ) {
+        words[i] -= words[i - line_words];
+    }
+}
+
+// Queue lines of raw data, encoded as requested by the client:
+//   (packet length) D (samples) (raw data)
+// or, if encoded:
+//   (packet length) C (samples) (flags) (raw data length) (encoded data)
+// The data is encoded in the client's scratch buffer; if it is not already
+// there, it is copied, leaving the gather buffer untouched.
+bool queue_lines(struct client *c, unsigned int samples, const char *data,
+                 unsigned int line_length) {
+    unsigned int data_len = samples * line_length;
+    unsigned int header[3];
+    uLongf encoded_len;
+    char *encoded;
+
+    if (c->encoding == 0 || data_len == 0) {
+        return (queue_packet(c, 'D', sizeof(unsigned int) + data_len) &&
+                queue_copy(c, &samples, sizeof(unsigned int)) &&
+                queue_ref(c, data, data_len));
+    }
+
+    encoded_len = data_len;
+    if (c->encoding & ENCODE_DELTA) {
+        if (data != c->scratch) {
+            c->scratch = (char*)malloc(data_len);
+            if (c->scratch == NULL) {
+                return queue_error(c, ERR_NO_MEMORY);
+            }
+            memcpy(c->scratch, data, data_len);
+        }
+
+        delta_encode((unsigned int*)c->scratch, samples, line_length >> 2);
+        data = c->scratch;
+    }
+
+    if (c->encoding & ENCODE_ZLIB) {
+        encoded_len = compressBound(data_len);
+        encoded = (char*)malloc(encoded_len);
+        if (encoded == NULL) {
+            return queue_error(c, ERR_NO_MEMORY);
+        }
+
+        if (compress2((Bytef*)encoded, &encoded_len, (const Bytef*)data,
+                      data_len, c->zlib_level) != Z_OK) {
+            free(encoded);
+            return queue_error(c, ERR_ENCODING);
+        }
+
+        free(c->scratch);
+        c->scratch = encoded;
+        data = encoded;
+    }
+
+    stats.encoded_raw_bytes += data_len;
+    stats.encoded_bytes += encoded_len;
+
+    header[0] = samples;
+    header[1] = c->encoding;
+    header[2] = data_len;
+    return (queue_packet(c, 'C', sizeof(header) + encoded_len) &&
+            queue_copy(c, header, sizeof(header)) &&
+            queue_ref(c, data, encoded_len));
+}
+
+// Queue the gathered raw data
+bool queue_data(struct client *c, struct gather_buffer *gb) {
+    unsigned int samples;
+
+    // Once a circular gather wraps around, only the buffer is available
+    samples = (gb->samples < gb->max_lines ? gb->samples : gb->max_lines);
+    return queue_lines(c, samples, gb->buffer, gb->line_length);
+}
+
+// Queue the gather configuration (see the meta command above)
+bool queue_metadata(struct client *c, struct gather_buffer *gb) {
+    unsigned int header[6];
+    double periods[2];
+    unsigned char flags[2];
+
+    header[0] = gather_generation(gb);
+    header[1] = gb->period;
+    header[2] = gb->max_samples;
+    header[3] = gb->samples;
+    header[4] = gb->index;
+    header[5] = (unsigned int)(unsigned long)pshm;
+    periods[0] = pshm->ServoPeriod;
+    periods[1] = pshm->PhaseOverServoPeriod;
+    flags[0] = c->phase;
+    flags[1] = gb->items;
+
+    return (queue_packet(c, 'M', sizeof(header) + sizeof(periods) + sizeof(flags) +
+                         (sizeof(unsigned short) + sizeof(unsigned int)) * gb->items) &&
+            queue_copy(c, header, sizeof(header)) &&
+            queue_copy(c, periods, sizeof(periods)) &&
+            queue_copy(c, flags, sizeof(flags)) &&
+            queue_copy(c, gb->types, sizeof(unsigned short) * gb->items) &&
+            queue_copy(c, gb->addrs, sizeof(unsigned int) * gb->items));
+}
+
+// End a stream which fell behind the gather, some of its lines having been
+// overwritten before they could be sent (E)
+bool queue_stream_overrun(struct client *c) {
+    c->streaming = false;
+    return queue_error(c, ERR_OVERRUN);
+}
+
+// Queue the lines gathered since the last call as a single packet:
+//   (packet length) S (first sample) (line count) (raw data)
+// The new lines are counted from the samples gathered, as the write index
+// alone cannot tell no new lines from a full buffer of them. They are
+// copied out of the gather buffer (wrapping around its end as necessary),
+// as the gather may overwrite them before they are sent.
+bool queue_new_lines(struct client *c) {
+    struct stream_state *st = &c->stream;
+    unsigned int samples, lines, first_lines;
+    unsigned int header[2];
+    char *data;
+
+    samples = gather_samples(&pshm->Gather, c->phase);
+    lines = samples - st->next_sample;
+    if (lines == 0) {
+        return true;
+    } else if (lines >= st->max_lines) {
+        // (the oldest line is the next to be overwritten, if not already)
+        return queue_stream_overrun(c);
+    }
+
+    first_lines = st->max_lines - st->next_line;
+    if (first_lines > lines) {
+        first_lines = lines;
+    }
+
+    data = (char*)malloc(lines * st->line_length);
+    if (data == NULL) {
+        c->streaming = false;
+        return queue_error(c, ERR_NO_MEMORY);
+    }
+
+    memcpy(data, st->buffer + st->next_line * st->line_length,
+           first_lines * st->line_length);
+    memcpy(data + first_lines * st->line_length, st->buffer,
+           (lines - first_lines) * st->line_length);
+
+    free(c->scratch);
+    c->scratch = data;
+
+    // The oldest lines may have been overwritten while being copied
+    if (gather_samples(&pshm->Gather, c->phase) - st->next_sample >=
+            st->max_lines) {
+        return queue_stream_overrun(c);
+    }
+
+    header[0] = st->next_sample;
+    header[1] = lines;
+    if (!queue_packet(c, 'S', sizeof(header) + lines * st->line_length) ||
+        !queue_copy(c, header, sizeof(header)) ||
+        !queue_ref(c, data, lines * st->line_length)) {
+        return false;
+    }
+
+    st->next_line = (st->next_line + lines) % st->max_lines;
+    st->next_sample = samples;
+    st->sent += lines;
+    return true;
+}
+
+// End a stream with the total number of lines sent:
+//   (packet length) Z (line count)
+bool queue_stream_end(struct client *c) {
+    c->streaming = false;
+    return (queue_packet(c, 'Z', sizeof(unsigned int)) &&
+            queue_copy(c, &c->stream.sent, sizeof(unsigned int)));
+}
+
+// Start streaming gathered data to the client as it is acquired
+// (see poll_streams)
+bool start_stream(struct client *c) {
+    struct gather_buffer gb;
+    struct stream_state *st = &c->stream;
+    unsigned int samples, index;
+
+    get_gather_buffer(c->phase, &gb);
+    st->buffer = gb.buffer;
+    st->line_length = gb.line_length;
+    st->max_lines = gb.max_lines;
+    st->sent = 0;
+
+    if (!queue_types(c, &gb)) {
+        return false;
+    } else if (gb.items == 0 || gb.max_lines == 0) {
+        return queue_stream_end(c);
+    }
+
+    gather_position(&pshm->Gather, c->phase, &samples, &index);
+    if (samples < gb.max_lines) {
+        // Not yet wrapped around, so the full gather is still in the buffer
+        st->next_line = 0;
+        st->next_sample = 0;
     } else {
-        items = gather->Items;
-        types = gather->Type;
-        samples = gather->Samples;
-        buffer = gather->Buffer;
-        line_length = gather->LineLength << 2;
+        st->next_line = index % gb.max_lines;
+        st->next_sample = samples;
     }
 
-    buf_len = sizeof(unsigned int) + (line_length * samples) + 1;
+    c->streaming = true;
+    return true;
+}
 
-    printf("client %d data request. items=%d samples=%d bytes/line=%d buffer length=%d (phase=%d)\n", 
-            client, items, gather->Samples, line_length, buf_len, phase);
-    
-    send_all(client, (char*)&buf_len, sizeof(unsigned int));
-    send_str(client, "D");
-    send_all(client, (char*)&samples, sizeof(unsigned int));
-    send_all(client, (char*)buffer, (line_length * samples));
+// Queue the request statistics as text, one key=value per line
+bool queue_stats(struct client *c) {
+    char text[OUT_BUF_SIZE - 16];   // (leaving room for the packet header)
+    struct timespec now;
+    struct request_stats *rs;
+    int len, i;
+
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    len = snprintf(text, sizeof(text),
+                   "uptime_s=%.3f\nclients=%u\naccepted=%lu\nbytes_sent=%llu\n"
+                   "encoded_raw_bytes=%llu\nencoded_bytes=%llu\n",
+                   elapsed_us(&stats.started, &now) * 1e-6, stats.clients,
+                   stats.accepted, stats.bytes_sent,
+                   stats.encoded_raw_bytes, stats.encoded_bytes);
+
+    for (i = 0; i < N_REQUEST_TYPES && len < (int)sizeof(text); i++) {
+        rs = &stats.requests[i];
+        len += snprintf(text + len, sizeof(text) - len,
+                        "%s.count=%lu\n%s.mean_us=%.1f\n%s.max_us=%.1f\n",
+                        request_names[i], rs->count,
+                        request_names[i], (rs->count ? rs->total_us / rs->count : 0.0),
+                        request_names[i], rs->max_us);
+    }
+
+    if (len >= (int)sizeof(text)) {
+        len = sizeof(text) - 1;
+    }
+
+    return (queue_packet(c, 'R', len) &&
+            queue_copy(c, text, len));
+}
+
+// Parse the arguments of a subset request:
+//   <first line> <line count> <step> <minmax> [item ...]
+bool parse_subset(char *args, struct gather_buffer *gb, struct subset *sub) {
+    unsigned int values[4];
+    unsigned long value;
+    char *token, *end, *saveptr;
+    int i;
+
+    sub->n_items = 0;
+    token = strtok_r(args, " ", &saveptr);
+    for (i = 0; token != NULL; i++) {
+        value = strtoul(token, &end, 10);
+        if (*end != 0) {
+            return false;
+        }
+
+        if (i < 4) {
+            values[i] = value;
+        } else if (value >= gb->items || sub->n_items == MAX_ITEMS) {
+            return false;
+        } else {
+            sub->items[sub->n_items++] = value;
+        }
+
+        token = strtok_r(NULL, " ", &saveptr);
+    }
+
+    if (i < 4 || values[2] == 0 || values[3] > 1) {
+        return false;
+    }
+
+    sub->first = values[0];
+    sub->count = values[1];
+    sub->step = values[2];
+    sub->minmax = (values[3] == 1);
+
+    if (sub->n_items == 0) {
+        for (i = 0; i < gb->items; i++) {
+            sub->items[i] = i;
+        }
+        sub->n_items = gb->items;
+    }
+    return true;
+}
+
+// Queue the selected items of the selected lines, gathered into a new
+// buffer, along with their types
+bool queue_subset(struct client *c, struct gather_buffer *gb,
+                  struct subset *sub) {
+    unsigned int offsets[MAX_ITEMS], sizes[MAX_ITEMS];
+    unsigned short types[MAX_ITEMS];
+    unsigned int available, end, line, block_end, offset;
+    unsigned int i, j, lines, out_line_length, min_line, max_line;
+    unsigned char n_items = sub->n_items;
+    double value, min_value, max_value;
+    char *out;
+
+    // Offsets of all items in a line of the gather buffer
+    offset = 0;
+    for (i = 0; i < gb->items; i++) {
+        offsets[i] = offset;
+        offset += gather_type_size(gb->types[i]);
+    }
+
+    out_line_length = 0;
+    for (i = 0; i < n_items; i++) {
+        types[i] = gb->types[sub->items[i]];
+        sizes[i] = gather_type_size(types[i]);
+        out_line_length += sizes[i];
+    }
+
+    // Once a circular gather wraps around, only the buffer is available
+    available = (gb->samples < gb->max_lines ? gb->samples : gb->max_lines);
+    if (sub->first >= available) {
+        end = sub->first;
+    } else if (sub->count == 0 || sub->count > available - sub->first) {
+        end = available;
+    } else {
+        end = sub->first + sub->count;
+    }
+
+    lines = (end - sub->first + sub->step - 1) / sub->step;
+    if (sub->minmax) {
+        lines *= 2;
+    }
+
+    if (lines > 0) {
+        c->scratch = (char*)malloc(lines * out_line_length);
+        if (c->scratch == NULL) {
+            return queue_error(c, ERR_NO_MEMORY);
+        }
+    }
+
+    out = c->scratch;
+    for (line = sub->first; line < end; line += sub->step) {
+        if (!sub->minmax) {
+            for (i = 0; i < n_items; i++) {
+                memcpy(out, gb->buffer + line * gb->line_length + offsets[sub->items[i]],
+                       sizes[i]);
+                out += sizes[i];
+            }
+            continue;
+        }
+
+        block_end = (end - line > sub->step ? line + sub->step : end);
+
+        // The line with the minimum, then the line with the maximum
+        // value of each item in the block
+        for (i = 0; i < n_items; i++) {
+            offset = offsets[sub->items[i]];
+            min_line = max_line = line;
+            min_value = max_value = gather_value(types[i],
+                                                 gb->buffer + line * gb->line_length + offset);
+
+            for (j = line + 1; j < block_end; j++) {
+                value = gather_value(types[i], gb->buffer + j * gb->line_length + offset);
+                if (value < min_value) {
+                    min_value = value;
+                    min_line = j;
+                } else if (value > max_value) {
+                    max_value = value;
+                    max_line = j;
+                }
+            }
+
+            memcpy(out, gb->buffer + min_line * gb->line_length + offset, sizes[i]);
+            memcpy(out + out_line_length, gb->buffer + max_line * gb->line_length + offset,
+                   sizes[i]);
+            out += sizes[i];
+        }
+
+        // Skip the line of maximums
+        out += out_line_length;
+    }
+
+    return (queue_packet(c, 'T', 1 + sizeof(unsigned short) * n_items) &&
+            queue_copy(c, &n_items, sizeof(unsigned char)) &&
+            queue_copy(c, types, sizeof(unsigned short) * n_items) &&
+            queue_lines(c, lines, c->scratch, out_line_length));
+}
+
+// Set the encoding of data from the arguments of an encoding request:
+//   <delta> <zlib level>
+bool set_encoding(struct client *c, const char *args) {
+    unsigned int delta, level;
+    char extra;
+
+    if (sscanf(args, "%u %u %c", &delta, &level, &extra) != 2 ||
+        delta > 1 || level > 9) {
+        return false;
+    }
+
+    c->encoding = ((delta ? ENCODE_DELTA : 0) |
+                   (level > 0 ? ENCODE_ZLIB : 0));
+    c->zlib_level = level;
+    return true;
+}
+
+// End a wait, queueing its outcome and (unless it timed out or was
+// cancelled) the gather configuration and data
+bool queue_wait_end(struct client *c, unsigned int outcome) {
+    struct gather_buffer gb;
+    unsigned int reply[2];
+
+    get_gather_buffer(c->phase, &gb);
+    c->waiting = false;
+
+    reply[0] = outcome;
+    reply[1] = gb.samples;
+    if (!queue_packet(c, 'W', sizeof(reply)) ||
+        !queue_copy(c, reply, sizeof(reply))) {
+        return false;
+    } else if (outcome == WAIT_TIMEOUT || outcome == WAIT_CANCELLED) {
+        return true;
+    }
+
+    return (queue_metadata(c, &gb) && queue_data(c, &gb));
+}
+
+// Check whether the wait of a client has ended, queueing the reply if so
+bool check_wait(struct client *c) {
+    struct wait_state *w = &c->wait;
+    GATHER *gather = &pshm->Gather;
+    struct timespec now;
+    bool enabled;
+    unsigned int samples;
+
+    enabled = gather_enabled(gather, c->phase);
+    samples = gather_samples(gather, c->phase);
+
+    if (w->need_start && (enabled || samples != w->start_samples)) {
+        // (a short gather may have come and gone between checks)
+        w->need_start = false;
+    }
+
+    if (!w->need_start) {
+        if (w->samples > 0 && samples >= w->samples) {
+            return queue_wait_end(c, WAIT_SAMPLES);
+        } else if (!enabled) {
+            return queue_wait_end(c, WAIT_DISABLED);
+        }
+    }
+
+    if (w->timed) {
+        clock_gettime(CLOCK_MONOTONIC, &now);
+        if (elapsed_us(&w->deadline, &now) >= 0.0) {
+            return queue_wait_end(c, WAIT_TIMEOUT);
+        }
+    }
+    return true;
+}
+
+// Start a wait from the arguments of a wait request:
+//   <samples> <timeout ms> <start>
+bool start_wait(struct client *c, const char *args) {
+    struct wait_state *w = &c->wait;
+    unsigned int samples, timeout_ms, start;
+    char extra;
+
+    if (args == NULL ||
+        sscanf(args, "%u %u %u %c", &samples, &timeout_ms, &start, &extra) != 3 ||
+        start > 1) {
+        return queue_error(c, ERR_BAD_ARGUMENT);
+    }
+
+    w->samples = samples;
+    w->start_samples = gather_samples(&pshm->Gather, c->phase);
+    w->need_start = (start == 1);
+    w->timed = (timeout_ms > 0);
+    clock_gettime(CLOCK_MONOTONIC, &w->deadline);
+    add_us(&w->deadline, timeout_ms * 1000UL);
+
+    c->waiting = true;
+    return check_wait(c);
+}
+
+// Whether a type is a gather type: one of the enumerated types, or a part
+// of a 32-bit word (see notes above)
+bool valid_gather_type(unsigned short type) {
+    unsigned int bit_start, bit_count;
+
+    if (type < N_GATHER_TYPES) {
+        return true;
+    }
+
+    bit_start = (type & start_mask) >> 11;
+    bit_count = 32 - ((type & bit_count_mask) >> 6);
+    return (bit_count > 0 && bit_start + bit_count <= 32);
+}
+
+// Whether an item of the given size at an address lies entirely within the
+// shared memory structure (and is word-aligned)
+bool valid_shm_address(unsigned long addr, unsigned int size) {
+    unsigned long base = (unsigned long)pshm;
+
+    return (addr % sizeof(unsigned int) == 0 && addr >= base &&
+            addr - base <= sizeof(SHM) - size);
+}
+
+// Parse the arguments of a snapshot request:
+//   <interval us> <count> <type> <address> [<type> <address> ...]
+// Returns 0 or the error code
+unsigned int parse_snapshot(char *args, struct snapshot_state *snap) {
+    unsigned long values[2], value, addr;
+    char *token, *end, *saveptr;
+    unsigned int i, item;
+
+    snap->n_items = 0;
+    token = strtok_r(args, " ", &saveptr);
+    for (i = 0; token != NULL; i++) {
+        // Addresses are in hex, everything else in decimal
+        value = strtoul(token, &end, (i >= 2 && i % 2 == 1) ? 16 : 10);
+        if (*end != 0) {
+            return ERR_BAD_ARGUMENT;
+        }
+
+        if (i < 2) {
+            values[i] = value;
+        } else if (i % 2 == 0) {
+            if (snap->n_items == MAX_ITEMS || value > 0xFFFF ||
+                !valid_gather_type(value)) {
+                return ERR_BAD_ARGUMENT;
+            }
+            snap->types[snap->n_items] = value;
+        } else {
+            item = snap->n_items++;
+            addr = value;
+            snap->sizes[item] = gather_type_size(snap->types[item]);
+            if (!valid_shm_address(addr, snap->sizes[item])) {
+                return ERR_BAD_ADDRESS;
+            }
+            snap->addrs[item] = (const char*)addr;
+        }
+
+        token = strtok_r(NULL, " ", &saveptr);
+    }
+
+    if (i < 4 || i % 2 != 0) {
+        return ERR_BAD_ARGUMENT;
+    }
+
+    snap->interval_us = values[0];
+    snap->count = values[1];
+    snap->sent = 0;
+    return 0;
+}
+
+// Queue the current values of the snapshot addresses:
+//   (packet length) V (snapshot number) (servo count) (values)
+bool queue_snapshot(struct client *c) {
+    struct snapshot_state *snap = &c->snap;
+    unsigned int i, len = 0;
+
+    snap->header[0] = snap->sent++;
+    snap->header[1] = pshm->ServoCount;
+    for (i = 0; i < snap->n_items; i++) {
+        memcpy(snap->values + len, snap->addrs[i], snap->sizes[i]);
+        len += snap->sizes[i];
+    }
+
+    return (queue_packet(c, 'V', sizeof(snap->header) + len) &&
+            queue_copy(c, snap->header, sizeof(snap->header)) &&
+            queue_ref(c, snap->values, len));
+}
+
+// End a series of snapshots with the number sent:
+//   (packet length) Z (snapshot count)
+bool queue_snapshot_end(struct client *c) {
+    c->snapshotting = false;
+    return (queue_packet(c, 'Z', sizeof(unsigned int)) &&
+            queue_copy(c, &c->snap.sent, sizeof(unsigned int)));
+}
+
+// Queue the next of a series of snapshots, scheduling the one after (or
+// ending the series)
+bool queue_next_snapshot(struct client *c) {
+    struct snapshot_state *snap = &c->snap;
+    struct timespec now;
+
+    if (!queue_snapshot(c)) {
+        return false;
+    } else if (snap->count > 0 && snap->sent >= snap->count) {
+        return queue_snapshot_end(c);
+    }
+
+    add_us(&snap->next, snap->interval_us);
+
+    // Having fallen behind (e.g., sending to a slow client), skip ahead
+    // rather than send a burst of snapshots
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    if (elapsed_us(&snap->next, &now) > 0.0) {
+        snap->next = now;
+        add_us(&snap->next, snap->interval_us);
+    }
+    return true;
+}
+
+// Start a snapshot request: a single snapshot, or a series of them
+// (see poll_snapshots)
+bool start_snapshot(struct client *c, char *args) {
+    unsigned int error_code;
+
+    if (args == NULL) {
+        return queue_error(c, ERR_BAD_ARGUMENT);
+    }
+
+    error_code = parse_snapshot(args, &c->snap);
+    if (error_code != 0) {
+        return queue_error(c, error_code);
+    } else if (c->snap.count == 1) {
+        return queue_snapshot(c);
+    }
+
+    clock_gettime(CLOCK_MONOTONIC, &c->snap.next);
+    c->snapshotting = true;
+    return queue_next_snapshot(c);
+}
+
+// Queue the reply to a single command
+bool handle_request(struct client *c, char *cmd) {
+    struct gather_buffer gb;
+    struct subset sub;
+    char *args;
+    int req;
+
+    // Commands may be followed by space-separated arguments
+    args = strchr(cmd, ' ');
+    if (args != NULL) {
+        *args++ = 0;
+    }
+
+    for (req = 0; req < REQ_UNKNOWN; req++) {
+        if (!strcmp(cmd, request_names[req])) {
+            break;
+        }
+    }
+
+    c->request = req;
+    clock_gettime(CLOCK_MONOTONIC, &c->request_start);
+
+    switch (req) {
+    case REQ_SERVO:
+        c->phase = false;
+        return queue_packet(c, 'K', 0);
+    case REQ_PHASE:
+        c->phase = true;
+        return queue_packet(c, 'K', 0);
+    case REQ_TYPES:
+        get_gather_buffer(c->phase, &gb);
+        return queue_types(c, &gb);
+    case REQ_DATA:
+        get_gather_buffer(c->phase, &gb);
+        return queue_data(c, &gb);
+    case REQ_ALL:
+        get_gather_buffer(c->phase, &gb);
+        if (!queue_types(c, &gb)) {
+            return false;
+        }
+        return (gb.items == 0 || queue_data(c, &gb));
+    case REQ_STREAM:
+        return start_stream(c);
+    case REQ_STATS:
+        return queue_stats(c);
+    case REQ_SUBSET:
+        get_gather_buffer(c->phase, &gb);
+        if (args == NULL || !parse_subset(args, &gb, &sub)) {
+            return queue_error(c, ERR_BAD_ARGUMENT);
+        }
+        return queue_subset(c, &gb, &sub);
+    case REQ_META:
+        get_gather_buffer(c->phase, &gb);
+        return queue_metadata(c, &gb);
+    case REQ_FULL:
+        get_gather_buffer(c->phase, &gb);
+        return (queue_metadata(c, &gb) && queue_data(c, &gb));
+    case REQ_ENCODING:
+        if (args == NULL || !set_encoding(c, args)) {
+            return queue_error(c, ERR_BAD_ARGUMENT);
+        }
+        return queue_packet(c, 'K', 0);
+    case REQ_WAIT:
+        return start_wait(c, args);
+    case REQ_CANCEL:
+        // Not waiting (or the wait already ended), nor sending snapshots
+        return queue_packet(c, 'K', 0);
+    case REQ_SNAPSHOT:
+        return start_snapshot(c, args);
+    default:
+        return queue_error(c, ERR_UNKNOWN_COMMAND);
+    }
+}
+
+// Record the service time of the request once its reply has been sent
+void request_done(struct client *c) {
+    struct timespec now;
+    struct request_stats *rs;
+    double us;
+
+    if (c->request < 0) {
+        return;
+    }
+
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    us = elapsed_us(&c->request_start, &now);
+
+    rs = &stats.requests[c->request];
+    rs->count++;
+    rs->total_us += us;
+    if (us > rs->max_us) {
+        rs->max_us = us;
+    }
+
+    c->request = -1;
+}
+
+// Write as much pending output as the socket will take
+// Returns false if the client disconnected
+bool flush_client(struct client *c) {
+    struct iovec *iov;
+    ssize_t sent;
+
+    while (output_pending(c)) {
+        sent = writev(c->fd, &c->iov[c->iov_index], c->iov_count - c->iov_index);
+        if (sent == -1) {
+            if (errno == EINTR) {
+                continue;
+            }
+            return (errno == EAGAIN || errno == EWOULDBLOCK);
+        }
+
+        stats.bytes_sent += sent;
+
+        // Skip past what was written
+        while (sent > 0) {
+            iov = &c->iov[c->iov_index];
+            if ((size_t)sent >= iov->iov_len) {
+                sent -= iov->iov_len;
+                c->iov_index++;
+            } else {
+                iov->iov_base = (char*)iov->iov_base + sent;
+                iov->iov_len -= sent;
+                sent = 0;
+            }
+        }
+    }
+
+    c->iov_index = c->iov_count = 0;
+    c->out_len = 0;
+    free(c->scratch);
+    c->scratch = NULL;
+    if (!c->waiting) {
+        request_done(c);
+    }
+    return true;
+}
+
+// Wait for input from the client only when no output is pending, so that
+// one request is handled at a time
+bool update_events(struct client *c) {
+    struct epoll_event ev;
+    unsigned int events = (output_pending(c) ? EPOLLOUT : EPOLLIN);
+
+    if (events == c->events) {
+        return true;
+    }
+
+    ev.events = events;
+    ev.data.ptr = c;
+    if (epoll_ctl(epoll_fd, EPOLL_CTL_MOD, c->fd, &ev) == -1) {
+        perror("epoll_ctl");
+        return false;
+    }
+
+    c->events = events;
+    return true;
 }
 
 // Strip off CR/LF from the client buffer
@@ -202,48 +1361,186 @@ void strip_buffer(char buf[], int buf_size) {
     buf[buf_size - 1] = 0;
 }
 
-int handle_client(int client) {
-    int received;
-    char buf[BUF_SIZE];
-    bool phase=false;
-
-    while (1) {
-        if ((received = recv(client, &buf, BUF_SIZE - 1, 0)) <= 0) {
-            perror("recv");
+// Handle the complete lines of input received, one at a time, for as long
+// as their replies can be written out immediately
+// Returns false if the client disconnected
+bool process_input(struct client *c) {
+    char line[BUF_SIZE];
+    char *eol;
+    unsigned int len;
+    bool too_long;
+
+    while (!output_pending(c) && c->in_len > 0) {
+        eol = (char*)memchr(c->in_buf, '\n', c->in_len);
+        too_long = false;
+        if (c->discarding) {
+            // Drop the rest of a line which was too long, up to its end
+            len = (eol != NULL ? eol - c->in_buf + 1 : c->in_len);
+            c->discarding = (eol == NULL);
+            c->in_len -= len;
+            memmove(c->in_buf, c->in_buf + len, c->in_len);
+            continue;
+        } else if (eol != NULL) {
+            len = eol - c->in_buf + 1;
+            memcpy(line, c->in_buf, len);
+            line[len] = 0;
+            strip_buffer(line, BUF_SIZE);
+        } else if (c->in_len == BUF_SIZE - 1) {
+            // Too long to be taken as a request, so it is refused (below)
+            // and the rest of it discarded as it arrives
+            len = c->in_len;
+            line[0] = 0;
+            too_long = true;
+            c->discarding = true;
+        } else {
             break;
         }
-        
-        strip_buffer(buf, BUF_SIZE);
-        if (!strcmp(buf, "phase")) {
-            phase = true;
-            send_str_packet(client, "K");
-            printf("client %d phase mode\n", client);
-        } else if (!strcmp(buf, "servo")) {
-            phase = false;
-            send_str_packet(client, "K");
-            printf("client %d servo mode\n", client);
-        } else if (!strcmp(buf, "types")) {
-            send_types(client, phase); 
-        } else if (!strcmp(buf, "data")) {
-            send_data(client, phase); 
-        } else if (!strcmp(buf, "all")) {
-            if (send_types(client, phase)) {
-                send_data(client, phase); 
+
+        c->in_len -= len;
+        memmove(c->in_buf, c->in_buf + len, c->in_len);
+
+        if (c->streaming) {
+            // Any input stops the stream; a cancel request is acknowledged
+            // either way, so that the client knows when the stream is over
+            if (!queue_stream_end(c) ||
+                (!strcmp(line, request_names[REQ_CANCEL]) &&
+                 !queue_packet(c, 'K', 0))) {
+                return false;
+            }
+        } else if (c->waiting) {
+            // or ends the wait
+            if (!queue_wait_end(c, WAIT_CANCELLED)) {
+                return false;
+            }
+        } else if (c->snapshotting) {
+            // or the snapshots
+            if (!queue_snapshot_end(c)) {
+                return false;
+            }
+        } else if (too_long) {
+            if (!queue_error(c, ERR_LINE_TOO_LONG)) {
+                return false;
             }
+        } else if (line[0] == 0) {
+            continue;
+        } else if (!handle_request(c, line)) {
+            fprintf(stderr, "client %d: reply to %s too large\n", c->fd, line);
+            return false;
         }
 
-        buf[0] = 0;
+        if (!flush_client(c)) {
+            return false;
+        }
     }
-    
-    printf("client %d closed\n", client);
-    return 0;
 
+    return true;
 }
 
-/// Handler for the child processes
-void sigchld_handler(int s)
-{
-    while(waitpid(-1, NULL, WNOHANG) > 0);
+// Receive what is available from the client
+// Returns false if the client disconnected
+bool read_client(struct client *c) {
+    ssize_t received;
+
+    received = recv(c->fd, c->in_buf + c->in_len, BUF_SIZE - 1 - c->in_len, 0);
+    if (received == 0) {
+        return false;
+    } else if (received == -1) {
+        return (errno == EAGAIN || errno == EWOULDBLOCK || errno == EINTR);
+    }
+
+    c->in_len += received;
+    return true;
+}
+
+void close_client(struct client *c) {
+    struct client **p;
+
+    epoll_ctl(epoll_fd, EPOLL_CTL_DEL, c->fd, NULL);
+    close(c->fd);
+
+    for (p = &clients; *p != NULL; p = &(*p)->next) {
+        if (*p == c) {
+            *p = c->next;
+            break;
+        }
+    }
+
+    printf("client %d closed\n", c->fd);
+    stats.clients--;
+    free(c->scratch);
+    free(c);
+}
+
+// Send newly gathered lines to streaming clients which are not still busy
+// sending the previous ones
+void poll_streams() {
+    struct client *c, *next;
+    bool enabled;
+
+    for (c = clients; c != NULL; c = next) {
+        next = c->next;
+        if (!c->streaming || output_pending(c)) {
+            continue;
+        }
+
+        // Check before reading the index, so that the final lines are
+        // sent before stopping
+        enabled = gather_enabled(&pshm->Gather, c->phase);
+
+        if (!queue_new_lines(c) ||
+            (!enabled && !queue_stream_end(c)) ||
+            !flush_client(c) || !update_events(c)) {
+            close_client(c);
+        }
+    }
+}
+
+// Reply to waiting clients whose waits have ended
+void poll_waits() {
+    struct client *c, *next;
+
+    for (c = clients; c != NULL; c = next) {
+        next = c->next;
+        if (!c->waiting || output_pending(c)) {
+            continue;
+        }
+
+        if (!check_wait(c) || !flush_client(c) || !update_events(c)) {
+            close_client(c);
+        }
+    }
+}
+
+// Send the snapshots which are due to clients which are not still busy
+// sending the previous ones
+void poll_snapshots() {
+    struct client *c, *next;
+    struct timespec now;
+
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    for (c = clients; c != NULL; c = next) {
+        next = c->next;
+        if (!c->snapshotting || output_pending(c) ||
+            elapsed_us(&c->snap.next, &now) < 0.0) {
+            continue;
+        }
+
+        if (!queue_next_snapshot(c) || !flush_client(c) || !update_events(c)) {
+            close_client(c);
+        }
+    }
+}
+
+// Whether any client is streaming, waiting or sending snapshots, and so
+// requires polling
+bool any_polling() {
+    struct client *c;
+    for (c = clients; c != NULL; c = c->next) {
+        if (c->streaming || c->waiting || c->snapshotting) {
+            return true;
+        }
+    }
+    return false;
 }
 
 /// Get IPv4/IPv6 address info
@@ -258,16 +1555,82 @@ void *get_in_addr(struct sockaddr *sa)
     }
 }
 
+int set_nonblocking(int fd) {
+    int flags = fcntl(fd, F_GETFL, 0);
+    if (flags == -1) {
+        return -1;
+    }
+    return fcntl(fd, F_SETFL, flags | O_NONBLOCK);
+}
+
+// Accept all pending connections
+void accept_clients(int sockfd) {
+    struct sockaddr_storage their_addr; // connector's address information
+    socklen_t sin_size;
+    struct epoll_event ev;
+    struct client *c;
+    char s[INET6_ADDRSTRLEN];
+    int new_fd, yes=1;
+
+    while (1) {
+        sin_size = sizeof their_addr;
+        new_fd = accept(sockfd, (struct sockaddr *)&their_addr, &sin_size);
+        if (new_fd == -1) {
+            if (errno != EAGAIN && errno != EWOULDBLOCK && errno != EINTR) {
+                perror("accept");
+            }
+            return;
+        }
+
+        inet_ntop(their_addr.ss_family,
+            get_in_addr((struct sockaddr *)&their_addr),
+            s, sizeof s);
+
+        if (set_nonblocking(new_fd) == -1 ||
+            setsockopt(new_fd, IPPROTO_TCP, TCP_NODELAY, &yes,
+                       sizeof(int)) == -1) {
+            perror("client socket options");
+            close(new_fd);
+            continue;
+        }
+
+        c = (struct client*)calloc(1, sizeof(struct client));
+        if (c == NULL) {
+            perror("calloc");
+            close(new_fd);
+            continue;
+        }
+
+        c->fd = new_fd;
+        c->request = -1;
+        c->events = EPOLLIN;
+
+        ev.events = EPOLLIN;
+        ev.data.ptr = c;
+        if (epoll_ctl(epoll_fd, EPOLL_CTL_ADD, new_fd, &ev) == -1) {
+            perror("epoll_ctl");
+            close(new_fd);
+            free(c);
+            continue;
+        }
+
+        c->next = clients;
+        clients = c;
+        stats.clients++;
+        stats.accepted++;
+        printf("server: client %d connected from %s\n", new_fd, s);
+    }
+}
+
 // Main server loop, listens on port
 int server_loop(const char *port) {
-    int sockfd, new_fd;  // listen on sock_fd, new connection on new_fd
+    int sockfd;  // listen on sock_fd
     struct addrinfo hints, *servinfo, *p;
-    struct sockaddr_storage their_addr; // connector's address information
-    socklen_t sin_size;
-    struct sigaction sa;
+    struct epoll_event ev, events[MAX_EVENTS];
+    struct client *c;
     int yes=1;
-    char s[INET6_ADDRSTRLEN];
-    int rv;
+    int rv, i, n_events;
+    bool ok;
 
     // Initialize the Power PMAC gplib library
     InitLibrary();
@@ -312,44 +1675,68 @@ int server_loop(const char *port) {
 
     freeaddrinfo(servinfo);
 
-    if (listen(sockfd, BACKLOG) == -1) {
+    if (set_nonblocking(sockfd) == -1 || listen(sockfd, BACKLOG) == -1) {
         perror("listen");
         exit(1);
     }
 
-    // reap all dead processes -- set their handler to this function
-    sa.sa_handler = sigchld_handler;
-    sigemptyset(&sa.sa_mask);
-    sa.sa_flags = SA_RESTART;
-    if (sigaction(SIGCHLD, &sa, NULL) == -1) {
-        perror("sigaction");
+    // A client disconnecting mid-reply should not take down the server
+    signal(SIGPIPE, SIG_IGN);
+
+    if ((epoll_fd = epoll_create(MAX_EVENTS)) == -1) {
+        perror("epoll_create");
         exit(1);
     }
 
+    ev.events = EPOLLIN;
+    ev.data.ptr = NULL;  // the listener
+    if (epoll_ctl(epoll_fd, EPOLL_CTL_ADD, sockfd, &ev) == -1) {
+        perror("epoll_ctl");
+        exit(1);
+    }
+
+    clock_gettime(CLOCK_MONOTONIC, &stats.started);
     printf("server: listening on port %s\n", port);
 
-    while(1) {  // main accept() loop
-        sin_size = sizeof their_addr;
-        new_fd = accept(sockfd, (struct sockaddr *)&their_addr, &sin_size);
-        if (new_fd == -1) {
-            perror("accept");
-            continue;
+    while(1) {  // main event loop
+        n_events = epoll_wait(epoll_fd, events, MAX_EVENTS,
+                              any_polling() ? STREAM_POLL_MS : -1);
+        if (n_events == -1) {
+            if (errno == EINTR) {
+                continue;
+            }
+            perror("epoll_wait");
+            break;
         }
 
-        inet_ntop(their_addr.ss_family,
-            get_in_addr((struct sockaddr *)&their_addr),
-            s, sizeof s);
-        printf("server: got connection from %s\n", s);
+        for (i = 0; i < n_events; i++) {
+            c = (struct client*)events[i].data.ptr;
+            if (c == NULL) {
+                accept_clients(sockfd);
+                continue;
+            }
 
-        if (fork() == 0) {
-            close(sockfd); // child doesn't need the listener
-            handle_client(new_fd);
-            close(new_fd);
-            exit(0);
+            if (events[i].events & (EPOLLERR | EPOLLHUP)) {
+                ok = false;
+            } else if (events[i].events & EPOLLOUT) {
+                ok = flush_client(c) && process_input(c);
+            } else {
+                ok = read_client(c) && process_input(c);
+            }
+
+            if (!(ok && update_events(c))) {
+                close_client(c);
+            }
         }
-        close(new_fd);
+
+        poll_streams();
+        poll_waits();
+        poll_snapshots();
     }
-    
+
+    close(epoll_fd);
+    close(sockfd);
+
     // Close the Power PMAC gplib library
     CloseLibrary();
     return 0;
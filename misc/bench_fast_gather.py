@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+:mod:`bench_fast_gather` -- fast_gather client benchmark
+========================================================
+
+.. module:: bench_fast_gather
+   :synopsis: Time the GatherClient requests (all data with each encoding,
+              decimated subsets, snapshots of the gathered addresses, and
+              streaming) against the simulated fast_gather server, or
+              against a real one with --host.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import time
+import argparse
+
+MODULE_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(MODULE_PATH, '..', 'src'))
+from ppmac import (config, fast_gather, fast_gather_sim)
+
+
+ENCODINGS = [('raw', False, 0),
+             ('delta', True, 0),
+             ('zlib 1', False, 1),
+             ('delta+zlib 1', True, 1),
+             ]
+
+
+def best_time(fcn, repeat):
+    times = []
+    for i in range(repeat):
+        t0 = time.time()
+        ret = fcn()
+        times.append(time.time() - t0)
+    return ret, min(times)
+
+
+def bench_requests(client, repeat=3):
+    types = client.query_types()
+    print('  %-24s %10s %10s' % ('request', 'time [ms]', 'samples'))
+
+    for name, delta, level in ENCODINGS:
+        client.set_encoding(delta=delta, zlib_level=level)
+        columns, elapsed = best_time(client.get_columns, repeat)
+        samples = len(columns[0]) if columns else 0
+        print('  %-24s %10.2f %10d' % ('all (%s)' % name, elapsed * 1e3,
+                                       samples))
+
+    client.set_encoding()
+    for step in (10, 100):
+        columns, elapsed = best_time(lambda: client.get_subset(step=step),
+                                     repeat)
+        print('  %-24s %10.2f %10d' % ('subset (step %d)' % step,
+                                       elapsed * 1e3, len(columns[0])))
+
+        (mins, maxs), elapsed = best_time(
+            lambda: client.get_subset(step=step, minmax=True), repeat)
+        print('  %-24s %10.2f %10d' % ('minmax (step %d)' % step,
+                                       elapsed * 1e3, len(mins[0])))
+
+    # The current values of the gathered addresses
+    metadata = client.query_metadata()
+    try:
+        record, elapsed = best_time(
+            lambda: client.snapshot(metadata.addresses, metadata.types),
+            repeat)
+    except fast_gather.GatherError as ex:
+        # (e.g., gathered I/O addresses, which are not in shared memory)
+        print('  %-24s %s' % ('snapshot', ex))
+    else:
+        print('  %-24s %10.2f %10d' % ('snapshot', elapsed * 1e3, 1))
+
+    return types
+
+
+def bench_stream(client, gather, rate, samples):
+    """
+    Stream a gather of `samples` lines acquired at `rate` lines per second
+    """
+    gather.start(rate=rate, max_samples=samples)
+    t0 = time.time()
+    received = chunks = 0
+    for first, columns in client.iter_chunks():
+        received += len(columns[0])
+        chunks += 1
+
+    elapsed = time.time() - t0
+    print('  stream: %d lines in %d chunks over %.2f s (gathered over %.2f s)'
+          % (received, chunks, elapsed, float(samples) / rate))
+    return received == samples
+
+
+def main(host=None, port=config.fast_gather_port, samples=1000000,
+         stream_rate=50000., repeat=3):
+    server = None
+    if host is None:
+        gather = fast_gather_sim.SimulatedGather(max_lines=samples)
+        gather.acquire(samples)
+        server = fast_gather_sim.SimulatedServer(('127.0.0.1', 0),
+                                                 servo=gather)
+        server.start()
+        host, port = '127.0.0.1', server.port
+        print('Simulated server: %r' % gather)
+
+    try:
+        client = fast_gather.GatherClient(host_port=(host, port))
+        bench_requests(client, repeat=repeat)
+
+        if server is not None:
+            stream_samples = int(stream_rate)
+            if not bench_stream(client, gather, stream_rate, stream_samples):
+                print('* stream incomplete')
+                sys.exit(1)
+    finally:
+        if server is not None:
+            server.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='fast_gather client benchmark')
+    parser.add_argument('--host',
+                        help='fast_gather server (default: simulated)')
+    parser.add_argument('-p', '--port', type=int,
+                        default=config.fast_gather_port,
+                        help='fast_gather server port (with --host)')
+    parser.add_argument('-n', '--samples', type=int, default=1000000,
+                        help='Samples in the simulated gather')
+    parser.add_argument('-s', '--stream-rate', type=float, default=50000.,
+                        help='Lines per second gathered while streaming')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Repetitions per request (best time is shown)')
+
+    args = parser.parse_args()
+    main(host=args.host, port=args.port, samples=args.samples,
+         stream_rate=args.stream_rate, repeat=args.repeat)
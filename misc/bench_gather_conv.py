@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+:mod:`bench_gather_conv` -- gather type conversion check and benchmark
+======================================================================
+
+.. module:: bench_gather_conv
+   :synopsis: Check that the numpy conversions in gather_types (24-bit
+              integers and the undocumented bitfield types), as looked up by
+              GatherClient, give exactly the same results as the scalar
+              conversions they replace, then compare their speed (no Power
+              PMAC required).
+"""
+
+from __future__ import print_function
+import os
+import sys
+import time
+import struct
+import argparse
+
+import numpy as np
+
+MODULE_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(MODULE_PATH, '..', 'src'))
+from ppmac import gather_types
+from ppmac.fast_gather import GatherClient
+
+
+# Words which exercise the sign bit and the unused high byte
+EDGE_WORDS = [0x00000000, 0x00000001, 0x007FFFFF, 0x00800000, 0x00FFFFFF,
+              0x01000000, 0x7FFFFFFF, 0x80000000, 0xFF7FFFFF, 0xFF800000,
+              0xFFFFFFFF, 0x12345678, 0x89ABCDEF]
+
+
+def legacy_conv_bits(start, count):
+    """
+    The scalar bitfield conversion previously used by GatherClient._get_type
+    """
+    mask = ((1 << count) - 1)
+
+    def wrapped(values):
+        return [((value >> start) & mask)
+                for value in values]
+
+    return wrapped
+
+
+def as_word_bytes(words):
+    """
+    32-bit words as the big-endian byte strings the scalar 24-bit
+    conversions take
+    """
+    return [struct.pack('>I', word) for word in words]
+
+
+def random_words(count, seed=0):
+    rs = np.random.RandomState(seed)
+    words = rs.randint(0, 1 << 32, size=count, dtype=np.uint64)
+    return np.concatenate([np.array(EDGE_WORDS, dtype=np.uint64),
+                           words]).astype(np.uint32)
+
+
+def bitfield_types():
+    """
+    Yields (type, start, count) for all bitfield types GatherClient decodes
+    """
+    for start in range(32):
+        for count_bits in range(32):
+            type_ = (start << 11) | (count_bits << 6)
+            if type_ <= gather_types.SBITS:
+                # (type 0 is UINT32)
+                continue
+
+            yield type_, start, 32 - count_bits
+
+
+def check(words):
+    """
+    Compare the numpy conversions against the scalar ones, bit for bit
+    """
+    word_list = [int(word) for word in words]
+    word_bytes = as_word_bytes(word_list)
+    big_endian = words.astype('>u4')
+    failures = 0
+
+    client = GatherClient.__new__(GatherClient)
+    client.sock = None
+
+    for name, type_, scalar, vector in [
+            ('int24', gather_types.INT24, gather_types.conv_int24,
+             gather_types.conv_int24_array),
+            ('uint24', gather_types.UINT24, gather_types.conv_uint24,
+             gather_types.conv_uint24_array)]:
+        expected = list(scalar(word_bytes))
+        for values in (words, big_endian):
+            result = vector(values)
+            if result.tolist() != expected:
+                print('* %s mismatch (%s)' % (name, values.dtype))
+                failures += 1
+
+        # The conversion used when decoding gathered data
+        size, format_, conv = client._get_type(type_)
+        if conv is not vector:
+            print('* %s is not converted with %s' % (name, vector.__name__))
+            failures += 1
+
+    for type_, start, count in bitfield_types():
+        expected = legacy_conv_bits(start, count)(word_list)
+        size, format_, conv = client._get_type(type_)
+        if conv(big_endian).tolist() != expected:
+            print('* bitfield type %x (start %d count %d) mismatch' %
+                  (type_, start, count))
+            failures += 1
+
+    return failures
+
+
+def bench(words, repeat=3):
+    """
+    Time the scalar and numpy conversions
+    """
+    word_list = [int(word) for word in words]
+    word_bytes = as_word_bytes(word_list)
+    big_endian = words.astype('>u4')
+    amp_ena = 0x67c6
+    start = (amp_ena & GatherClient.START_MASK) >> 11
+    count = 32 - ((amp_ena & GatherClient.BIT_MASK) >> 6)
+
+    tests = [('int24', lambda: gather_types.conv_int24(word_bytes),
+              lambda: gather_types.conv_int24_array(big_endian)),
+             ('uint24', lambda: gather_types.conv_uint24(word_bytes),
+              lambda: gather_types.conv_uint24_array(big_endian)),
+             ('bits %x' % amp_ena,
+              lambda: legacy_conv_bits(start, count)(word_list),
+              lambda: gather_types.make_conv_bits(start, count)(big_endian)),
+             ]
+
+    def best_time(fcn):
+        times = []
+        for i in range(repeat):
+            t0 = time.time()
+            fcn()
+            times.append(time.time() - t0)
+        return min(times)
+
+    print('Conversion of %d values:' % len(words))
+    for name, scalar, vector in tests:
+        t_scalar = best_time(scalar)
+        t_vector = best_time(vector)
+        print('  %-10s scalar %8.2f ms  numpy %8.2f ms  (x%.0f)' %
+              (name, t_scalar * 1e3, t_vector * 1e3, t_scalar / t_vector))
+
+
+def main(check_count=10000, bench_count=1000000):
+    failures = check(random_words(check_count))
+    if failures:
+        print('%d conversion(s) differ' % failures)
+        sys.exit(1)
+
+    print('All conversions match')
+    bench(random_words(bench_count, seed=1))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='gather conversion check')
+    parser.add_argument('-c', '--check', type=int, default=10000,
+                        help='Number of random words to check')
+    parser.add_argument('-n', '--count', type=int, default=1000000,
+                        help='Number of values to benchmark')
+
+    args = parser.parse_args()
+    main(check_count=args.check, bench_count=args.count)
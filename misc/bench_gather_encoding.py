@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+:mod:`bench_gather_encoding` -- fast_gather data encoding benchmark
+===================================================================
+
+.. module:: bench_gather_encoding
+   :synopsis: Measure how much the delta and zlib encodings of gather_server
+              reduce the data sent for recorded (or synthetic) servo
+              gathers, and the effective throughput over a given link once
+              decoding is accounted for.
+
+Record a gather buffer from a running fast_gather server with:
+    python bench_gather_encoding.py --record ppmac_host -o servo.npz
+and benchmark it (along with any other recordings) with:
+    python bench_gather_encoding.py servo.npz
+"""
+
+from __future__ import print_function
+import os
+import sys
+import time
+import zlib
+import argparse
+
+import numpy as np
+
+MODULE_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(MODULE_PATH, '..', 'src'))
+from ppmac import (config, fast_gather, gather_types)
+
+
+ENCODINGS = [('raw', 0, 0),
+             ('delta', 1, 0),
+             ('zlib 1', 0, 1),
+             ('zlib 6', 0, 6),
+             ('delta+zlib 1', 1, 1),
+             ('delta+zlib 6', 1, 6),
+             ]
+
+
+def record(host, port, fn):
+    """
+    Save the types and raw data of the current gather buffer of a
+    fast_gather server
+    """
+    client = fast_gather.GatherClient(host_port=(host, port))
+    types, samples, raw_data = client.query_types_and_raw_data()
+    np.savez(fn, types=np.array(types, dtype=np.uint16), samples=samples,
+             raw=np.frombuffer(raw_data, dtype=np.uint8))
+    print('Saved %d samples of %d items to %s' % (samples, len(types), fn))
+
+
+def load(fn):
+    data = np.load(fn)
+    return (tuple(int(type_) for type_ in data['types']), int(data['samples']),
+            data['raw'].tobytes())
+
+
+def synthetic_gather(samples, gather_period=1, seed=0):
+    """
+    A typical servo gather: Sys.ServoCount, the actual and desired positions
+    of 3 motors during a move, 2 following errors in counts, and a status
+    bit (Motor[].AmpEna)
+    """
+    rs = np.random.RandomState(seed)
+    amp_ena = 0x67c6
+    types = ((gather_types.UINT32, ) + (gather_types.DOUBLE, ) * 6 +
+             (gather_types.INT32, ) * 2 + (amp_ena, ))
+
+    client = fast_gather.GatherClient.__new__(fast_gather.GatherClient)
+    client.sock = None
+    lines = np.zeros(samples, dtype=client._get_dtype(types))
+
+    t = np.arange(samples) * gather_period
+    lines['f0'] = 123456 + t
+    for motor in range(3):
+        desired = 1000. * (1 - np.cos(2 * np.pi * t / (samples * (motor + 1))))
+        # Positions are in encoder counts (1/512 of a unit here)
+        actual = np.round((desired + rs.normal(0, 0.01, samples)) * 512) / 512
+        lines['f%d' % (1 + motor)] = actual
+        lines['f%d' % (4 + motor)] = desired
+
+    for i in (7, 8):
+        lines['f%d' % i] = np.round(rs.normal(0, 3, samples))
+
+    lines['f9'] = 1 << 12
+    return types, samples, lines.tobytes()
+
+
+def encode_data(samples, raw_data, delta, zlib_level):
+    """
+    Encode raw data as gather_server does
+    """
+    data = raw_data
+    if delta:
+        words = np.frombuffer(data, dtype='>u4').reshape(samples, -1)
+        diff = words.astype(np.uint32)
+        diff[1:] -= diff[:-1].copy()
+        data = diff.astype('>u4').tobytes()
+
+    if zlib_level:
+        data = zlib.compress(data, zlib_level)
+
+    return data
+
+
+def best_time(fcn, repeat):
+    times = []
+    for i in range(repeat):
+        t0 = time.time()
+        ret = fcn()
+        times.append(time.time() - t0)
+    return ret, min(times)
+
+
+def bench(name, types, samples, raw_data, link_mbit=100., repeat=3):
+    raw_length = len(raw_data)
+    link_rate = link_mbit * 1e6 / 8
+    print('%s: %d samples of %d items (%.2f MB)' %
+          (name, samples, len(types), raw_length / 1e6))
+    print('  %-14s %10s %7s %10s %10s %12s' %
+          ('encoding', 'bytes', 'ratio', 'enc [ms]', 'dec [ms]',
+           'eff. [MB/s]'))
+
+    for enc_name, delta, level in ENCODINGS:
+        flags = ((fast_gather.ENCODE_DELTA if delta else 0) |
+                 (fast_gather.ENCODE_ZLIB if level else 0))
+        encoded, t_encode = best_time(
+            lambda: encode_data(samples, raw_data, delta, level), repeat)
+        decoded, t_decode = best_time(
+            lambda: fast_gather.decode_data(samples, flags, raw_length,
+                                            encoded), repeat)
+
+        if decoded.tobytes() != raw_data:
+            print('* %s: decoded data differs' % enc_name)
+            return False
+
+        if not flags:
+            t_decode = 0.0
+
+        # Time on the wire plus decoding; encoding happens on the Power PMAC
+        # (whose CPU is slower than this one, so the time here is only a
+        # rough guide)
+        transfer = len(encoded) / link_rate + t_decode
+        print('  %-14s %10d %6.1fx %10.2f %10.2f %12.2f' %
+              (enc_name, len(encoded), float(raw_length) / len(encoded),
+               t_encode * 1e3, t_decode * 1e3, raw_length / transfer / 1e6))
+
+    return True
+
+
+def main(files, samples=100000, link_mbit=100.):
+    if files:
+        datasets = [(fn, ) + load(fn) for fn in files]
+    else:
+        datasets = [('synthetic', ) + synthetic_gather(samples)]
+
+    ok = True
+    for dataset in datasets:
+        ok = bench(*dataset, link_mbit=link_mbit) and ok
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='gather encoding benchmark')
+    parser.add_argument('files', nargs='*',
+                        help='Recorded gather buffers (default: synthetic)')
+    parser.add_argument('-n', '--samples', type=int, default=100000,
+                        help='Number of samples in the synthetic gather')
+    parser.add_argument('-l', '--link', type=float, default=100.,
+                        help='Link speed [Mbit/s]')
+    parser.add_argument('--record', metavar='HOST',
+                        help='Record the gather buffer of a fast_gather server')
+    parser.add_argument('-p', '--port', type=int,
+                        default=config.fast_gather_port,
+                        help='fast_gather server port (with --record)')
+    parser.add_argument('-o', '--output', default='gather_buffer.npz',
+                        help='Recording filename (with --record)')
+
+    args = parser.parse_args()
+    if args.record:
+        record(args.record, int(args.port), args.output)
+    else:
+        main(args.files, samples=args.samples, link_mbit=args.link)
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+:mod:`bench_read_timeout` -- ShellChannel.read_timeout micro-benchmark
+======================================================================
+
+.. module:: bench_read_timeout
+   :synopsis: Compare the select-based line reader of ShellChannel against
+              the previous polling reader, using a local stand-in for the
+              paramiko channel (no Power PMAC required).
+"""
+
+from __future__ import print_function
+import os
+import sys
+import time
+import socket
+import select
+import argparse
+import collections
+import threading
+
+MODULE_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(MODULE_PATH, '..', 'src'))
+from ppmac import pp_comm
+
+
+class LocalChannel(object):
+    """
+    Stand-in for a paramiko channel, backed by a local socket pair.
+
+    Every line sent is answered by `reply(line)` from a responder thread.
+    """
+    def __init__(self, reply):
+        self._local, self._remote = socket.socketpair()
+        self._reply = reply
+        self.closed = False
+        self._thread = threading.Thread(target=self._respond)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _respond(self):
+        buf = b''
+        while True:
+            data = self._remote.recv(65536)
+            if not data:
+                break
+
+            buf += data
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                self._remote.sendall(self._reply(line.decode('ascii')))
+
+    def fileno(self):
+        return self._local.fileno()
+
+    def recv_ready(self):
+        readable, _, _ = select.select([self._local], [], [], 0)
+        return bool(readable)
+
+    def recv(self, nbytes):
+        return self._local.recv(nbytes)
+
+    def recv_stderr_ready(self):
+        return False
+
+    def send(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('ascii')
+        return self._local.send(data)
+
+    def close(self):
+        self._local.close()
+        self._remote.close()
+
+
+def legacy_read_timeout(channel, timeout=5.0, delim='\r\n'):
+    """
+    The polling reader previously used by ShellChannel.read_timeout
+    """
+    t0 = time.time()
+    buf = ''
+
+    def check_timeout():
+        if timeout is None:
+            return True
+        return ((time.time() - t0) <= timeout)
+
+    while channel.recv_ready() or check_timeout():
+        if channel.recv_ready():
+            buf += channel.recv(1024).decode('ascii')
+
+            lines = buf.split(delim)
+            if not buf.endswith(delim):
+                buf = lines[-1]
+                lines = lines[:-1]
+            else:
+                buf = ''
+
+            for line in lines:
+                pp_comm.vlog(False, '<- %s' % line)
+                yield line.rstrip()
+
+        else:
+            time.sleep(0.01)
+
+        if channel.recv_stderr_ready():
+            channel.recv_stderr(1024)
+
+    if not check_timeout():
+        raise pp_comm.TimeoutError('Elapsed %.2f s' % (time.time() - t0))
+
+
+def make_shell_channel(channel):
+    """
+    Create a ShellChannel wrapping `channel`, skipping the SSH setup
+    """
+    shell = pp_comm.ShellChannel.__new__(pp_comm.ShellChannel)
+    shell.lock = threading.RLock()
+    shell._read_buffer = bytearray()
+    shell._read_lines = collections.deque()
+    shell._reader = None
+    shell._channel = channel
+    shell._verbose = False
+    return shell
+
+
+def variable_reply(line):
+    return ('%s=1.2345\r\n' % line).encode('ascii')
+
+
+def make_dump_reply(lines):
+    dump = b''.join(b'    X(P%d) Y(P%d) F(1000) ; line %d\r\n' % (i, i, i)
+                    for i in range(lines))
+    dump += b'END\r\n'
+
+    def reply(line):
+        return dump
+
+    return reply
+
+
+def bench_latency(reader, queries):
+    """
+    Time request/reply round trips (e.g., get_variable)
+    """
+    channel = LocalChannel(variable_reply)
+    try:
+        t0 = time.time()
+        for i in range(queries):
+            var = 'Motor[%d].ActPos' % (i % 32)
+            channel.send('%s\n' % var)
+            for line in reader(channel):
+                if line.startswith(var):
+                    break
+
+        return (time.time() - t0) / queries
+    finally:
+        channel.close()
+
+
+def bench_dump(reader, lines):
+    """
+    Time reading a large multi-line reply (e.g., list prog)
+    """
+    channel = LocalChannel(make_dump_reply(lines))
+    try:
+        t0 = time.time()
+        channel.send('list prog 1\n')
+        count = 0
+        for line in reader(channel):
+            if line == 'END':
+                break
+            elif line:
+                # (the legacy reader yields empty lines at chunk boundaries)
+                count += 1
+
+        assert(count == lines)
+        return time.time() - t0
+    finally:
+        channel.close()
+
+
+def main(queries=200, dump_lines=50000):
+    def new_reader(channel):
+        return make_shell_channel(channel).read_timeout()
+
+    readers = [('legacy', legacy_read_timeout),
+               ('select', new_reader)]
+
+    print('Round-trip latency (%d queries):' % queries)
+    for name, reader in readers:
+        elapsed = bench_latency(reader, queries)
+        print('  %-8s %8.3f ms/query' % (name, elapsed * 1e3))
+
+    print('Large reply (%d lines):' % dump_lines)
+    for name, reader in readers:
+        elapsed = bench_dump(reader, dump_lines)
+        print('  %-8s %8.3f s' % (name, elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='read_timeout benchmark')
+    parser.add_argument('-q', '--queries', type=int, default=200,
+                        help='Number of request/reply round trips')
+    parser.add_argument('-l', '--lines', type=int, default=50000,
+                        help='Number of lines in the large reply')
+
+    args = parser.parse_args()
+    main(queries=args.queries, dump_lines=args.lines)
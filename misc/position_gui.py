@@ -83,11 +83,13 @@ class PositionMonitor(QtGui.QFrame):
             if gpascii is None:
                 return
 
+        motor_list = ','.join('%d' % motor for motor in motors)
         try:
-            act_pos = [gpascii.get_variable('Motor[%d].ActPos' % i, type_=float)
-                       for i in motors]
-            home_pos = [gpascii.get_variable('Motor[%d].HomePos' % i, type_=float)
-                        for i in motors]
+            act_pos = gpascii.get_array('Motor[%s].ActPos' % motor_list)
+            home_pos = gpascii.get_array('Motor[%s].HomePos' % motor_list)
+            # (a single motor gives a 0-dimensional array)
+            act_pos = act_pos.reshape(len(motors))
+            home_pos = home_pos.reshape(len(motors))
         except pp_comm.TimeoutError:
             self.reconnect()
             QtCore.QTimer.singleShot(5000.0, self.update)
@@ -0,0 +1,292 @@
+"""
+:mod:`ppmac.address_index` -- Reverse address index
+===================================================
+
+.. module:: ppmac.address_index
+   :synopsis: Map numeric Power PMAC addresses (e.g., the Gather.Addr[]
+              values reported by fast_gather) back to symbolic names such as
+              Motor[3].ActPos.a. The index is built once per controller by
+              querying the addresses of the elements listed in the completer
+              database, and saved to disk keyed by firmware version and
+              configuration.
+.. moduleauthor:: Ken Lauer <klauer@bnl.gov>
+"""
+
+from __future__ import print_function
+import os
+import re
+import json
+import hashlib
+import logging
+
+from .pp_comm import GPError
+from .completer import PPCompleterList
+
+
+logger = logging.getLogger(__name__)
+
+# (structure, count) to index by default. Count is either the number of
+# structures, a variable holding it, or None for a single (non-list)
+# structure. Indices that do not exist on the controller are skipped.
+DEFAULT_STRUCTURES = [('Sys', None),
+                      ('Motor', 'Sys.MaxMotors'),
+                      ('Coord', 'Sys.MaxCoords'),
+                      ('Gate1', 20),
+                      ('Gate2', 16),
+                      ('Gate3', 16),
+                      ]
+
+# Indices tried for lists within structures (e.g., Motor[].Status[]);
+# those which do not exist are skipped
+LIST_INDICES = range(4)
+
+# Nesting limit when walking the completer database
+MAX_DEPTH = 4
+
+DEFAULT_PATH = 'address_index'
+
+_VERSION_RE = re.compile(r'\d+(\.\d+)+')
+
+
+def parse_address(value):
+    """
+    Parse an address as reported by gpascii ($-prefixed hex or decimal)
+
+    Returns None if it is not an address
+    """
+    value = str(value).strip()
+    try:
+        if value.startswith('$'):
+            return int(value[1:], 16)
+        else:
+            return int(value, 0)
+    except ValueError:
+        return None
+
+
+def get_firmware_version(gpascii, timeout=2.0):
+    """
+    Firmware version, as reported by the gpascii `vers` command
+    """
+    with gpascii.lock:
+        gpascii.send_line('vers')
+        for line in gpascii.read_timeout(timeout=timeout):
+            if 'error' in line:
+                raise GPError(line)
+
+            m = _VERSION_RE.search(line)
+            if m:
+                return m.group(0)
+
+
+def get_elements(node, prefix='', list_indices=LIST_INDICES, depth=0):
+    """
+    Names of all elements of a completer node, relative to it, including
+    those of its substructures (e.g., 'ActPos', 'Servo.Kp', 'Status[0]')
+    """
+    ret = []
+    for key in sorted(node.info.keys()):
+        child = node._get_node(node.info[key])
+        if isinstance(child, PPCompleterList):
+            children = [(child[i], '%s[%d]' % (key, i)) for i in list_indices]
+        else:
+            children = [(child, key)]
+
+        for child, name in children:
+            name = prefix + name
+            if child.info and depth < MAX_DEPTH:
+                ret.extend(get_elements(child, prefix='%s.' % name,
+                                        list_indices=list_indices,
+                                        depth=depth + 1))
+            else:
+                ret.append(name)
+
+    return ret
+
+
+def _get_count(gpascii, count):
+    try:
+        return int(count)
+    except ValueError:
+        return gpascii.get_variable(count, type_=int)
+
+
+def _query_addresses(gpascii, names):
+    """
+    Addresses of `names` (without .a), None for any that failed
+    """
+    def error(var, ex):
+        return None
+
+    values = gpascii.get_variables(['%s.a' % name for name in names],
+                                   error_cb=error)
+    return [parse_address(value) if value is not None else None
+            for value in values]
+
+
+def get_candidates(gpascii, completer, structures=DEFAULT_STRUCTURES,
+                   list_indices=LIST_INDICES):
+    """
+    Structures (with the indices present on the controller) and their
+    element names, from the completer database
+
+    Returns: list of (structure, indices or None, elements)
+    """
+    ret = []
+    for struct, count in structures:
+        try:
+            node = getattr(completer, struct)
+        except AttributeError:
+            logger.debug('Structure not in completer database: %s', struct)
+            continue
+
+        if isinstance(node, PPCompleterList):
+            node = node[0]
+
+        elements = get_elements(node, list_indices=list_indices)
+        if not elements:
+            continue
+
+        if count is None:
+            ret.append((struct, None, elements))
+            continue
+
+        # Probe the first element of each structure, as those that do not
+        # exist (e.g., uninstalled gates) report errors
+        indices = list(range(_get_count(gpascii, count)))
+        probe = _query_addresses(gpascii, ['%s[%d].%s' % (struct, i, elements[0])
+                                           for i in indices])
+        indices = [i for i, addr in zip(indices, probe) if addr is not None]
+        if indices:
+            ret.append((struct, indices, elements))
+
+    return ret
+
+
+def get_config_hash(candidates):
+    """
+    Hash of the candidate structures, indices and elements
+    """
+    return hashlib.sha1(json.dumps(candidates,
+                                   sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class AddressIndex(object):
+    """
+    Reverse index of Power PMAC addresses: {address: 'Motor[3].ActPos.a'}
+
+    Gather.Addr[] values are the same addresses gpascii reports for
+    `name.a`, so gathered data can be labeled with `label()`.
+    """
+    def __init__(self, names=None, firmware=None, config_hash=None):
+        if names is None:
+            names = {}
+
+        self.names = dict(names)
+        self.firmware = firmware
+        self.config_hash = config_hash
+
+    @classmethod
+    def build(cls, gpascii, completer, candidates=None, firmware=None,
+              structures=DEFAULT_STRUCTURES, verbose=False):
+        """
+        Query the addresses of all candidate elements (see get_candidates)
+        """
+        if candidates is None:
+            candidates = get_candidates(gpascii, completer,
+                                        structures=structures)
+        if firmware is None:
+            firmware = get_firmware_version(gpascii)
+
+        index = cls(firmware=firmware, config_hash=get_config_hash(candidates))
+        for struct, indices, elements in candidates:
+            if indices is None:
+                names = ['%s.%s' % (struct, element) for element in elements]
+            else:
+                names = ['%s[%d].%s' % (struct, i, element)
+                         for i in indices
+                         for element in elements]
+
+            if verbose:
+                print('Querying %d %s addresses' % (len(names), struct))
+
+            for name, addr in zip(names, _query_addresses(gpascii, names)):
+                # Aliases (and elements without addresses of their own) go to
+                # the first name found
+                if addr is not None and addr not in index.names:
+                    index.names[addr] = '%s.a' % name
+
+        return index
+
+    def lookup(self, addr, default=None):
+        """
+        Symbolic name of an address, or `default` if unknown
+        """
+        return self.names.get(addr, default)
+
+    def label(self, addresses):
+        """
+        Names of a list of addresses (e.g., GatherMetadata.addresses), with
+        those not in the index in hex ($3000a0)
+        """
+        return [self.names.get(addr, '$%x' % addr) for addr in addresses]
+
+    def __contains__(self, addr):
+        return addr in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def save(self, fn):
+        names = dict(('%x' % addr, name) for addr, name in self.names.items())
+        with open(fn, 'wt') as f:
+            json.dump({'firmware': self.firmware,
+                       'config_hash': self.config_hash,
+                       'names': names}, f)
+
+    @classmethod
+    def load(cls, fn):
+        with open(fn, 'rt') as f:
+            info = json.load(f)
+
+        names = dict((int(addr, 16), name)
+                     for addr, name in info['names'].items())
+        return cls(names, firmware=info['firmware'],
+                   config_hash=info['config_hash'])
+
+    def __repr__(self):
+        return ('<%s addresses=%d firmware=%s>' %
+                (self.__class__.__name__, len(self.names), self.firmware))
+
+
+def get_index_filename(path, firmware, config_hash):
+    firmware = re.sub(r'[^\w.]', '_', str(firmware))
+    return os.path.join(path, 'index_%s_%s.json' % (firmware, config_hash[:16]))
+
+
+def get_address_index(gpascii, completer, path=DEFAULT_PATH,
+                      structures=DEFAULT_STRUCTURES, rebuild=False,
+                      verbose=False):
+    """
+    Load the address index for the controller's firmware version and
+    configuration from `path`, building (and saving) it if necessary
+    """
+    firmware = get_firmware_version(gpascii)
+    candidates = get_candidates(gpascii, completer, structures=structures)
+    fn = get_index_filename(path, firmware, get_config_hash(candidates))
+
+    if not rebuild and os.path.exists(fn):
+        try:
+            return AddressIndex.load(fn)
+        except (ValueError, KeyError) as ex:
+            logger.warning('Unable to load address index %s (%s)', fn, ex)
+
+    index = AddressIndex.build(gpascii, completer, candidates=candidates,
+                               firmware=firmware, verbose=verbose)
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    index.save(fn)
+    logger.debug('Saved address index (%d addresses) to %s', len(index), fn)
+    return index
@@ -0,0 +1,255 @@
+"""
+:mod:`ppmac.async_comm` -- asyncio gpascii client
+=================================================
+
+.. module:: ppmac.async_comm
+   :synopsis: An asyncio counterpart to GpasciiChannel. Requests are written
+              to gpascii as soon as they are made, and the replies are
+              matched back to the awaiting coroutines as they arrive, so many
+              coroutines may have requests in flight on one channel at once.
+.. moduleauthor:: Ken Lauer <klauer@bnl.gov>
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+
+from . import pp_comm
+from .pp_comm import (GpasciiRequest, ReplyDispatcher, _pack_lines)
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncGpasciiChannel(object):
+    """
+    asyncio wrapper around a dedicated GpasciiChannel
+
+    Once wrapped, the GpasciiChannel should no longer be used directly, as
+    all data received from it is consumed by the event loop.
+
+    Create one with `AsyncGpasciiChannel.open(comm)`, or wrap an existing
+    channel with `AsyncGpasciiChannel(comm.gpascii_channel())` from within a
+    coroutine, as the channel is attached to the running event loop.
+
+    Every request is followed by a query of the channel's FENCE_VARIABLE,
+    marking where its replies end. A request which times out is left in place
+    to take its late replies, which then cannot be mistaken for those of a
+    later request for the same variables.
+    """
+    def __init__(self, channel, loop=None):
+        if loop is None:
+            loop = asyncio.get_running_loop()
+
+        self._gpascii = channel
+        self._loop = loop
+        self._dispatcher = ReplyDispatcher()
+        self._buffer = bytearray()
+        self._closed = False
+        # Lines are written from a single worker thread, so that the event
+        # loop does not block on the channel and requests go out in the order
+        # they were made
+        self._sender = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        # Discard anything left over from the channel startup
+        channel.sync()
+
+        self._fileno = channel._channel.fileno()
+        loop.add_reader(self._fileno, self._on_readable)
+
+    @classmethod
+    async def open(cls, comm, loop=None):
+        """
+        Open a new gpascii channel on `comm` (a PPComm instance) without
+        blocking the event loop
+        """
+        if loop is None:
+            loop = asyncio.get_running_loop()
+
+        channel = await loop.run_in_executor(None, comm.gpascii_channel)
+        return cls(channel, loop=loop)
+
+    def close(self):
+        """
+        Stop reading from and close the gpascii channel
+        """
+        if self._closed:
+            return
+
+        self._closed = True
+        self._loop.remove_reader(self._fileno)
+        self._dispatcher.fail_all(pp_comm.PPCommChannelClosed())
+        self._sender.shutdown(wait=False)
+        self._gpascii.close()
+
+    @property
+    def pending(self):
+        """
+        Number of requests awaiting replies
+        """
+        return len(self._dispatcher.pending)
+
+    def _on_readable(self, delim='\r\n'):
+        channel = self._gpascii._channel
+        if channel is None:
+            self.close()
+            return
+
+        buf = self._buffer
+        while channel.recv_ready():
+            chunk = channel.recv(self._gpascii.RECV_SIZE)
+            if not chunk:
+                self.close()
+                return
+
+            buf.extend(chunk)
+
+        if channel.closed:
+            self.close()
+            return
+
+        idx = buf.rfind(delim.encode('ascii'))
+        if idx < 0:
+            return
+
+        lines = buf[:idx].decode('ascii', 'replace').split(delim)
+        del buf[:idx + len(delim)]
+
+        for line in lines:
+            line = line.rstrip()
+            if not self._dispatcher.feed_line(line) and line:
+                logger.debug('Unsolicited gpascii output: %s', line)
+
+    async def _request(self, line, names=(), timeout=2.0):
+        """
+        Send a request followed by the fence, and wait for it to complete
+
+        Returns the completed GpasciiRequest
+        """
+        if self._closed:
+            raise pp_comm.PPCommChannelClosed()
+
+        fence = self._gpascii.FENCE_VARIABLE
+        if fence.lower() in [name.lower() for name in names]:
+            # The reply to the query itself would be taken as the fence
+            fence = None
+
+        future = self._loop.create_future()
+
+        def completed(request):
+            if not future.done():
+                future.set_result(request)
+
+        request = GpasciiRequest(line, names, fence=fence, callback=completed)
+        self._dispatcher.add(request)
+        await self._loop.run_in_executor(self._sender,
+                                         self._gpascii.send_lines,
+                                         request.lines)
+
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            # The request stays with the dispatcher until its fence is
+            # received, so that its late replies go to it alone
+            raise pp_comm.TimeoutError('No reply to: %s' % (line, ))
+
+    async def send_line(self, line, timeout=2.0):
+        """
+        Send a single line of text, waiting until gpascii has processed it
+
+        Raises GPError if gpascii reports an error for the line
+        """
+        request = await self._request(line, timeout=timeout)
+        if request.error is not None:
+            raise request.error
+
+    async def get_variable(self, var, type_=str, timeout=2.0):
+        """
+        Get a Power PMAC variable, and typecast it to type_
+        """
+        request = await self._request(var, [var], timeout=timeout)
+        return request.get_value(var, type_)
+
+    async def set_variable(self, var, value, check=True, timeout=2.0):
+        """
+        Set a Power PMAC variable to value
+        """
+        line = '%s=%s' % (var.lower(), value)
+        if not check:
+            return await self.send_line(line, timeout=timeout)
+
+        # The assignment and readback go in one request, as in
+        # GpasciiChannel.set_variables, so any error is reported against it
+        request = await self._request('%s %s' % (line, var), [var],
+                                      timeout=timeout)
+        return request.get_value(var)
+
+    async def _get_line_values(self, variables, type_, timeout):
+        """
+        Query the variables packed into one line, falling back to individual
+        queries for those not read back (e.g., after an error)
+        """
+        line = ' '.join(variables)
+        try:
+            request = await self._request(line, variables, timeout=timeout)
+        except pp_comm.TimeoutError as ex:
+            return [ex] * len(variables)
+
+        values = []
+        for var in variables:
+            if var.lower() in request.values:
+                try:
+                    values.append(request.get_value(var, type_))
+                except ValueError as ex:
+                    values.append(ex)
+            else:
+                values.append(None)
+
+        missing = [i for i, value in enumerate(values) if value is None]
+        if missing:
+            results = await asyncio.gather(
+                *[self.get_variable(variables[i], type_=type_,
+                                    timeout=timeout)
+                  for i in missing],
+                return_exceptions=True)
+
+            for i, value in zip(missing, results):
+                values[i] = value
+
+        return values
+
+    async def get_variables(self, variables, type_=str, timeout=2.0,
+                            cb=None, error_cb=None):
+        """
+        Get Power PMAC variables, typecasting them to type_
+
+        All lines of packed queries are sent at once. Errors are reported per
+        variable as in GpasciiChannel.get_variables.
+        """
+        variables = list(variables)
+        lines = list(_pack_lines(variables,
+                                 self._gpascii.MAX_LINE_LENGTH))
+
+        results = await asyncio.gather(
+            *[self._get_line_values(line_vars, type_, timeout)
+              for line_vars in lines])
+
+        ret = []
+        for var, value in zip(variables,
+                              [value for values in results
+                               for value in values]):
+            if isinstance(value, Exception):
+                if error_cb is None:
+                    ret.append('Error: %s' % (value, ))
+                else:
+                    ret.append(error_cb(var, value))
+            else:
+                if cb is not None:
+                    try:
+                        value = cb(var, value)
+                    except:
+                        pass
+
+                ret.append(value)
+
+        return ret
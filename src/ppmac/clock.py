@@ -115,6 +115,15 @@ def set_global_phase(devices, phase_freq, servo_divider, verbose=True,
                                      **kwargs)
 
     gpascii = devices[0].gpascii
+    current = {}
+    if verbose:
+        # Read all of the current values up front, in as few round trips as
+        # possible
+        variables = [line.split('=')[0] for line in script if '=' in line]
+        current = dict(zip(variables,
+                           gpascii.get_variables(variables,
+                                                 error_cb=lambda var, ex: ex)))
+
     with util.WpKeySave(gpascii, verbose=True):
         for line in script:
             if not line:
@@ -124,7 +133,7 @@ def set_global_phase(devices, phase_freq, servo_divider, verbose=True,
                 if '=' in line:
                     var, value = line.split('=')
                     print('Setting %s=%s (current value=%s)' %
-                          (var, value, gpascii.get_variable(var)))
+                          (var, value, current[var]))
                 else:
                     print('Sending %s' % line)
 
@@ -134,6 +143,10 @@ def set_global_phase(devices, phase_freq, servo_divider, verbose=True,
                 except Exception as ex:
                     print('* Failed: %s' % ex)
 
+    if not dry_run:
+        # Clock settings change variables such as Sys.ServoPeriod indirectly
+        gpascii.flush_cache()
+
 
 def test():
     from .pp_comm import PPComm
@@ -12,6 +12,8 @@ username = os.environ.get('PPMAC_USER', 'root')
 password = os.environ.get('PPMAC_PASS', 'deltatau')
 
 fast_gather_port = int(os.environ.get('PPMAC_GATHER_PORT', '2332'))
+# Socket receive buffer size for the fast gather client (0 = system default)
+fast_gather_rcvbuf = int(os.environ.get('PPMAC_GATHER_RCVBUF', '0'))
 
 logger.debug('Power PMAC default host: %s:%d', hostname, port)
 logger.debug('Power PMAC default login: %s/%s', username, password)
@@ -18,22 +18,85 @@
 """
 
 from __future__ import print_function
+import os
+import json
+import select
 import socket
 import struct
 import time
+import zlib
+import contextlib
 import numpy as np
 
 from . import config
-from .gather_types import GATHER_TYPES
+from .gather_types import (GATHER_TYPES, make_conv_bits)
+from .gather_result import GatherResult
+
+
+# Data encoding flags (see GatherClient.set_encoding)
+ENCODE_DELTA = 1
+ENCODE_ZLIB = 2
+
+# Error code of a stream which fell behind the gather (see iter_chunks)
+ERR_OVERRUN = 6
+
+# Longest request line (including its newline) the server accepts, and the
+# most addresses a snapshot can read
+MAX_REQUEST_LENGTH = 4095
+MAX_SNAPSHOT_ITEMS = 256
+
+# Outcomes of a wait (see GatherClient.wait_full_result)
+WAIT_DISABLED, WAIT_SAMPLES, WAIT_TIMEOUT, WAIT_CANCELLED = range(4)
+
+# How often (s) a cancellation event is checked while waiting
+WAIT_CANCEL_POLL = 0.1
+
+# Size of the chunks data is received and decoded in by save_full_result
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Files of a gather saved by save_full_result: a description, and either
+# one array per column or a single structured array
+MEMMAP_INFO = 'gather.json'
+MEMMAP_COLUMN = 'column_%03d.npy'
+MEMMAP_LINES = 'lines.npy'
+
+
+def decode_data(samples, flags, raw_length, data):
+    """
+    Decode the data of an encoded (C) data packet
+
+    Returns the raw data, as a flat uint8 array
+    """
+    if flags & ENCODE_ZLIB:
+        data = zlib.decompress(data)
+
+    if len(data) != raw_length:
+        raise RuntimeError('Decoded %d bytes, expected %d' % (len(data), raw_length))
+
+    if flags & ENCODE_DELTA:
+        # Each 32-bit word of a line was sent as the difference from the
+        # previous line, so a (wrapping) cumulative sum restores it
+        words = np.frombuffer(data, dtype='>u4').reshape(samples, -1)
+        words = np.cumsum(words, axis=0, dtype=np.uint32).astype('>u4')
+        return words.reshape(-1).view(np.uint8)
+
+    return np.frombuffer(data, dtype=np.uint8)
 
 
 class TCPSocket(object):
-    def __init__(self, sock=None, host_port=None):
+    def __init__(self, sock=None, host_port=None, rcvbuf=None):
         if sock is None:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Commands are small, and each is waited on for its reply
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         else:
             self.sock = sock
 
+        if rcvbuf:
+            # A larger receive buffer (set prior to connecting, so that the
+            # TCP window can scale accordingly) helps with large transfers
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+
         if host_port is not None:
             self.connect(host_port)
 
@@ -58,21 +121,30 @@ class TCPSocket(object):
 
             total += sent
 
-    def recv_fixed(self, expected):
+    def recv_into_exact(self, buf):
         """
-        Receive a fixed-length packet, of length `expected`
+        Fill a writable buffer (e.g., a bytearray or numpy array) entirely
+        with received data
         """
-        packet = []
+        view = memoryview(buf).cast('B')
         received = 0
+        expected = len(view)
         while received < expected:
-            chunk = self.sock.recv(expected - len(packet))
-            if len(chunk) == 0:
+            count = self.sock.recv_into(view[received:])
+            if count == 0:
                 raise RuntimeError("Connection lost")
 
-            received += len(chunk)
-            packet.append(chunk)
+            received += count
 
-        return b''.join(packet)
+    def recv_fixed(self, expected):
+        """
+        Receive a fixed-length packet, of length `expected`
+
+        Returns a bytearray
+        """
+        packet = bytearray(expected)
+        self.recv_into_exact(packet)
+        return packet
 
     def __getattr__(self, s):
         # can't subclass socket.socket, so here's the next best thing
@@ -83,6 +155,97 @@ class GatherError(Exception):
     pass
 
 
+class GatherTimeoutError(GatherError):
+    pass
+
+
+class GatherCancelled(GatherError):
+    pass
+
+
+class GatherOverrun(GatherError):
+    pass
+
+
+class GatherMetadata(object):
+    """
+    Gather configuration, as reported by the server (see
+    GatherClient.query_metadata)
+
+    generation: changes whenever the gather is reconfigured
+    period: Gather.Period (or PhasePeriod)
+    max_samples, samples, index: Gather.MaxSamples, Samples and Index
+    shm_base: address of the Power PMAC shared memory, which the numeric
+              gather addresses point into
+    servo_period: Sys.ServoPeriod, in ms
+    phase_over_servo: Sys.PhaseOverServoPeriod
+    phase: whether this is the phase gather
+    types: the gather type of each address
+    addresses: numeric Gather.Addr (or PhaseAddr)
+    """
+    _HEADER = struct.Struct('>6I2d2B')
+
+    def __init__(self, generation, period, max_samples, samples, index,
+                 shm_base, servo_period, phase_over_servo, phase, types,
+                 addresses):
+        self.generation = generation
+        self.period = period
+        self.max_samples = max_samples
+        self.samples = samples
+        self.index = index
+        self.shm_base = shm_base
+        self.servo_period = servo_period
+        self.phase_over_servo = phase_over_servo
+        self.phase = phase
+        self.types = types
+        self.addresses = addresses
+
+    @classmethod
+    def from_packet(cls, buf):
+        """
+        Decode a metadata (M) packet
+        """
+        header_size = cls._HEADER.size
+        header = cls._HEADER.unpack(buf[:header_size])
+        n_items = header[-1]
+
+        types_end = header_size + 2 * n_items
+        types = struct.unpack('>%dH' % n_items, buf[header_size:types_end])
+        addresses = struct.unpack('>%dI' % n_items,
+                                  buf[types_end:types_end + 4 * n_items])
+
+        (generation, period, max_samples, samples, index, shm_base,
+         servo_period, phase_over_servo, phase, n_items) = header
+        return cls(generation, period, max_samples, samples, index, shm_base,
+                   servo_period, phase_over_servo, bool(phase), types,
+                   addresses)
+
+    @property
+    def clock_period(self):
+        """
+        Period of the servo (or phase) clock, in seconds
+        """
+        period = self.servo_period * 1e-3
+        if self.phase:
+            period *= self.phase_over_servo
+        return period
+
+    def __repr__(self):
+        return ('<%s generation=%08x items=%d period=%d samples=%d/%d>' %
+                (self.__class__.__name__, self.generation, len(self.types),
+                 self.period, self.samples, self.max_samples))
+
+
+def _get_phase_over_servo(metadata):
+    """
+    Sys.PhaseOverServoPeriod for phase gathers (see GatherResult), None for
+    servo gathers
+    """
+    if metadata.phase:
+        return metadata.phase_over_servo
+    return None
+
+
 class GatherClient(TCPSocket):
     """
     Power PMAC fast_gather client
@@ -90,44 +253,76 @@ class GatherClient(TCPSocket):
     START_MASK = 0xF800
     BIT_MASK = 0x07FF
 
-    def _recv_packet(self, expected_code):
+    # numpy dtypes of a line of data, keyed on the tuple of gather types
+    _dtypes = {}
+
+    def __init__(self, *args, **kwargs):
+        TCPSocket.__init__(self, *args, **kwargs)
+
+        # Descriptive names of the gather addresses, keyed on the generation
+        # of the gather configuration
+        self.address_cache = {}
+
+        # Whether the server sends phase (rather than servo) gather data
+        self.phase = False
+
+    def _recv_any_packet(self):
         """
-        Receive a packet, with an expected code
+        Receive a packet
 
         For example, the data code 'D':
             (packet length, uint32) D (packet)
 
-        Raises RuntimeError upon receiving an unexpected code or disconnection
+        Returns: (code, packet)
+
+        Raises RuntimeError upon disconnection
         Raises GatherError upon receiving an error code from the server
         """
-        packet_len = self.recv(4)
+        packet_len, = struct.unpack('>I', self.recv_fixed(4))
 
-        packet_len, = struct.unpack('>I', packet_len)
-        packet = self.recv_fixed(packet_len)
-        code, packet = packet[:1], packet[1:]
+        # The packet is received into a single buffer, and the code is
+        # stripped by way of a view rather than a copy
+        packet = memoryview(self.recv_fixed(packet_len))
+        code, packet = packet[:1].tobytes(), packet[1:]
 
         if code == b'E':
             error_code, = struct.unpack('>I', packet[:4])
+            if error_code == ERR_OVERRUN:
+                raise GatherOverrun('Stream overran the gather buffer')
             raise GatherError('Error %d' % error_code)
 
-        elif expected_code == code:
-            return memoryview(packet)
+        return code, packet
 
+    def _recv_packet(self, expected_code):
+        """
+        Receive a packet, with an expected code
+
+        Raises RuntimeError upon receiving an unexpected code or disconnection
+        Raises GatherError upon receiving an error code from the server
+        """
+        code, packet = self._recv_any_packet()
+        if expected_code == code:
+            return packet
         else:
             raise RuntimeError('Unexpected code %s (expected %s)' % (code, expected_code))
 
-    def query_types(self):
+    def _parse_types(self, buf):
         """
-        Get the integral types of the gathered data, one for each address
+        Unpack the gather types from a types (T) packet
         """
-        self.send(b'types\n')
-        buf = self._recv_packet(b'T')
         n_items, = struct.unpack('B', buf[:1])
         types = struct.unpack('>' + 'H' * n_items, buf[1:])
 
         assert(n_items == len(types))
         return types
 
+    def query_types(self):
+        """
+        Get the integral types of the gathered data, one for each address
+        """
+        self.send(b'types\n')
+        return self._parse_types(self._recv_packet(b'T'))
+
     def query_raw_data(self):
         """
         Query the server for all the raw data
@@ -135,10 +330,36 @@ class GatherClient(TCPSocket):
         Returns: sample count (lines), and raw data
         """
         self.send(b'data\n')
-        buf = self._recv_packet(b'D')
+        return self._recv_data()
+
+    def _recv_data(self):
+        """
+        Receive a data packet, either raw (D) or encoded (C)
+
+        Returns: sample count (lines), and raw data
+        """
+        code, packet = self._recv_any_packet()
+        if code == b'D':
+            samples, = struct.unpack('>I', packet[:4])
+            return samples, packet[4:]
+        elif code == b'C':
+            samples, flags, raw_length = struct.unpack('>III', packet[:12])
+            return samples, decode_data(samples, flags, raw_length, packet[12:])
+        else:
+            raise RuntimeError('Unexpected code %s (expected D or C)' % (code, ))
+
+    def set_encoding(self, delta=False, zlib_level=0):
+        """
+        Request that the server encode subsequent data (all, data, and subset
+        requests), which is then decoded transparently
 
-        samples, = struct.unpack('>I', buf[:4])
-        return samples, buf[4:]
+        delta: send each 32-bit word of each line as the difference from the
+               previous line, which makes slowly changing values (counters,
+               positions) highly compressible
+        zlib_level: zlib compression level (1-9, or 0 for none)
+        """
+        self.send(('encoding %d %d\n' % (int(bool(delta)), zlib_level)).encode('ascii'))
+        self._recv_packet(b'K')
 
     def set_phase_mode(self):
         """
@@ -146,6 +367,7 @@ class GatherClient(TCPSocket):
         """
         self.send(b'phase\n')
         self._recv_packet(b'K')
+        self.phase = True
 
     def set_servo_mode(self):
         """
@@ -153,27 +375,281 @@ class GatherClient(TCPSocket):
         """
         self.send(b'servo\n')
         self._recv_packet(b'K')
+        self.phase = False
+
+    def set_mode(self, phase):
+        """
+        Request phase (or servo) gather data, if not already doing so
+        """
+        if phase and not self.phase:
+            self.set_phase_mode()
+        elif not phase and self.phase:
+            self.set_servo_mode()
+
+    @contextlib.contextmanager
+    def phase_mode(self, phase=True):
+        """
+        Context manager: request phase (or, with phase=False, servo) gather
+        data within the block, restoring the previous mode afterward
+        """
+        previous = self.phase
+        self.set_mode(phase)
+        try:
+            yield self
+        finally:
+            self.set_mode(previous)
 
     def query_types_and_raw_data(self):
         """
         Query both types and raw data
 
-        Note: due to Nagle's algorithm where small packets are buffered before sending,
-        requesting the type information separately from the raw data can be significantly
-        slower. This method is more efficient, requesting both at the same time.
+        Both are requested at the same time, saving a round trip over
+        querying them separately.
         """
         self.send(b'all\n')
-        type_buf = self._recv_packet(b'T')
-        n_items, = struct.unpack('B', type_buf[:1])
-        types = struct.unpack('>' + 'H' * n_items, type_buf[1:])
+        types = self._parse_types(self._recv_packet(b'T'))
 
-        if n_items == 0:
+        if len(types) == 0:
             return types, 0, []
         else:
-            assert(n_items == len(types))
-            data_buf = self._recv_packet(b'D')
-            samples, = struct.unpack('>I', data_buf[:4])
-            return types, samples, data_buf[4:]
+            samples, data = self._recv_data()
+            return types, samples, data
+
+    def query_subset(self, items=None, start=0, count=None, step=1,
+                     minmax=False):
+        """
+        Query part of the raw data, selected by the server prior to sending
+
+        items: indices of the gathered items to include (default: all)
+        start: first sample (line)
+        count: number of samples from `start` (default: all remaining)
+        step: include only every `step`th sample
+        minmax: instead, include a pair of lines for every `step` samples:
+                the minimum, then the maximum of each item
+
+        Returns: (types of the selected items,
+                  number of lines,
+                  raw data)
+        """
+        args = [start, count or 0, step, int(bool(minmax))]
+        if items is not None:
+            if not items:
+                raise ValueError('No items selected')
+            args.extend(items)
+
+        self.send(('subset %s\n' % ' '.join('%d' % arg for arg in args)).encode('ascii'))
+
+        types = self._parse_types(self._recv_packet(b'T'))
+        samples, data = self._recv_data()
+        return types, samples, data
+
+    def get_subset(self, items=None, start=0, count=None, step=1,
+                   minmax=False):
+        """
+        Query part of the gathered data (see query_subset), as columns
+
+        Returns: a list of column arrays, one for each selected item (as in
+                 get_columns), or with `minmax`, a list of minimum columns and
+                 a list of maximum columns
+        """
+        types, samples, raw_data = self.query_subset(items=items, start=start,
+                                                     count=count, step=step,
+                                                     minmax=minmax)
+
+        if samples == 0:
+            data = [np.zeros(0) for type_ in types]
+        else:
+            data, n_items, samples = self._parse_raw_data(types, raw_data)
+
+        if minmax:
+            return ([col[0::2] for col in data],
+                    [col[1::2] for col in data])
+        else:
+            return data
+
+    def query_stats(self):
+        """
+        Query the server's request statistics
+
+        Returns a dictionary, including for each request type (e.g., 'types'):
+            types.count: number of requests served
+            types.mean_us, types.max_us: service time, in microseconds
+        along with the number of connected clients and total bytes sent.
+        """
+        self.send(b'stats\n')
+        text = self._recv_packet(b'R').tobytes().decode('ascii')
+
+        stats = {}
+        for line in text.splitlines():
+            key, value = line.split('=', 1)
+            if '.' in value:
+                stats[key] = float(value)
+            else:
+                stats[key] = int(value)
+
+        return stats
+
+    def iter_chunks(self):
+        """
+        Stream gathered data while it is being acquired
+
+        The server follows the gather buffer index, sending the newly
+        gathered lines (wrapping around the end of the buffer as necessary)
+        as they are written, until gathering is disabled. Closing the
+        generator early stops the stream.
+
+        Gathering should be enabled prior to calling this, as the stream
+        ends as soon as the server finds it disabled.
+
+        Yields: (number of the first sample in the chunk,
+                 list of column arrays, as in get_columns)
+
+        Raises GatherOverrun if the stream fell so far behind the gather
+        that lines were overwritten before they could be sent
+        """
+        self.send(b'stream\n')
+        types = self._parse_types(self._recv_packet(b'T'))
+
+        try:
+            while True:
+                code, packet = self._recv_any_packet()
+                if code == b'Z':
+                    return
+                elif code != b'S':
+                    raise RuntimeError('Unexpected code %s (expected S)' % (code, ))
+
+                first_sample, lines = struct.unpack('>II', packet[:8])
+                if lines > 0:
+                    data, n_items, samples = self._parse_raw_data(types,
+                                                                  packet[8:])
+                    yield first_sample, data
+        except GeneratorExit:
+            self._stop_stream()
+            raise
+
+    def _stop_stream(self):
+        """
+        Stop streaming, discarding any chunks already sent
+
+        The cancel request is acknowledged whether it stopped the stream or
+        the stream had already ended (its end yet to be received)
+        """
+        self.send(b'cancel\n')
+        while True:
+            try:
+                code, packet = self._recv_any_packet()
+            except GatherError:
+                # (e.g., the stream overran before the cancel arrived)
+                continue
+
+            if code == b'K':
+                break
+
+    def _snapshot_request(self, addresses, types, interval, count):
+        if len(addresses) != len(types):
+            raise ValueError('Got %d types for %d addresses' %
+                             (len(types), len(addresses)))
+        elif not addresses:
+            raise ValueError('No addresses')
+        elif len(addresses) > MAX_SNAPSHOT_ITEMS:
+            raise ValueError('At most %d addresses can be read at once (got '
+                             '%d)' % (MAX_SNAPSHOT_ITEMS, len(addresses)))
+
+        items = ' '.join('%d %x' % (type_, addr)
+                         for type_, addr in zip(types, addresses))
+        request = ('snapshot %d %d %s\n' % (int(interval * 1e6), count,
+                                            items)).encode('ascii')
+        if len(request) > MAX_REQUEST_LENGTH:
+            raise ValueError('Snapshot request too long (%d bytes)' %
+                             len(request))
+
+        return request
+
+    def _parse_snapshot(self, packet, types, names=None):
+        """
+        Decode a snapshot (V) packet
+
+        Returns: (snapshot number, Sys.ServoCount, numpy record)
+        """
+        number, servo_count = struct.unpack('>II', packet[:8])
+        data, n_items, samples = self._parse_raw_data(types, packet[8:])
+        record = np.rec.fromarrays(data, names=names)[0]
+        return number, servo_count, record
+
+    def snapshot(self, addresses, types, names=None):
+        """
+        Read the current values of addresses in the Power PMAC shared
+        memory, decoded as gathered data of the same types would be
+
+        This takes a single round trip to the server, rather than a gpascii
+        query.
+
+        addresses: numeric addresses, as in Gather.Addr[] (e.g.,
+                   GatherMetadata.addresses, or from ppmac.address_index)
+        types: the gather type of each address (e.g., GatherMetadata.types)
+        names: field names of the record (default: f0, f1, ...)
+
+        Raises GatherError if an address is outside of the shared memory
+        structure, and ValueError if there are more than MAX_SNAPSHOT_ITEMS
+        addresses.
+
+        Returns: numpy record
+        """
+        self.send(self._snapshot_request(addresses, types, 0, 1))
+        number, servo_count, record = self._parse_snapshot(
+            self._recv_packet(b'V'), types, names)
+        return record
+
+    def iter_snapshots(self, addresses, types, interval, count=0,
+                       names=None):
+        """
+        Read the current values of addresses (see snapshot) every `interval`
+        seconds, for `count` snapshots (or until the generator is closed,
+        with count=0)
+
+        The server polls at most once per millisecond, so intervals shorter
+        than that are rounded up.
+
+        Yields: (Sys.ServoCount, numpy record)
+        """
+        self.send(self._snapshot_request(addresses, types, interval, count))
+        if count == 1:
+            # A single snapshot, as snapshot()
+            number, servo_count, record = self._parse_snapshot(
+                self._recv_packet(b'V'), types, names)
+            yield servo_count, record
+            return
+
+        try:
+            while True:
+                code, packet = self._recv_any_packet()
+                if code == b'Z':
+                    return
+                elif code != b'V':
+                    raise RuntimeError('Unexpected code %s (expected V)' % (code, ))
+
+                number, servo_count, record = self._parse_snapshot(
+                    packet, types, names)
+                yield servo_count, record
+        except GeneratorExit:
+            self._stop_snapshots(count)
+            raise
+
+    def _stop_snapshots(self, count):
+        """
+        Stop sending snapshots, discarding any already sent
+        """
+        self.send(b'cancel\n')
+        while True:
+            code, packet = self._recv_any_packet()
+            if code == b'Z':
+                break
+
+        sent, = struct.unpack('>I', packet[:4])
+        if count and sent >= count:
+            # All were sent before the server got the request, which is
+            # then acknowledged
+            self._recv_packet(b'K')
 
     def _get_type(self, type_):
         """
@@ -186,16 +662,6 @@ class GatherClient(TCPSocket):
         if type_ in GATHER_TYPES:
             return GATHER_TYPES[type_]
 
-        def make_conv_bits(start, count):
-            mask = ((1 << count) - 1)
-
-            def wrapped(values):
-                return [((value >> start) & mask)
-                        for value in values]
-
-            wrapped.__name__ = 'conv_bits_%d_to_%d' % (start, start + count)
-            return wrapped
-
         # Undocumented types -- a certain number of bits and such
         # see gather_serve.c or:
         #   http://forums.deltatau.com/archive/index.php?thread-933.html
@@ -207,39 +673,62 @@ class GatherClient(TCPSocket):
         GATHER_TYPES[type_] = ret
         return ret
 
+    def _get_dtype(self, types):
+        """
+        Get the numpy structured dtype of one line (sample) of raw data with
+        the given gather types
+
+        Fields are named f0, f1, ... in the order of the types, with the
+        big-endian format of each from GATHER_TYPES.
+        """
+        types = tuple(types)
+        try:
+            return self._dtypes[types]
+        except KeyError:
+            pass
+
+        formats = []
+        for type_ in types:
+            size, format_, conv = self._get_type(type_)
+            dtype = np.dtype('>' + format_)
+            assert(dtype.itemsize == size)
+            formats.append(dtype)
+
+        dtype = np.dtype({'names': ['f%d' % i for i in range(len(types))],
+                          'formats': formats})
+
+        self._dtypes[types] = dtype
+        return dtype
+
     def _parse_raw_data(self, types, raw_data):
         """
-        Combines type information and raw data into a 1D array of processed
-        data
+        Combines type information and raw data into per-address arrays of
+        processed data
 
-        Returns: (processed but flat data,
+        The raw data is viewed as a numpy structured array without copying,
+        so columns without a conversion function are (big-endian) views of
+        the received buffer.
+
+        Returns: (list of column arrays,
                   number of addresses,
                   number of samples/lines)
         """
         n_items = len(types)
 
-        types = [self._get_type(type_) for type_ in types]
-
-        line_size = sum(size for (size, format_, conv) in types)
-        line_count = int(len(raw_data) / line_size)
+        dtype = self._get_dtype(types)
+        line_count = len(raw_data) // dtype.itemsize
 
-        data_format = ''.join(format_ for (size, format_, conv) in types)
-        struct_ = struct.Struct('>' + data_format * line_count)
-
-        if not isinstance(raw_data, memoryview):
-            raw_data = memoryview(raw_data)
-
-        data = struct_.unpack(raw_data[:line_size * line_count])
+        data = np.frombuffer(raw_data, dtype=dtype, count=line_count)
 
         ret_data = []
-        for i, (size, format_, conv) in enumerate(types):
-            col = data[i::n_items]
+        for i, type_ in enumerate(types):
+            size, format_, conv = self._get_type(type_)
+            col = data['f%d' % i]
             if conv is not None:
-                ret_data.append(conv(col))
-            else:
-                ret_data.append(col)
+                col = np.asarray(conv(col))
+
+            ret_data.append(col)
 
-        # import pdb; pdb.set_trace()
         return ret_data, n_items, line_count
 
     def _query_all(self):
@@ -265,6 +754,8 @@ class GatherClient(TCPSocket):
                   [addr1[0], addr1[1], ...],
                   ...]
 
+        where each column is a numpy array (or, if `as_numpy` is set, a 2D
+        array of all columns)
         """
         data, n_items, samples = self._query_all()
 
@@ -281,13 +772,411 @@ class GatherClient(TCPSocket):
                   [addr0[1], addr1[1], ...],
                   ...]
         """
+        data, n_items, samples = self._query_all()
+
         if as_numpy:
-            return self.get_rows(as_numpy=as_numpy).T
-        else:
-            data, n_items, samples = self._query_all()
+            if samples == 0:
+                return np.zeros((0, n_items))
 
+            return np.column_stack(data)
+        else:
             return list(zip(*data))
 
+    def get_result(self, addresses):
+        """
+        Query the server for all gather data, returning a GatherResult
+
+        addresses: the descriptive names of the gathered addresses, in
+                   order (e.g., from the gather settings file)
+        """
+        data, n_items, samples = self._query_all()
+
+        if len(addresses) != n_items:
+            raise GatherError('Server gathered %d addresses, expected %d' %
+                              (n_items, len(addresses)))
+
+        if samples == 0:
+            data = [np.zeros(0) for i in range(n_items)]
+
+        return GatherResult(addresses, data)
+
+    def query_metadata(self):
+        """
+        Query the gather configuration
+
+        Returns: GatherMetadata
+        """
+        self.send(b'meta\n')
+        return GatherMetadata.from_packet(self._recv_packet(b'M'))
+
+    def query_full(self):
+        """
+        Query the gather configuration and all raw data, in a single reply
+
+        Returns: (GatherMetadata, sample count, raw data)
+        """
+        self.send(b'full\n')
+        metadata = GatherMetadata.from_packet(self._recv_packet(b'M'))
+        samples, data = self._recv_data()
+        return metadata, samples, data
+
+    def _get_addresses(self, metadata, addresses=None):
+        """
+        Descriptive names of the gathered addresses: those given (which are
+        then remembered for the gather configuration), those last given for
+        the same configuration, or failing that, the numeric addresses (as
+        '$hex')
+        """
+        types = metadata.types
+        if addresses is None:
+            addresses = self.address_cache.get(metadata.generation)
+        elif len(addresses) != len(types):
+            raise GatherError('Server gathered %d addresses, expected %d' %
+                              (len(types), len(addresses)))
+        else:
+            self.address_cache[metadata.generation] = addresses
+
+        if addresses is None:
+            addresses = ['$%x' % addr for addr in metadata.addresses]
+
+        return list(addresses)
+
+    def get_full_result(self, addresses=None):
+        """
+        Query the server for all gather data along with its configuration,
+        returning a GatherResult with its time axis information filled in
+
+        addresses: the descriptive names of the gathered addresses. If
+                   unspecified, those last given for the same gather
+                   configuration are used; failing that, the numeric
+                   addresses (as '$hex').
+
+        Returns: (GatherMetadata, GatherResult)
+        """
+        metadata, samples, raw_data = self.query_full()
+        return metadata, self._make_full_result(metadata, samples, raw_data,
+                                                addresses)
+
+    def _make_full_result(self, metadata, samples, raw_data, addresses=None):
+        types = metadata.types
+        if samples == 0:
+            data = [np.zeros(0) for type_ in types]
+        else:
+            data, n_items, samples = self._parse_raw_data(types, raw_data)
+
+        addresses = self._get_addresses(metadata, addresses)
+        return GatherResult(addresses, data,
+                            servo_period=metadata.servo_period * 1e-3,
+                            gather_period=metadata.period,
+                            phase_over_servo=_get_phase_over_servo(metadata))
+
+    def wait_full_result(self, samples=0, timeout=None, wait_start=False,
+                         addresses=None, cancel=None, start=None):
+        """
+        Wait for the current gather to complete, then receive all of its
+        data along with its configuration (as get_full_result)
+
+        The server watches the gather itself and replies as soon as it
+        completes, rather than the gather state being polled over gpascii.
+
+        samples: return once this many samples have been gathered (default:
+                 once gathering is disabled)
+        timeout: give up after this many seconds (default: no timeout)
+        wait_start: gathering has yet to be enabled (e.g., by a motion
+                    program that is about to run), so wait for that first
+        addresses: descriptive names of the gathered addresses (see
+                   get_full_result)
+        cancel: optionally, a threading.Event which cancels the wait when
+                set (from another thread)
+        start: optionally, called once the wait request has been sent (e.g.,
+               to start the motion program which enables gathering, such
+               that a short gather cannot end before the wait begins)
+
+        Raises GatherTimeoutError on timeout, and GatherCancelled when
+        cancelled. A KeyboardInterrupt cancels the wait before it is
+        re-raised.
+
+        Returns: (GatherMetadata, GatherResult)
+        """
+        timeout_ms = 0
+        if timeout is not None:
+            timeout_ms = max(1, int(timeout * 1000))
+
+        self.send(('wait %d %d %d\n' % (samples, timeout_ms,
+                                        int(bool(wait_start)))).encode('ascii'))
+
+        if start is not None:
+            try:
+                start()
+            except BaseException:
+                self._cancel_wait()
+                raise
+
+        try:
+            if cancel is not None:
+                # Check the event while waiting for the reply to start
+                while not self._wait_readable(WAIT_CANCEL_POLL):
+                    if cancel.is_set():
+                        self._cancel_wait()
+                        raise GatherCancelled('Wait cancelled')
+
+            outcome, gathered = self._recv_wait_outcome()
+        except KeyboardInterrupt:
+            self._cancel_wait()
+            raise
+
+        if outcome == WAIT_TIMEOUT:
+            raise GatherTimeoutError('Gather incomplete after %g s (%d samples)'
+                                     % (timeout, gathered))
+        elif outcome == WAIT_CANCELLED:
+            raise GatherCancelled('Wait cancelled')
+
+        metadata = GatherMetadata.from_packet(self._recv_packet(b'M'))
+        samples, raw_data = self._recv_data()
+        return metadata, self._make_full_result(metadata, samples, raw_data,
+                                                addresses)
+
+    def _wait_readable(self, timeout):
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        return bool(readable)
+
+    def _recv_wait_outcome(self):
+        """
+        Returns: (outcome, samples gathered)
+        """
+        return struct.unpack('>II', self._recv_packet(b'W')[:8])
+
+    def _cancel_wait(self):
+        """
+        Cancel a wait, discarding its reply if the gather completed (or the
+        wait timed out) before the server got the request
+        """
+        self.send(b'cancel\n')
+        outcome, gathered = self._recv_wait_outcome()
+        if outcome == WAIT_CANCELLED:
+            return
+
+        if outcome != WAIT_TIMEOUT:
+            self._recv_packet(b'M')
+            self._recv_data()
+
+        # The cancel request itself is then acknowledged
+        self._recv_packet(b'K')
+
+    def _recv_data_header(self):
+        """
+        Receive the start of a data packet, either raw (D) or encoded (C),
+        leaving its data to be received
+
+        Returns: (sample count, encoding flags, raw data length,
+                  data length still to be received)
+        """
+        packet_len, = struct.unpack('>I', self.recv_fixed(4))
+        code = bytes(self.recv_fixed(1))
+        if code == b'E':
+            error_code, = struct.unpack('>I', self.recv_fixed(4))
+            raise GatherError('Error %d' % error_code)
+        elif code == b'D':
+            samples, = struct.unpack('>I', self.recv_fixed(4))
+            remaining = packet_len - 5
+            return samples, 0, remaining, remaining
+        elif code == b'C':
+            samples, flags, raw_length = struct.unpack('>III',
+                                                       self.recv_fixed(12))
+            return samples, flags, raw_length, packet_len - 13
+        else:
+            raise RuntimeError('Unexpected code %s (expected D or C)' % (code, ))
+
+    def _iter_raw_chunks(self, flags, raw_length, remaining, line_length,
+                         chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Receive the data of a data packet in chunks, decoding it as it
+        arrives
+
+        Yields chunks of raw data of whole lines (of at most about
+        `chunk_size` bytes), such that memory use is bounded regardless of
+        the size of the data
+        """
+        if remaining == 0:
+            return
+
+        chunk_size = max(1, chunk_size // line_length) * line_length
+        if not flags:
+            buf = bytearray(min(chunk_size, remaining))
+            while remaining > 0:
+                view = memoryview(buf)[:min(len(buf), remaining)]
+                self.recv_into_exact(view)
+                remaining -= len(view)
+                yield view
+            return
+
+        def decoded():
+            # Decompressed output is limited to a chunk per call
+            decompressor = (zlib.decompressobj() if flags & ENCODE_ZLIB
+                            else None)
+            left = remaining
+            while left > 0:
+                data = self.recv_fixed(min(chunk_size, left))
+                left -= len(data)
+                if decompressor is None:
+                    yield bytes(data)
+                    continue
+
+                while data:
+                    yield decompressor.decompress(data, chunk_size)
+                    data = decompressor.unconsumed_tail
+
+            if decompressor is not None:
+                yield decompressor.flush()
+
+        pending = b''
+        previous = None
+        received = 0
+        for data in decoded():
+            pending += data
+            whole = len(pending) - len(pending) % line_length
+            if whole == 0:
+                continue
+
+            chunk, pending = pending[:whole], pending[whole:]
+            received += len(chunk)
+            if flags & ENCODE_DELTA:
+                # As in decode_data, continuing from the last line of the
+                # previous chunk
+                words = np.frombuffer(chunk, dtype='>u4').reshape(
+                    -1, line_length // 4).astype(np.uint32)
+                if previous is not None:
+                    words[0] += previous
+
+                np.cumsum(words, axis=0, dtype=np.uint32, out=words)
+                previous = words[-1].copy()
+                chunk = words.astype('>u4').tobytes()
+
+            yield chunk
+
+        if received != raw_length or pending:
+            raise RuntimeError('Decoded %d bytes, expected %d' %
+                               (received + len(pending), raw_length))
+
+    def _get_decoded_dtype(self, type_):
+        """
+        dtype of the values of an item of the given type, once converted
+        """
+        size, format_, conv = self._get_type(type_)
+        dtype = np.dtype('>' + format_)
+        if conv is not None:
+            dtype = np.asarray(conv(np.zeros(1, dtype=dtype))).dtype
+
+        return dtype.newbyteorder('=')
+
+    def save_full_result(self, path, addresses=None, columnar=True,
+                         chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Query the server for all gather data along with its configuration,
+        as with get_full_result, decoding it in chunks straight to .npy files
+        in the directory `path`. Memory use is bounded by the chunk size,
+        rather than the size of the gather.
+
+        columnar: save one array per address, rather than one structured
+                  array (with a field per address)
+
+        The data can be reopened later with load_memmap_result(path).
+
+        Returns: (GatherMetadata, GatherResult of memory-mapped columns)
+        """
+        self.send(b'full\n')
+        metadata = GatherMetadata.from_packet(self._recv_packet(b'M'))
+        samples, flags, raw_length, remaining = self._recv_data_header()
+
+        types = metadata.types
+        addresses = self._get_addresses(metadata, addresses)
+        dtype = self._get_dtype(types)
+        samples = (raw_length // dtype.itemsize if dtype.itemsize else 0)
+        out_dtypes = [self._get_decoded_dtype(type_) for type_ in types]
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        open_memmap = np.lib.format.open_memmap
+        if columnar:
+            columns = [open_memmap(os.path.join(path, MEMMAP_COLUMN % i),
+                                   mode='w+', dtype=out_dtype,
+                                   shape=(samples, ))
+                       for i, out_dtype in enumerate(out_dtypes)]
+        else:
+            # Fields are named by address, unless any is gathered twice
+            if len(set(addresses)) == len(addresses):
+                names = addresses
+            else:
+                names = ['f%d' % i for i in range(len(addresses))]
+
+            lines = open_memmap(os.path.join(path, MEMMAP_LINES), mode='w+',
+                                dtype=np.dtype({'names': names,
+                                                'formats': out_dtypes}),
+                                shape=(samples, ))
+            columns = [lines[name] for name in names]
+
+        line = 0
+        for chunk in self._iter_raw_chunks(flags, raw_length, remaining,
+                                           dtype.itemsize,
+                                           chunk_size=chunk_size):
+            data = np.frombuffer(chunk, dtype=dtype)
+            for i, type_ in enumerate(types):
+                size, format_, conv = self._get_type(type_)
+                col = data['f%d' % i]
+                if conv is not None:
+                    col = conv(col)
+
+                columns[i][line:line + len(data)] = col
+
+            line += len(data)
+
+        if columnar:
+            for column in columns:
+                column.flush()
+        else:
+            lines.flush()
+
+        info = {'addresses': addresses,
+                'types': list(types),
+                'samples': samples,
+                'columnar': columnar,
+                'generation': metadata.generation,
+                'servo_period': metadata.servo_period * 1e-3,
+                'gather_period': metadata.period,
+                'phase_over_servo': _get_phase_over_servo(metadata),
+                }
+        with open(os.path.join(path, MEMMAP_INFO), 'wt') as f:
+            json.dump(info, f, indent=4)
+
+        del columns
+        return metadata, load_memmap_result(path)
+
+
+def load_memmap_result(path, mode='r'):
+    """
+    Open gather data saved by GatherClient.save_full_result, without reading
+    it into memory
+
+    Returns: GatherResult of memory-mapped columns
+    """
+    with open(os.path.join(path, MEMMAP_INFO), 'rt') as f:
+        info = json.load(f)
+
+    addresses = info['addresses']
+    if info['columnar']:
+        columns = [np.load(os.path.join(path, MEMMAP_COLUMN % i),
+                           mmap_mode=mode)
+                   for i in range(len(addresses))]
+    else:
+        lines = np.load(os.path.join(path, MEMMAP_LINES), mmap_mode=mode)
+        columns = [lines[name] for name in lines.dtype.names]
+
+    return GatherResult(addresses, columns,
+                        servo_period=info['servo_period'],
+                        gather_period=info['gather_period'],
+                        phase_over_servo=info.get('phase_over_servo'))
+
 
 def test(host=config.hostname, port=config.fast_gather_port):
     port = int(port)
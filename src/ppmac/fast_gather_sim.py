@@ -0,0 +1,965 @@
+"""
+:mod:`ppmac.fast_gather_sim` -- Simulated fast_gather server
+============================================================
+
+.. module:: ppmac.fast_gather_sim
+   :synopsis: A stand-in for fast_gather/gather_server which speaks the same
+              protocol (in the Power PMAC's big-endian byte order) from a
+              synthetic or recorded gather buffer, so that GatherClient can
+              be tested and benchmarked without a Power PMAC.
+.. moduleauthor:: Ken Lauer <klauer@bnl.gov>
+
+Run a server with a synthetic gather of 100000 samples with:
+    python -m ppmac.fast_gather_sim -n 100000
+or from a buffer recorded with misc/bench_gather_encoding.py with:
+    python -m ppmac.fast_gather_sim servo.npz
+"""
+
+from __future__ import print_function
+import time
+import zlib
+import select
+import socket
+import struct
+import logging
+import argparse
+import threading
+
+import numpy as np
+from six.moves import socketserver
+
+from . import config
+from . import gather_types
+from .gather_types import (UINT32, INT32, UINT24, INT24, FLOAT, DOUBLE,
+                           UBITS, SBITS)
+
+
+logger = logging.getLogger(__name__)
+
+# Error codes, sent in E packets
+ERR_UNKNOWN_COMMAND = 1
+ERR_BAD_ARGUMENT = 2
+ERR_NO_MEMORY = 3
+ERR_ENCODING = 4
+ERR_BAD_ADDRESS = 5
+ERR_OVERRUN = 6
+ERR_LINE_TOO_LONG = 7
+
+# Data encoding flags
+ENCODE_DELTA = 1
+ENCODE_ZLIB = 2
+
+# Gather.Items is an unsigned char
+MAX_ITEMS = 256
+
+# Longest line gather_server takes as a request (its input buffer, BUF_SIZE,
+# less one), and what read_line returns in place of a longer one
+MAX_LINE_LENGTH = 4095
+LINE_TOO_LONG = object()
+
+# Reported as the shared memory base address, (unsigned int)pshm
+SHM_BASE = 0x70000000
+
+# Size of the simulated shared memory structure, sizeof(SHM), which
+# snapshot addresses must lie within
+SHM_SIZE = 0x100000
+
+# While streaming, how often (s) the gather index is checked for new lines
+STREAM_POLL = 0.001
+
+REQUESTS = ['servo', 'phase', 'types', 'data', 'all', 'stream', 'stats',
+            'subset', 'encoding', 'meta', 'full', 'wait', 'cancel', 'snapshot',
+            'unknown']
+
+# Outcomes of a wait, sent in W packets
+WAIT_DISABLED, WAIT_SAMPLES, WAIT_TIMEOUT, WAIT_CANCELLED = range(4)
+
+START_MASK = 0xF800
+BIT_MASK = 0x07FF
+
+# Motor[].AmpEna: 1 bit, starting at bit 12
+AMP_ENA = 0x67c6
+
+# Sys.ServoCount, a motor's actual and desired positions, following error in
+# counts, and amplifier enable bit, and an int24, float, and uint24 item
+DEFAULT_TYPES = (UINT32, DOUBLE, DOUBLE, INT32, AMP_ENA, INT24, FLOAT, UINT24)
+
+
+def fnv1a(data, hash_=2166136261):
+    """
+    32-bit FNV-1a hash
+    """
+    for byte in bytearray(data):
+        hash_ = ((hash_ ^ byte) * 16777619) & 0xFFFFFFFF
+    return hash_
+
+
+def get_bits(type_):
+    """
+    (start bit, bit count) of a bitfield gather type, or None
+    """
+    if type_ <= SBITS:
+        return None
+
+    start = (type_ & START_MASK) >> 11
+    count = 32 - ((type_ & BIT_MASK) >> 6)
+    return start, count
+
+
+def valid_gather_type(type_):
+    """
+    Whether a type is one of the enumerated gather types, or a bitfield
+    within a 32-bit word
+    """
+    if not 0 <= type_ <= 0xFFFF:
+        return False
+    elif type_ <= SBITS:
+        return True
+
+    start, count = get_bits(type_)
+    return count > 0 and start + count <= 32
+
+
+def get_line_dtype(types):
+    """
+    Structured dtype of a line of the gather buffer, as raw big-endian words
+    (doubles as is)
+    """
+    return np.dtype([('f%d' % i, '>f8' if type_ == DOUBLE else '>u4')
+                     for i, type_ in enumerate(types)])
+
+
+def get_values(type_, words):
+    """
+    Values of gathered items (raw words, or doubles) as the client decodes
+    them, as doubles for comparison (as gather_server does for minmax)
+    """
+    if type_ == DOUBLE:
+        return np.asarray(words, dtype=np.float64)
+
+    words = np.asarray(words, dtype=np.uint32)
+    if type_ == INT32:
+        return words.view(np.int32).astype(np.float64)
+    elif type_ == INT24:
+        return gather_types.conv_int24_array(words).astype(np.float64)
+    elif type_ == UINT24:
+        return gather_types.conv_uint24_array(words).astype(np.float64)
+    elif type_ == FLOAT:
+        return words.view(np.float32).astype(np.float64)
+    elif type_ in (UINT32, UBITS, SBITS):
+        return words.astype(np.float64)
+
+    start, count = get_bits(type_)
+    return gather_types.make_conv_bits(start, count)(words).astype(np.float64)
+
+
+def block_extremes(values, step):
+    """
+    Indices of the (first) minimum and maximum of each block of `step`
+    values, the last of which may be partial
+    """
+    full = len(values) // step
+    starts = np.arange(0, len(values), step)
+    blocks = values[:full * step].reshape(full, step)
+    min_idx = [np.argmin(blocks, axis=1)]
+    max_idx = [np.argmax(blocks, axis=1)]
+    if len(values) > full * step:
+        min_idx.append([np.argmin(values[full * step:])])
+        max_idx.append([np.argmax(values[full * step:])])
+
+    return (starts + np.concatenate(min_idx).astype(int),
+            starts + np.concatenate(max_idx).astype(int))
+
+
+def synthetic_lines(types, samples, first_sample=0, seed=0):
+    """
+    Gather lines for the given types: counters (uint32), moves (double,
+    float), noise (int32, int24, uint24) and toggling bitfields. The unused
+    bits of words (the high byte of 24-bit items, the bits outside of
+    bitfields) are filled with noise, as the client is expected to mask
+    them off.
+    """
+    rs = np.random.RandomState(seed + first_sample)
+    lines = np.zeros(samples, dtype=get_line_dtype(types))
+    t = np.arange(first_sample, first_sample + samples, dtype=np.float64)
+
+    for i, type_ in enumerate(types):
+        field = 'f%d' % i
+        noise = rs.randint(0, 1 << 32, size=samples,
+                           dtype=np.uint64).astype(np.uint32)
+        if type_ == UINT32:
+            lines[field] = (123456 + t).astype(np.uint32)
+        elif type_ == DOUBLE:
+            lines[field] = 1000. * np.sin(2 * np.pi * t / (5000. * (i + 1)))
+        elif type_ == FLOAT:
+            value = np.float32(10. * np.cos(2 * np.pi * t / 1000.))
+            lines[field] = value.view(np.uint32)
+        elif type_ == INT32:
+            lines[field] = np.round(rs.normal(0, 1000, samples)).astype(np.int32).view(np.uint32)
+        elif type_ in (INT24, UINT24):
+            value = rs.randint(-(1 << 23), 1 << 23, size=samples).astype(np.int32)
+            lines[field] = ((value.view(np.uint32) & 0xFFFFFF) |
+                            (noise & 0xFF000000))
+        elif type_ in (UBITS, SBITS):
+            lines[field] = noise
+        else:
+            start, count = get_bits(type_)
+            mask = (1 << count) - 1 if count < 32 else 0xFFFFFFFF
+            value = ((t // 1000).astype(np.uint32) + np.uint32(i)) & mask
+            lines[field] = ((noise & ~np.uint32(mask << start & 0xFFFFFFFF)) |
+                            (value << np.uint32(start)))
+
+    return lines
+
+
+class SimulatedGather(object):
+    """
+    A servo or phase gather buffer
+
+    Lines are acquired into a circular buffer of `max_lines` lines. Once
+    `max_samples` lines have been acquired (if nonzero), gathering stops.
+    """
+    def __init__(self, types=DEFAULT_TYPES, max_lines=100000, period=1,
+                 max_samples=0, addresses=None, source=None):
+        if len(types) > MAX_ITEMS - 1:
+            raise ValueError('Too many items')
+
+        self.types = tuple(types)
+        self.period = period
+        self.max_lines = max_lines
+        self.max_samples = max_samples
+        if addresses is None:
+            addresses = [SHM_BASE + 0x1000 + 8 * i for i in range(len(types))]
+
+        self.addresses = tuple(addresses)
+        self.dtype = get_line_dtype(types)
+        self.buffer = np.zeros(max_lines, dtype=self.dtype)
+        self.samples = 0
+        self.enabled = False
+
+        # Source of lines: fcn(first sample, count) -> structured array,
+        # synthetic by default
+        if source is None:
+            source = lambda first, count: synthetic_lines(self.types, count,
+                                                          first_sample=first)
+        self.source = source
+
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @classmethod
+    def from_file(cls, fn, **kwargs):
+        """
+        A gather buffer recorded with misc/bench_gather_encoding.py, whose
+        lines are replayed (repeating) as they are acquired
+        """
+        data = np.load(fn)
+        types = tuple(int(type_) for type_ in data['types'])
+        samples = int(data['samples'])
+        lines = np.frombuffer(data['raw'].tobytes(), dtype=get_line_dtype(types),
+                              count=samples)
+
+        def source(first, count):
+            return lines[np.arange(first, first + count) % samples]
+
+        kwargs.setdefault('max_lines', samples)
+        gather = cls(types, source=source, **kwargs)
+        gather.acquire(samples)
+        return gather
+
+    @property
+    def line_length(self):
+        return self.dtype.itemsize
+
+    @property
+    def index(self):
+        """
+        Write index (line number) of the buffer
+        """
+        return self.samples % self.max_lines if self.max_lines else 0
+
+    @property
+    def generation(self):
+        """
+        Hash of the gather configuration, as gather_server calculates it
+        """
+        n_items = len(self.types)
+        return fnv1a(struct.pack('>B%dH%dIII' % (n_items, n_items), n_items,
+                                 *(self.types + self.addresses +
+                                   (self.period, self.max_samples))))
+
+    def acquire(self, count):
+        """
+        Acquire `count` lines from the source (or up to max_samples)
+        """
+        if self.max_samples:
+            count = min(count, self.max_samples - self.samples)
+
+        if count <= 0 or not self.max_lines:
+            return 0
+
+        lines = self.source(self.samples, count)[-self.max_lines:]
+        with self.lock:
+            index = (self.samples + count - len(lines)) % self.max_lines
+            first = min(len(lines), self.max_lines - index)
+            self.buffer[index:index + first] = lines[:first]
+            self.buffer[:len(lines) - first] = lines[first:]
+            self.samples += count
+
+        return count
+
+    def start(self, rate=2000., max_samples=None):
+        """
+        Gather in the background, at `rate` lines per second, until stopped
+        or `max_samples` lines have been acquired
+        """
+        self.stop()
+        if max_samples is not None:
+            self.max_samples = max_samples
+
+        with self.lock:
+            self.samples = 0
+            self.enabled = True
+
+        self._thread = threading.Thread(target=self._run, args=(rate, ))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, rate):
+        t0 = time.time()
+        while self.enabled:
+            due = int((time.time() - t0) * rate) - self.samples
+            if due > 0 and self.acquire(due) < due:
+                # Reached max_samples
+                break
+
+            time.sleep(STREAM_POLL)
+
+        self.enabled = False
+
+    def stop(self):
+        """
+        Stop gathering
+        """
+        self.enabled = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def get_lines(self):
+        """
+        A copy of the lines in the buffer, in buffer order (as sent by the
+        data request)
+        """
+        with self.lock:
+            return self.buffer[:min(self.samples, self.max_lines)].copy()
+
+    def __repr__(self):
+        return ('<%s items=%d samples=%d max_lines=%d enabled=%s>' %
+                (self.__class__.__name__, len(self.types), self.samples,
+                 self.max_lines, self.enabled))
+
+
+def pack_packet(code, payload=b''):
+    """
+    (packet length) (code) (payload)
+    """
+    return struct.pack('>Ic', len(payload) + 1, code) + payload
+
+
+def delta_encode(data, samples):
+    """
+    Replace each 32-bit word of each line (but the first) by its difference
+    from the same word of the previous line
+    """
+    words = np.frombuffer(data, dtype='>u4').reshape(samples, -1).astype(np.uint32)
+    words[1:] -= words[:-1].copy()
+    return words.astype('>u4').tobytes()
+
+
+class GatherRequestHandler(socketserver.BaseRequestHandler):
+    """
+    Handles the commands of a single client, as gather_server does
+    """
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.phase = False
+        self.encoding = 0
+        self.zlib_level = 0
+        self._buf = b''
+        with self.server.stats_lock:
+            self.server.clients += 1
+            self.server.accepted += 1
+
+    def finish(self):
+        with self.server.stats_lock:
+            self.server.clients -= 1
+
+    @property
+    def gather(self):
+        if self.phase:
+            return self.server.phase
+        else:
+            return self.server.servo
+
+    def read_line(self):
+        """
+        Receive a line, or None upon disconnection
+
+        A line too long for gather_server is discarded (up to its end), and
+        LINE_TOO_LONG returned in its place
+        """
+        too_long = False
+        while b'\n' not in self._buf:
+            if len(self._buf) >= MAX_LINE_LENGTH:
+                too_long = True
+                self._buf = b''
+
+            received = self.request.recv(4096)
+            if not received:
+                return None
+
+            self._buf += received
+
+        line, self._buf = self._buf.split(b'\n', 1)
+        if too_long or len(line) >= MAX_LINE_LENGTH:
+            return LINE_TOO_LONG
+
+        return line.strip(b'\r').decode('ascii', 'replace')
+
+    def send(self, *packets):
+        data = b''.join(packets)
+        self.request.sendall(data)
+        with self.server.stats_lock:
+            self.server.bytes_sent += len(data)
+
+    def handle(self):
+        while True:
+            line = self.read_line()
+            if line is None:
+                return
+            elif line is LINE_TOO_LONG:
+                self.send(self.error_packet(ERR_LINE_TOO_LONG))
+                continue
+            elif not line:
+                continue
+
+            cmd, _, args = line.partition(' ')
+            request = cmd if cmd in REQUESTS[:-1] else 'unknown'
+
+            t0 = time.time()
+            getattr(self, 'request_%s' % request)(args)
+            self.server.request_done(request, time.time() - t0)
+
+    def error_packet(self, error_code):
+        return pack_packet(b'E', struct.pack('>I', error_code))
+
+    def types_packet(self, types):
+        return pack_packet(b'T', struct.pack('>B%dH' % len(types), len(types),
+                                             *types))
+
+    def lines_packet(self, samples, data):
+        """
+        Data packet (D), or encoded data packet (C) as requested by the
+        client
+        """
+        if not self.encoding or not data:
+            return pack_packet(b'D', struct.pack('>I', samples) + data)
+
+        raw_length = len(data)
+        if self.encoding & ENCODE_DELTA:
+            data = delta_encode(data, samples)
+
+        if self.encoding & ENCODE_ZLIB:
+            data = zlib.compress(data, self.zlib_level)
+
+        with self.server.stats_lock:
+            self.server.encoded_raw_bytes += raw_length
+            self.server.encoded_bytes += len(data)
+
+        return pack_packet(b'C', struct.pack('>III', samples, self.encoding,
+                                             raw_length) + data)
+
+    def data_packet(self):
+        lines = self.gather.get_lines()
+        return self.lines_packet(len(lines), lines.tobytes())
+
+    def metadata_packet(self):
+        gather = self.gather
+        server = self.server
+        n_items = len(gather.types)
+        return pack_packet(b'M', struct.pack(
+            '>6I2d2B%dH%dI' % (n_items, n_items),
+            gather.generation, gather.period, gather.max_samples,
+            gather.samples, gather.index, SHM_BASE,
+            server.servo_period, server.phase_over_servo, self.phase, n_items,
+            *(gather.types + gather.addresses)))
+
+    def request_servo(self, args):
+        self.phase = False
+        self.send(pack_packet(b'K'))
+
+    def request_phase(self, args):
+        self.phase = True
+        self.send(pack_packet(b'K'))
+
+    def request_types(self, args):
+        self.send(self.types_packet(self.gather.types))
+
+    def request_data(self, args):
+        self.send(self.data_packet())
+
+    def request_all(self, args):
+        if not self.gather.types:
+            self.send(self.types_packet(()))
+        else:
+            self.send(self.types_packet(self.gather.types), self.data_packet())
+
+    def request_meta(self, args):
+        self.send(self.metadata_packet())
+
+    def request_full(self, args):
+        self.send(self.metadata_packet(), self.data_packet())
+
+    def request_unknown(self, args):
+        self.send(self.error_packet(ERR_UNKNOWN_COMMAND))
+
+    def request_encoding(self, args):
+        try:
+            delta, level = [int(arg) for arg in args.split()]
+        except ValueError:
+            delta = level = -1
+
+        if delta not in (0, 1) or not (0 <= level <= 9):
+            self.send(self.error_packet(ERR_BAD_ARGUMENT))
+            return
+
+        self.encoding = ((ENCODE_DELTA if delta else 0) |
+                         (ENCODE_ZLIB if level else 0))
+        self.zlib_level = level
+        self.send(pack_packet(b'K'))
+
+    def request_stats(self, args):
+        self.send(pack_packet(b'R', self.server.get_stats().encode('ascii')))
+
+    def request_subset(self, args):
+        """
+        subset <first line> <line count> <step> <minmax> [item ...]
+        """
+        types = self.gather.types
+        try:
+            values = [int(arg) for arg in args.split()]
+        except ValueError:
+            values = []
+
+        if (len(values) < 4 or min(values) < 0 or values[2] == 0 or
+                values[3] > 1 or any(item >= len(types) for item in values[4:])):
+            self.send(self.error_packet(ERR_BAD_ARGUMENT))
+            return
+
+        first, count, step, minmax = values[:4]
+        items = values[4:] or list(range(len(types)))
+
+        lines = self.gather.get_lines()
+        available = len(lines)
+        if first >= available:
+            end = first
+        elif count == 0 or count > available - first:
+            end = available
+        else:
+            end = first + count
+
+        fields = ['f%d' % item for item in items]
+        out_dtype = get_line_dtype([types[item] for item in items])
+        selected = lines[first:end]
+        if not minmax:
+            selected = selected[::step]
+            out = np.zeros(len(selected), dtype=out_dtype)
+            for i, field in enumerate(fields):
+                out['f%d' % i] = selected[field]
+        else:
+            # The minimum then the maximum of each item, per block of lines
+            blocks = (len(selected) + step - 1) // step
+            out = np.zeros(2 * blocks, dtype=out_dtype)
+            for i, (item, field) in enumerate(zip(items, fields)):
+                column = selected[field]
+                min_lines, max_lines = block_extremes(
+                    get_values(types[item], column), step)
+                out['f%d' % i][0::2] = column[min_lines]
+                out['f%d' % i][1::2] = column[max_lines]
+
+        self.send(self.types_packet([types[item] for item in items]),
+                  self.lines_packet(len(out), out.tobytes()))
+
+    def request_wait(self, args):
+        """
+        wait <samples> <timeout ms> <start>
+
+        Wait until gathering is disabled or the given number of samples has
+        been gathered, then send the outcome, configuration and data
+        """
+        try:
+            samples, timeout_ms, start = [int(arg) for arg in args.split()]
+        except ValueError:
+            start = -1
+
+        if start not in (0, 1) or samples < 0 or timeout_ms < 0:
+            self.send(self.error_packet(ERR_BAD_ARGUMENT))
+            return
+
+        gather = self.gather
+        start_samples = gather.samples
+        need_start = (start == 1)
+        deadline = time.time() + timeout_ms * 1e-3
+        while True:
+            enabled, gathered = gather.enabled, gather.samples
+            if need_start and (enabled or gathered != start_samples):
+                need_start = False
+
+            outcome = None
+            if not need_start:
+                if samples and gathered >= samples:
+                    outcome = WAIT_SAMPLES
+                elif not enabled:
+                    outcome = WAIT_DISABLED
+
+            if outcome is None and timeout_ms and time.time() >= deadline:
+                outcome = WAIT_TIMEOUT
+
+            if outcome is not None:
+                break
+
+            # Any input ends the wait
+            readable, _, _ = select.select([self.request], [], [], STREAM_POLL)
+            if readable:
+                if self.read_line() is None:
+                    return
+                outcome = WAIT_CANCELLED
+                break
+
+        packets = [pack_packet(b'W', struct.pack('>II', outcome,
+                                                 gather.samples))]
+        if outcome in (WAIT_DISABLED, WAIT_SAMPLES):
+            packets.extend([self.metadata_packet(), self.data_packet()])
+
+        self.send(*packets)
+
+    def request_cancel(self, args):
+        # Not waiting (or the wait already ended), nor sending snapshots
+        self.send(pack_packet(b'K'))
+
+    def snapshot_packet(self, number, addresses, sizes):
+        self.server.store_gathered()
+        values = b''.join(self.server.read_memory(addr, size)
+                          for addr, size in zip(addresses, sizes))
+        return pack_packet(b'V', struct.pack('>II', number,
+                                             self.server.servo_count) + values)
+
+    def request_snapshot(self, args):
+        """
+        snapshot <interval us> <count> <type> <address> [<type> <address> ...]
+
+        The current values of the addresses, once or every interval until
+        count snapshots are sent (0 for no limit) or the client sends
+        anything, then the number sent
+        """
+        tokens = args.split()
+        try:
+            interval_us, count = [int(arg) for arg in tokens[:2]]
+            types = [int(arg) for arg in tokens[2::2]]
+            addresses = [int(arg, 16) for arg in tokens[3::2]]
+        except ValueError:
+            tokens = []
+
+        if (len(tokens) < 4 or len(tokens) % 2 or interval_us < 0 or
+                count < 0 or len(types) > MAX_ITEMS or
+                not all(valid_gather_type(type_) for type_ in types)):
+            self.send(self.error_packet(ERR_BAD_ARGUMENT))
+            return
+
+        sizes = [8 if type_ == DOUBLE else 4 for type_ in types]
+        if not all(self.server.valid_address(addr, size)
+                   for addr, size in zip(addresses, sizes)):
+            self.send(self.error_packet(ERR_BAD_ADDRESS))
+            return
+
+        if count == 1:
+            self.send(self.snapshot_packet(0, addresses, sizes))
+            return
+
+        interval = interval_us * 1e-6
+        next_time = time.time()
+        sent = 0
+        while True:
+            self.send(self.snapshot_packet(sent, addresses, sizes))
+            sent += 1
+            if count and sent >= count:
+                break
+
+            next_time += interval
+            now = time.time()
+            if next_time < now:
+                # Fell behind; skip ahead rather than send a burst
+                next_time = now + interval
+
+            # Any input ends the snapshots
+            readable, _, _ = select.select([self.request], [], [],
+                                           max(next_time - now, STREAM_POLL))
+            if readable:
+                if self.read_line() is None:
+                    return
+                break
+
+        self.send(pack_packet(b'Z', struct.pack('>I', sent)))
+
+    def request_stream(self, args):
+        """
+        Types, then newly gathered lines as they are acquired until gathering
+        is disabled or the client sends anything, then the line count
+
+        Each chunk carries the sample number of its first line. A client
+        which falls so far behind that lines are overwritten before they are
+        sent gets an overrun error in place of the line count.
+        """
+        gather = self.gather
+        self.send(self.types_packet(gather.types))
+        max_lines = gather.max_lines
+        sent = 0
+        if not gather.types or not max_lines:
+            self.send(pack_packet(b'Z', struct.pack('>I', sent)))
+            return
+
+        if gather.samples < max_lines:
+            next_sample = 0
+        else:
+            next_sample = gather.samples
+
+        line = None
+        while True:
+            # Check before reading the samples, so that the final lines are
+            # sent before stopping
+            enabled = gather.enabled
+            with gather.lock:
+                samples = gather.samples
+                lines = samples - next_sample
+                if 0 < lines < max_lines:
+                    next_line = next_sample % max_lines
+                    index = samples % max_lines
+                    if next_line < index:
+                        data = gather.buffer[next_line:index].tobytes()
+                    else:
+                        data = (gather.buffer[next_line:].tobytes() +
+                                gather.buffer[:index].tobytes())
+
+            if not 0 <= lines < max_lines:
+                self.send(self.error_packet(ERR_OVERRUN))
+                return
+            elif lines:
+                self.send(pack_packet(b'S', struct.pack('>II', next_sample,
+                                                        lines) + data))
+                next_sample = samples
+                sent += lines
+
+            if not enabled:
+                break
+
+            # Any input stops the stream
+            readable, _, _ = select.select([self.request], [], [], STREAM_POLL)
+            if readable:
+                line = self.read_line()
+                if line is None:
+                    return
+                break
+
+        packets = [pack_packet(b'Z', struct.pack('>I', sent))]
+        if line == 'cancel':
+            # Acknowledged, as it would be once the stream has ended
+            packets.append(pack_packet(b'K'))
+
+        self.send(*packets)
+
+
+class SimulatedServer(socketserver.ThreadingTCPServer):
+    """
+    Simulated fast_gather server, with a servo and a phase gather buffer
+    (by default, a synthetic servo gather and an empty phase gather)
+
+    Use port 0 to pick a free port (see `port`), and serve_forever() in a
+    thread (or start()) to serve clients.
+
+    Snapshots read the simulated shared memory (see read_memory), where the
+    gathered addresses hold their most recently gathered values (see
+    store_gathered).
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host_port=('127.0.0.1', config.fast_gather_port),
+                 servo=None, phase=None, servo_period=0.442673749446658,
+                 phase_over_servo=0.25):
+        if servo is None:
+            servo = SimulatedGather()
+            servo.acquire(servo.max_lines)
+
+        if phase is None:
+            phase = SimulatedGather(types=(), max_lines=0)
+
+        self.servo = servo
+        self.phase = phase
+        self.servo_period = servo_period
+        self.phase_over_servo = phase_over_servo
+        self.shm = bytearray(SHM_SIZE)
+
+        self.stats_lock = threading.Lock()
+        self.started = time.time()
+        self.clients = 0
+        self.accepted = 0
+        self.bytes_sent = 0
+        self.encoded_raw_bytes = 0
+        self.encoded_bytes = 0
+        self.requests = dict((request, [0, 0.0, 0.0]) for request in REQUESTS)
+        self._thread = None
+
+        socketserver.ThreadingTCPServer.__init__(self, host_port,
+                                                 GatherRequestHandler)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        """
+        Serve clients from a background thread
+        """
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.servo.stop()
+        self.phase.stop()
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def servo_count(self):
+        """
+        Sys.ServoCount: servo cycles since the server started
+        """
+        elapsed = time.time() - self.started
+        return int(elapsed / (self.servo_period * 1e-3)) & 0xFFFFFFFF
+
+    def valid_address(self, addr, size):
+        """
+        Whether an item of `size` bytes at `addr` lies within the shared
+        memory structure (and is word-aligned)
+        """
+        return (addr % 4 == 0 and addr >= SHM_BASE and
+                addr - SHM_BASE <= SHM_SIZE - size)
+
+    def write_memory(self, addr, data):
+        """
+        Write (big-endian) data to the simulated shared memory
+        """
+        offset = addr - SHM_BASE
+        self.shm[offset:offset + len(data)] = data
+
+    def store_gathered(self):
+        """
+        Store the most recently gathered value of each gathered address in
+        the simulated shared memory
+        """
+        for gather in (self.servo, self.phase):
+            with gather.lock:
+                if not gather.samples or not gather.max_lines:
+                    continue
+
+                # (a slice of the buffer keeps its big-endian byte order)
+                index = (gather.samples - 1) % gather.max_lines
+                line = gather.buffer[index:index + 1]
+                for i, item_addr in enumerate(gather.addresses):
+                    data = line['f%d' % i].tobytes()
+                    if self.valid_address(item_addr, len(data)):
+                        self.write_memory(item_addr, data)
+
+    def read_memory(self, addr, size):
+        """
+        Read (big-endian) data from the simulated shared memory
+        """
+        offset = addr - SHM_BASE
+        return bytes(self.shm[offset:offset + size])
+
+    def request_done(self, request, elapsed):
+        us = elapsed * 1e6
+        with self.stats_lock:
+            stats = self.requests[request]
+            stats[0] += 1
+            stats[1] += us
+            stats[2] = max(stats[2], us)
+
+    def get_stats(self):
+        """
+        Request statistics as text, one key=value per line
+        """
+        with self.stats_lock:
+            lines = ['uptime_s=%.3f' % (time.time() - self.started),
+                     'clients=%d' % self.clients,
+                     'accepted=%d' % self.accepted,
+                     'bytes_sent=%d' % self.bytes_sent,
+                     'encoded_raw_bytes=%d' % self.encoded_raw_bytes,
+                     'encoded_bytes=%d' % self.encoded_bytes,
+                     ]
+            for request in REQUESTS:
+                count, total_us, max_us = self.requests[request]
+                lines.extend(['%s.count=%d' % (request, count),
+                              '%s.mean_us=%.1f' % (request, total_us / count
+                                                   if count else 0.0),
+                              '%s.max_us=%.1f' % (request, max_us)])
+
+        return ''.join('%s\n' % line for line in lines)
+
+
+def main(fn=None, host='127.0.0.1', port=config.fast_gather_port,
+         samples=100000, max_lines=None, rate=0.0):
+    if fn is not None:
+        servo = SimulatedGather.from_file(fn)
+    else:
+        servo = SimulatedGather(max_lines=max_lines or samples)
+        if not rate:
+            servo.acquire(samples)
+
+    if rate:
+        servo.start(rate=rate, max_samples=samples)
+
+    server = SimulatedServer((host, port), servo=servo)
+    print('Serving %r on %s:%d' % (servo, host, server.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servo.stop()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='simulated fast_gather server')
+    parser.add_argument('file', nargs='?',
+                        help='Recorded gather buffer (default: synthetic)')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to bind')
+    parser.add_argument('-p', '--port', type=int,
+                        default=config.fast_gather_port, help='Port')
+    parser.add_argument('-n', '--samples', type=int, default=100000,
+                        help='Samples to gather (synthetic)')
+    parser.add_argument('-l', '--max-lines', type=int,
+                        help='Buffer size in lines (default: samples)')
+    parser.add_argument('-r', '--rate', type=float, default=0.0,
+                        help='Gather continuously at this many lines per '
+                             'second (default: all samples up front)')
+
+    args = parser.parse_args()
+    main(args.file, host=args.host, port=args.port, samples=args.samples,
+         max_lines=args.max_lines, rate=args.rate)
@@ -24,6 +24,8 @@ import numpy as np
 from . import pp_comm
 from .pp_comm import vlog
 from .util import InsList
+from .gather_result import GatherResult
+from .fast_gather import GatherTimeoutError
 
 
 logger = logging.getLogger(__name__)
@@ -31,6 +33,46 @@ logger = logging.getLogger(__name__)
 max_samples = 0x7FFFFFFF
 gather_config_file = '/var/ftp/gather/GatherSetting.txt'
 gather_output_file = '/var/ftp/gather/GatherFile.txt'
+# Seconds allowed for a motion program to start and stop gathering, beyond
+# the time taken to fill the gather buffer (see run_and_gather)
+run_timeout_margin = 10.0
+
+# Gather structure elements configuring the servo and phase gathers
+SERVO_GATHER_VARS = {'enable': 'gather.enable',
+                     'addr': 'gather.addr',
+                     'items': 'gather.items',
+                     'period': 'gather.period',
+                     'max_samples': 'gather.maxsamples',
+                     'max_lines': 'gather.maxlines',
+                     'samples': 'gather.samples',
+                     }
+
+PHASE_GATHER_VARS = {'enable': 'gather.phaseenable',
+                     'addr': 'gather.phaseaddr',
+                     'items': 'gather.phaseitems',
+                     'period': 'gather.phaseperiod',
+                     'max_samples': 'gather.phasemaxsamples',
+                     'max_lines': 'gather.phasemaxlines',
+                     'samples': 'gather.phasesamples',
+                     }
+
+
+def get_gather_vars(phase=False):
+    """
+    Gather structure elements of the servo (or phase) gather
+    """
+    if phase:
+        return PHASE_GATHER_VARS
+    return SERVO_GATHER_VARS
+
+
+def get_clock_period(gpascii, phase=False):
+    """
+    Period of the clock the servo (or phase) gather samples on, in seconds
+    """
+    if phase:
+        return gpascii.phase_period
+    return gpascii.servo_period
 
 
 def get_sample_count(servo_period, gather_period, duration):
@@ -50,22 +92,29 @@ def get_duration(servo_period, gather_period, samples):
 
 
 def get_settings(servo_period, addresses=[], gather_period=1, duration=2.0,
-                 samples=None):
+                 samples=None, phase=False):
+    """
+    Gather configuration lines
 
+    servo_period: the clock period, in seconds (for phase gathers, the
+                  phase period)
+    phase: configure the phase gather (Gather.PhaseAddr[], etc.)
+    """
     if samples is not None:
         duration = get_duration(servo_period, gather_period, samples)
     else:
         samples = get_sample_count(servo_period, gather_period, duration)
 
-    yield 'gather.enable=0'
+    vars_ = get_gather_vars(phase)
+    yield '%s=0' % vars_['enable']
     for i, addr in enumerate(addresses):
-        yield 'gather.addr[%d]=%s' % (i, addr)
+        yield '%s[%d]=%s' % (vars_['addr'], i, addr)
 
-    yield 'gather.items=%d' % len(addresses)
-    yield 'gather.Period=%d' % gather_period
-    yield 'gather.enable=1'
-    yield 'gather.enable=0'
-    yield 'gather.MaxSamples=%d' % samples
+    yield '%s=%d' % (vars_['items'], len(addresses))
+    yield '%s=%d' % (vars_['period'], gather_period)
+    yield '%s=1' % vars_['enable']
+    yield '%s=0' % vars_['enable']
+    yield '%s=%d' % (vars_['max_samples'], samples)
 
 
 def read_settings_file(comm, fn=None):
@@ -101,15 +150,18 @@ def read_settings_file(comm, fn=None):
             else:
                 settings[var] = value
 
-    if 'gather.addr' in settings:
-        addr_dict = settings['gather.addr']
+    for key in (SERVO_GATHER_VARS['addr'], PHASE_GATHER_VARS['addr']):
+        if key not in settings:
+            continue
+
+        addr_dict = settings[key]
         # addresses comes in as a dictionary of {index: value}
         max_addr = max(addr_dict.keys())
         addr_list = InsList(['']) * (max_addr + 1)
         for index, value in addr_dict.items():
             addr_list[index] = value
 
-        settings['gather.addr'] = addr_list
+        settings[key] = addr_list
 
     return settings
 
@@ -134,30 +186,25 @@ def parse_gather(addresses, lines, delim=' '):
     return data
 
 
-def setup_gather(gpascii, addresses, duration=0.1, period=1,
-                 output_file=gather_output_file):
+def _write_settings(gpascii, settings):
     comm = gpascii._comm
-
-    servo_period = gpascii.servo_period
-
-    total_samples = get_sample_count(servo_period, period, duration)
-
-    settings = get_settings(servo_period, addresses, duration=duration,
-                            gather_period=period)
-
-    settings = '\n'.join(settings)
-
-    comm.write_file(gather_config_file, settings)
+    comm.write_file(gather_config_file, '\n'.join(settings))
 
     logger.debug('Wrote configuration to: %s', gather_config_file)
 
     comm.gpascii_file(gather_config_file)
 
-    max_lines = gpascii.get_variable('gather.maxlines', type_=int)
+
+def _limit_samples(gpascii, clock_period, period, total_samples, phase=False):
+    """
+    Limit the samples to what fits in the gather buffer
+    """
+    vars_ = get_gather_vars(phase)
+    max_lines = gpascii.get_variable(vars_['max_lines'], type_=int)
     if max_lines < total_samples:
         total_samples = max_lines
-        duration = get_duration(servo_period, period, total_samples)
-        gpascii.set_variable('gather.maxsamples', total_samples)
+        duration = get_duration(clock_period, period, total_samples)
+        gpascii.set_variable(vars_['max_samples'], total_samples)
 
         logger.warning('* Warning: Buffer not large enough.')
         logger.warning('  Maximum count with the current addresses: %d',
@@ -167,19 +214,69 @@ def setup_gather(gpascii, addresses, duration=0.1, period=1,
     return total_samples
 
 
+def _check_fast_gather(comm, phase):
+    if phase and comm.fast_gather is None:
+        raise ValueError('Phase gathers require the fast_gather server')
+
+
+def setup_gather(gpascii, addresses, duration=0.1, period=1,
+                 output_file=gather_output_file, phase=False):
+    """
+    Configure the servo (or, with `phase` set, the phase) gather
+
+    Returns the number of samples to be gathered
+    """
+    clock_period = get_clock_period(gpascii, phase)
+
+    total_samples = get_sample_count(clock_period, period, duration)
+
+    settings = get_settings(clock_period, addresses, duration=duration,
+                            gather_period=period, phase=phase)
+
+    _write_settings(gpascii, settings)
+    return _limit_samples(gpascii, clock_period, period, total_samples,
+                          phase=phase)
+
+
 def gather(gpascii, addresses, duration=0.1, period=1,
-           output_file=gather_output_file, verbose=True, f=sys.stdout):
+           output_file=gather_output_file, verbose=True, f=sys.stdout,
+           phase=False):
+    """
+    Gather `addresses` for `duration` seconds, every `period` servo (or,
+    with `phase` set, phase) cycles
+
+    Phase gathers require the fast_gather server.
+    """
+    comm = gpascii._comm
+    _check_fast_gather(comm, phase)
 
     total_samples = setup_gather(gpascii, addresses, duration=duration,
-                                 period=period, output_file=output_file)
+                                 period=period, output_file=output_file,
+                                 phase=phase)
 
-    gpascii.set_variable('gather.enable', 2)
+    vars_ = get_gather_vars(phase)
+    gpascii.set_variable(vars_['enable'], 2)
     samples = 0
 
     logger.info('Waiting for %d samples', total_samples)
+    if comm.fast_gather is not None:
+        # The server replies with the data once the samples are gathered
+        try:
+            result = wait_for_gather_results(comm, addresses,
+                                             samples=total_samples,
+                                             phase=phase)
+        except KeyboardInterrupt:
+            result = None
+
+        gpascii.set_variable(vars_['enable'], 0)
+        if result is not None:
+            return result
+
+        return get_gather_results(comm, addresses, output_file, phase=phase)
+
     try:
         while samples < total_samples:
-            samples = gpascii.get_variable('gather.samples', type_=int)
+            samples = gpascii.get_variable(vars_['samples'], type_=int)
             if total_samples != 0 and verbose:
                 percent = 100. * (float(samples) / total_samples)
                 print('%-6d/%-6d (%.2f%%)' % (samples, total_samples,
@@ -193,8 +290,6 @@ def gather(gpascii, addresses, duration=0.1, period=1,
         print(file=f)
 
     gpascii.set_variable('gather.enable', 0)
-
-    comm = gpascii._comm
     return get_gather_results(comm, addresses, output_file)
 
 
@@ -202,6 +297,9 @@ def get_columns(all_columns, data, *to_get):
     if data is None or len(data) == 0:
         return [np.zeros(1) for col in to_get]
 
+    if isinstance(data, GatherResult):
+        return [data.column(col) for col in to_get]
+
     if isinstance(data, list):
         data = np.array(data)
 
@@ -282,40 +380,88 @@ def get_addr_index(addresses, addr):
             return addresses.index(addr)
 
 
-def _check_times(gpascii, addresses, rows):
-    if rows is None or len(rows) == 0:
-        return rows
+def get_phase_times(servo_counts, servo_period, sample_period):
+    """
+    Times of the samples of a phase gather, in seconds, on the time base of
+    servo gathers (Sys.ServoCount * servo period)
+
+    Sys.ServoCount only changes once per servo cycle, so the samples (which
+    are evenly spaced) could have started anywhere from the earliest to the
+    latest time consistent with each sample having been taken during the
+    servo cycle it reported. They are placed in the middle of that range (or
+    at its earliest, should the counts be inconsistent with the spacing).
+    """
+    offsets = np.arange(len(servo_counts)) * sample_period
+    earliest = np.max(servo_counts * servo_period - offsets)
+    latest = np.min((servo_counts + 1) * servo_period - offsets)
+    start = earliest + max(0.0, latest - earliest) / 2.0
+    return start + offsets
 
-    if 'Sys.ServoCount.a' in addresses:
-        idx = get_addr_index(addresses, 'Sys.ServoCount.a')
-        servo_period = gpascii.servo_period
 
-        times = [row[idx] for row in rows]
-        if isinstance(rows[0], tuple):
-            # TODO fast gather returns list of tuples
-            rows = [list(row) for row in rows]
+def _check_times(gpascii, addresses, result, phase=False):
+    """
+    Fill in the time axis metadata of a GatherResult (unless already known),
+    and convert its Sys.ServoCount column (if gathered) to time in seconds
 
-        gather_period = gpascii.get_variable('gather.period', type_=int)
-        if 0 in times:
-            # This happens when the gather buffer rolls over, iirc
-            logger.warning('Gather data issue, trimming data...')
-            last_time = times.index(0)
+    Results from the fast_gather server carry the periods from its
+    GatherMetadata, so gpascii is only queried (once, for all of them) for
+    results read back by other means.
+    """
+    if result is None or len(result) == 0:
+        return result
+
+    if result.servo_period is None or (phase and
+                                       result.phase_over_servo is None):
+        def raise_error(var, ex):
+            raise ex
 
-            times = np.arange(0, len(rows) * gather_period, gather_period)
+        vars_ = get_gather_vars(phase)
+        servo_period, gather_period, phase_over_servo = gpascii.get_variables(
+            ['Sys.ServoPeriod', vars_['period'], 'Sys.PhaseOverServoPeriod'],
+            type_=float, error_cb=raise_error)
 
-            rows = rows[:last_time]
+        if result.servo_period is None:
+            result.servo_period = servo_period * 1e-3
+            result.gather_period = int(gather_period)
+        if phase and result.phase_over_servo is None:
+            result.phase_over_servo = phase_over_servo
 
-        for row, t0 in zip(rows, times):
-            row[idx] = t0 * servo_period
+    servo_period = result.servo_period
+    gather_period = result.gather_period
+
+    if 'Sys.ServoCount.a' in addresses:
+        idx = result.index('Sys.ServoCount.a')
+        times = result.columns[idx]
 
-    return rows
+        zeros = np.flatnonzero(times == 0)
+        if len(zeros):
+            # This happens when the gather buffer rolls over, iirc
+            logger.warning('Gather data issue, trimming data...')
+            result = result[:zeros[0]]
+            times = np.arange(0, len(result) * gather_period, gather_period)
+            result.columns[idx] = times * result.clock_period
+        elif result.phase:
+            result.columns[idx] = get_phase_times(times, servo_period,
+                                                  result.sample_period)
+        else:
+            result.columns[idx] = times * servo_period
 
+    return result
 
-def get_gather_results(comm, addresses, output_file=gather_output_file):
+
+def get_gather_results(comm, addresses, output_file=gather_output_file,
+                       phase=False):
+    """
+    Get the results of the most recent servo (or phase) gather
+
+    Phase gathers require the fast_gather server.
+    """
+    _check_fast_gather(comm, phase)
     if comm.fast_gather is not None:
-        # Use the 'fast gather' server
+        # Use the 'fast gather' server, which also reports the periods
         client = comm.fast_gather
-        rows = client.get_rows()
+        with client.phase_mode(phase):
+            metadata, result = client.get_full_result(addresses)
     else:
         # Use the Delta Tau-supplied 'gather' program
 
@@ -324,8 +470,184 @@ def get_gather_results(comm, addresses, output_file=gather_output_file):
 
         lines = [line.strip() for line in comm.read_file(output_file)]
         rows = parse_gather(addresses, lines)
+        result = GatherResult.from_rows(addresses, rows)
 
-    return _check_times(comm.gpascii, addresses, rows)
+    return _check_times(comm.gpascii, addresses, result, phase=phase)
+
+
+def wait_for_gather_results(comm, addresses, samples=0, wait_start=False,
+                            timeout=None, phase=False, start=None):
+    """
+    Wait for the gather to complete using the fast_gather server, which
+    replies with the data as soon as it does, rather than polling the gather
+    state over gpascii
+
+    samples: wait for this many samples (default: until gathering is
+             disabled)
+    wait_start: gathering is yet to be enabled (e.g., by a motion program)
+    phase: wait for the phase gather
+    start: called once the wait has begun (e.g., to start that program)
+
+    Returns the GatherResult, as get_gather_results. See
+    GatherClient.wait_full_result for the exceptions raised.
+    """
+    client = comm.fast_gather
+    with client.phase_mode(phase):
+        metadata, result = client.wait_full_result(samples=samples,
+                                                   timeout=timeout,
+                                                   wait_start=wait_start,
+                                                   addresses=addresses,
+                                                   start=start)
+    return _check_times(comm.gpascii, addresses, result, phase=phase)
+
+
+def _with_servo_count(addresses):
+    addresses = InsList(addresses)
+    if 'sys.servocount.a' not in addresses:
+        addresses.insert(0, 'Sys.ServoCount.a')
+    return addresses
+
+
+def gather_servo_and_phase(gpascii, servo_addresses, phase_addresses,
+                           duration=0.1, servo_period=1, phase_period=1,
+                           timeout=None):
+    """
+    Run a servo and a phase gather simultaneously, using the fast_gather
+    server
+
+    Sys.ServoCount is added to both sets of addresses (if not already
+    there), and their times are converted to a common time base (see
+    _check_times), such that `result.time` of either gather may be plotted
+    against the other, or the phase data resampled with
+    resample_phase_result.
+
+    servo_period, phase_period: gather every this many servo and phase
+                                cycles
+    timeout: give up waiting for the gathers after this many seconds
+
+    Returns: (servo GatherResult, phase GatherResult)
+    """
+    comm = gpascii._comm
+    _check_fast_gather(comm, True)
+
+    servo_addresses = _with_servo_count(servo_addresses)
+    phase_addresses = _with_servo_count(phase_addresses)
+
+    servo_clock = get_clock_period(gpascii)
+    phase_clock = get_clock_period(gpascii, phase=True)
+    servo_samples = get_sample_count(servo_clock, servo_period, duration)
+    phase_samples = get_sample_count(phase_clock, phase_period, duration)
+
+    settings = (list(get_settings(servo_clock, servo_addresses,
+                                  gather_period=servo_period,
+                                  samples=servo_samples)) +
+                list(get_settings(phase_clock, phase_addresses,
+                                  gather_period=phase_period,
+                                  samples=phase_samples, phase=True)))
+    _write_settings(gpascii, settings)
+
+    servo_samples = _limit_samples(gpascii, servo_clock, servo_period,
+                                   servo_samples)
+    phase_samples = _limit_samples(gpascii, phase_clock, phase_period,
+                                   phase_samples, phase=True)
+
+    # Both assignments are packed into one line, so the gathers start
+    # together
+    enables = [SERVO_GATHER_VARS['enable'], PHASE_GATHER_VARS['enable']]
+    gpascii.set_variables([(var, 2) for var in enables], check=False)
+    try:
+        servo_result = wait_for_gather_results(comm, servo_addresses,
+                                               samples=servo_samples,
+                                               timeout=timeout)
+        phase_result = wait_for_gather_results(comm, phase_addresses,
+                                               samples=phase_samples,
+                                               timeout=timeout, phase=True)
+    finally:
+        gpascii.set_variables([(var, 0) for var in enables], check=False)
+
+    return servo_result, phase_result
+
+
+def resample_phase_result(phase_result, servo_result):
+    """
+    Resample (by linear interpolation) phase gather data onto the time axis
+    of a simultaneous servo gather, as from gather_servo_and_phase
+
+    Only servo samples within the span of the phase gather are kept.
+
+    Returns: GatherResult with the servo time axis (as Sys.ServoCount.a) and
+             the remaining phase gather columns
+    """
+    phase_time = phase_result.time
+    servo_time = servo_result.time
+    in_span = ((servo_time >= phase_time[0]) &
+               (servo_time <= phase_time[-1]))
+    times = servo_time[in_span]
+
+    addresses = ['Sys.ServoCount.a']
+    columns = [times]
+    for addr, column in phase_result.items():
+        if addr.lower() != 'sys.servocount.a':
+            addresses.append(addr)
+            columns.append(np.interp(times, phase_time, column))
+
+    return GatherResult(addresses, columns,
+                        servo_period=servo_result.servo_period,
+                        gather_period=servo_result.gather_period)
+
+
+def get_fast_gather_results(comm, settings_file=None, address_index=None,
+                            phase=False):
+    """
+    Get the results of the most recent gather from the fast_gather server,
+    along with the gather settings
+
+    The server reports the gather configuration along with the data, so the
+    settings file is only read (for the descriptive addresses) when the
+    configuration has changed since it was last read, or when `settings_file`
+    is specified. If an `address_index` (see ppmac.address_index) is given
+    and knows all of the gathered addresses, the file is not read at all.
+
+    phase: get the results of the phase gather
+
+    Returns: (settings dictionary, as from read_settings_file, GatherResult)
+    """
+    client = comm.fast_gather
+    with client.phase_mode(phase):
+        metadata, result = client.get_full_result()
+
+    vars_ = get_gather_vars(phase)
+
+    addresses = client.address_cache.get(metadata.generation)
+    if (addresses is None and settings_file is None and
+            address_index is not None and
+            all(addr in address_index for addr in metadata.addresses)):
+        addresses = address_index.label(metadata.addresses)
+        client.address_cache[metadata.generation] = addresses
+
+    if addresses is None or settings_file is not None:
+        settings = read_settings_file(comm, settings_file)
+        if vars_['addr'] not in settings:
+            raise KeyError('%s: Unable to read addresses from settings file '
+                           '(%s)' % (vars_['addr'], settings_file))
+
+        addresses = settings[vars_['addr']]
+        if len(addresses) != len(metadata.types):
+            raise RuntimeError('Gather settings file has %d addresses, but %d '
+                               'were gathered (wrong file?)' %
+                               (len(addresses), len(metadata.types)))
+
+        client.address_cache[metadata.generation] = addresses
+    else:
+        settings = {vars_['addr']: addresses,
+                    vars_['items']: str(len(addresses)),
+                    vars_['period']: str(metadata.period),
+                    vars_['max_samples']: str(metadata.max_samples),
+                    }
+
+    result.addresses = InsList(addresses)
+    return settings, _check_times(comm.gpascii, addresses, result,
+                                  phase=phase)
 
 
 def gather_data_to_file(fn, addr, data, delim='\t'):
@@ -343,13 +665,15 @@ def gather_data_from_file(fn, delim='\t'):
 
         lines = [line.strip() for line in f.readlines()]
 
-    return addresses, parse_gather(addresses, lines, delim=delim)
+    rows = parse_gather(addresses, lines, delim=delim)
+    return addresses, GatherResult.from_rows(addresses, rows)
 
 
 def plot(addr, data):
     x_idx = get_addr_index(addr, 'Sys.ServoCount.a')
 
-    data = np.array(data)
+    if not isinstance(data, GatherResult):
+        data = np.array(data)
     x_axis = data[:, x_idx] - data[0, x_idx]
     for i in range(len(addr)):
         if i == x_idx:
@@ -363,12 +687,13 @@ def plot(addr, data):
     plt.show()
 
 
-def gather_and_plot(gpascii, addr, duration=0.2, period=1):
+def gather_and_plot(gpascii, addr, duration=0.2, period=1, phase=False):
     servo_period = gpascii.servo_period
     logger.debug('Servo period is %g (%g KHz)', servo_period,
                  1.0 / (servo_period * 1000))
 
-    data = gather(gpascii, addr, duration=duration, period=period)
+    data = gather(gpascii, addr, duration=duration, period=period,
+                  phase=phase)
     gather_data_to_file('test.txt', addr, data)
     plot(addr, data)
 
@@ -497,9 +822,16 @@ def geterrors_motor(motor, time_=0.3, abort_cmd='', m_mask=0x7ac, c_mask=0x7ac,
 def run_and_gather(gpascii, script_text, prog=999, coord_sys=0,
                    gather_vars=[], period=1, samples=max_samples,
                    cancel_callback=None, check_active=False,
-                   verbose=True):
+                   verbose=True, timeout=None):
     """
     Run a motion program and read back the gathered data
+
+    timeout: give up waiting for the program after this many seconds
+             (default: the time taken to fill the gather buffer, plus
+             run_timeout_margin)
+
+    Raises pp_comm.TimeoutError (or fast_gather.GatherTimeoutError, with the
+    fast_gather server) after stopping the program, on timeout.
     """
 
     if 'gather.enable' not in script_text.lower():
@@ -511,10 +843,7 @@ def run_and_gather(gpascii, script_text, prog=999, coord_sys=0,
     comm = gpascii._comm
     gpascii.set_variable('gather.enable', '0')
 
-    gather_vars = InsList(gather_vars)
-
-    if 'sys.servocount.a' not in gather_vars:
-        gather_vars.insert(0, 'Sys.ServoCount.a')
+    gather_vars = _with_servo_count(gather_vars)
 
     settings = get_settings(gpascii.servo_period, gather_vars,
                             gather_period=period,
@@ -528,10 +857,17 @@ def run_and_gather(gpascii, script_text, prog=999, coord_sys=0,
 
     comm.gpascii_file(gather_config_file, verbose=verbose)
 
+    if timeout is None:
+        max_lines = gpascii.get_variable('gather.maxlines', type_=int)
+        timeout = (get_duration(gpascii.servo_period, period,
+                                min(samples, max_lines)) +
+                   run_timeout_margin)
+
     for line in script_text.split('\n'):
         gpascii.send_line(line.lstrip())
 
-    gpascii.program(coord_sys, prog, start=True)
+    def start_program():
+        gpascii.program(coord_sys, prog, start=True)
 
     if check_active:
         active_var = 'Coord[%d].ProgActive' % coord_sys
@@ -541,16 +877,35 @@ def run_and_gather(gpascii, script_text, prog=999, coord_sys=0,
     def get_status():
         return gpascii.get_variable(active_var, type_=int)
 
+    def check_timeout():
+        if time.time() > deadline:
+            raise pp_comm.TimeoutError('Program %d did not complete in %g s'
+                                       % (prog, timeout))
+
+    data = None
     try:
         # time.sleep(1.0 + abs((iterations * distance) / velocity))
         vlog(verbose, "Waiting...")
-        while get_status() == 0:
-            time.sleep(0.1)
-
-        while get_status() != 0:
-            samples = gpascii.get_variable('gather.samples', type_=int)
-            vlog(verbose, "Working... got %6d data points" % samples, end='\r')
-            time.sleep(0.1)
+        if comm.fast_gather is not None and not check_active:
+            # The server replies with the data once the program has enabled
+            # and then disabled gathering. The wait is sent before the
+            # program is started, so that even a short gather is seen.
+            data = wait_for_gather_results(comm, gather_vars,
+                                           wait_start=True, timeout=timeout,
+                                           start=start_program)
+        else:
+            start_program()
+            deadline = time.time() + timeout
+            while get_status() == 0:
+                check_timeout()
+                time.sleep(0.1)
+
+            while get_status() != 0:
+                check_timeout()
+                samples = gpascii.get_variable('gather.samples', type_=int)
+                vlog(verbose, "Working... got %6d data points" % samples,
+                     end='\r')
+                time.sleep(0.1)
 
         vlog(verbose, 'Done')
 
@@ -559,6 +914,10 @@ def run_and_gather(gpascii, script_text, prog=999, coord_sys=0,
         gpascii.program(coord_sys, prog, stop=True)
         if cancel_callback is not None:
             cancel_callback(ex)
+    except (pp_comm.TimeoutError, GatherTimeoutError):
+        vlog(verbose, 'Timed out - stopping program')
+        gpascii.program(coord_sys, prog, stop=True)
+        raise
 
     try:
         for line in gpascii.read_timeout(timeout=0.1):
@@ -569,7 +928,8 @@ def run_and_gather(gpascii, script_text, prog=999, coord_sys=0,
     except pp_comm.TimeoutError:
         pass
 
-    data = get_gather_results(comm, gather_vars, gather_output_file)
+    if data is None:
+        data = get_gather_results(comm, gather_vars, gather_output_file)
     return gather_vars, data
 
 
@@ -0,0 +1,195 @@
+"""
+:mod:`ppmac.gather_result` -- Columnar gather data
+==================================================
+
+.. module:: ppmac.gather_result
+   :synopsis: GatherResult holds gathered data as one numpy array per
+              address, looked up by (case-insensitive) address name, along
+              with the servo and gather periods needed for its time axis.
+.. moduleauthor:: Ken Lauer <klauer@bnl.gov>
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+from .util import InsList
+
+
+class GatherResult(object):
+    """
+    Gathered data, stored per address (column) as 1D numpy arrays
+
+    Columns may be accessed by index or by address name (with or without
+    the trailing '.a'):
+        result['Motor[1].ActPos']  # -> column array
+        result[0]                  # -> first row (sample), as a tuple
+        result[10:20]              # -> GatherResult of views of each column
+        result[:, 'Motor[1].ActPos'] or result[:, 1]
+
+    For compatibility with code expecting a 2D array of rows, `len()` is the
+    number of samples, iterating yields rows, and `np.asarray(result)` stacks
+    the columns into a (samples, addresses) array.
+
+    Phase gathers are sampled on the phase clock, which runs
+    1 / phase_over_servo times as fast as the servo clock.
+    """
+    def __init__(self, addresses, columns, servo_period=None,
+                 gather_period=1, phase_over_servo=None):
+        self.addresses = InsList(addresses)
+        self.columns = [np.asarray(col) for col in columns]
+        self.servo_period = servo_period
+        self.gather_period = gather_period
+        self.phase_over_servo = phase_over_servo
+
+        if len(self.addresses) != len(self.columns):
+            raise ValueError('Got %d columns for %d addresses' %
+                             (len(self.columns), len(self.addresses)))
+
+        lengths = set(len(col) for col in self.columns)
+        if len(lengths) > 1:
+            raise ValueError('Columns differ in length: %s' %
+                             sorted(lengths))
+
+    @classmethod
+    def from_rows(cls, addresses, rows, **kwargs):
+        """
+        Create a GatherResult from a list of rows (e.g., from parse_gather)
+        """
+        data = np.asarray(rows)
+        if data.ndim != 2:
+            # No samples
+            columns = [np.zeros(0) for addr in addresses]
+        else:
+            columns = [np.ascontiguousarray(data[:, i])
+                       for i in range(data.shape[1])]
+
+        return cls(addresses, columns, **kwargs)
+
+    def index(self, key):
+        """
+        Column index of `key`, either an index or an address name
+        """
+        try:
+            return int(key)
+        except (TypeError, ValueError):
+            addr_a = '%s.a' % key
+            if addr_a in self.addresses:
+                return self.addresses.index(addr_a)
+            else:
+                return self.addresses.index(key)
+
+    def column(self, key):
+        """
+        Column array for `key`, either an index or an address name
+        """
+        return self.columns[self.index(key)]
+
+    def __contains__(self, addr):
+        return (addr in self.addresses or
+                '%s.a' % addr in self.addresses)
+
+    def items(self):
+        """
+        Yields (address, column array)
+        """
+        return zip(self.addresses, self.columns)
+
+    @property
+    def samples(self):
+        if not self.columns:
+            return 0
+
+        return len(self.columns[0])
+
+    @property
+    def shape(self):
+        return (self.samples, len(self.columns))
+
+    @property
+    def phase(self):
+        """
+        Whether this is phase (rather than servo) gather data
+        """
+        return self.phase_over_servo is not None
+
+    @property
+    def clock_period(self):
+        """
+        Period of the servo (or phase) clock, in seconds (None if the servo
+        period is unknown)
+        """
+        if self.servo_period is None:
+            return None
+        elif self.phase:
+            return self.servo_period * self.phase_over_servo
+
+        return self.servo_period
+
+    @property
+    def sample_period(self):
+        """
+        Time between samples, in seconds (None if the servo period is
+        unknown)
+        """
+        if self.servo_period is None:
+            return None
+
+        return self.clock_period * self.gather_period
+
+    @property
+    def time(self):
+        """
+        Time axis, in seconds
+
+        Uses the Sys.ServoCount column if gathered (as converted by
+        gather.get_gather_results, which puts phase gathers on the same
+        time base as servo gathers), otherwise the sample period.
+        """
+        if 'Sys.ServoCount' in self:
+            return self.column('Sys.ServoCount')
+
+        period = self.sample_period
+        if period is None:
+            raise ValueError('Servo period unknown')
+
+        return np.arange(self.samples) * period
+
+    def __len__(self):
+        return self.samples
+
+    def __iter__(self):
+        return zip(*self.columns)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.column(key)
+        elif isinstance(key, slice):
+            return GatherResult(self.addresses,
+                                [col[key] for col in self.columns],
+                                servo_period=self.servo_period,
+                                gather_period=self.gather_period,
+                                phase_over_servo=self.phase_over_servo)
+        elif isinstance(key, tuple) and len(key) == 2:
+            rows, col = key
+            if isinstance(col, (str, int, np.integer)):
+                return self.column(col)[rows]
+        elif isinstance(key, (int, np.integer)):
+            return tuple(col[key] for col in self.columns)
+
+        return np.asarray(self)[key]
+
+    def __array__(self, dtype=None, copy=None):
+        if not self.columns:
+            return np.zeros((0, 0), dtype=dtype)
+
+        data = np.column_stack(self.columns)
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+
+        return data
+
+    def __repr__(self):
+        return ('<%s%s samples=%d addresses=%s>' %
+                (self.__class__.__name__, ' (phase)' if self.phase else '',
+                 self.samples, list(self.addresses)))
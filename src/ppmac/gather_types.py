@@ -1,6 +1,7 @@
 from __future__ import print_function
 import struct
 import six
+import numpy as np
 
 
 # TODO: uint24/int24 are untested -- assuming they are still stored in 4 bytes
@@ -48,14 +49,40 @@ def conv_uint24(values):
                          b''.join(_extend_uint24(b) for b in values))
 
 
+def conv_int24_array(values):
+    '''sign extend the low 24 bits of an array of 32-bit words'''
+    values = np.asarray(values).astype(np.int32) & 0xFFFFFF
+    return (values ^ 0x800000) - 0x800000
+
+
+def conv_uint24_array(values):
+    '''take the low 24 bits of an array of 32-bit words'''
+    return np.asarray(values).astype(np.int32) & 0xFFFFFF
+
+
+def make_conv_bits(start, count):
+    '''
+    Create a conversion function which takes `count` bits from bit `start`
+    of an array of 32-bit words
+    '''
+    mask = np.uint32((1 << count) - 1)
+    start = np.uint32(start)
+
+    def wrapped(values):
+        return (np.asarray(values, dtype=np.uint32) >> start) & mask
+
+    wrapped.__name__ = 'conv_bits_%d_to_%d' % (start, start + count)
+    return wrapped
+
+
 UINT32, INT32, UINT24, INT24, FLOAT, DOUBLE, UBITS, SBITS = range(8)
 
 GATHER_TYPES = {
     # type index : (size, format char, conversion function)
     UINT32: (4, 'I', None),
     INT32: (4, 'i', None),
-    UINT24: (4, 'I', None),
-    INT24: (4, '4B', conv_int24),
+    UINT24: (4, 'I', conv_uint24_array),
+    INT24: (4, 'I', conv_int24_array),
     FLOAT: (4, 'f', None),
     DOUBLE: (8, 'd', None),
     UBITS: (4, 'I', None),
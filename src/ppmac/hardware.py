@@ -449,16 +449,33 @@ def _get_gates(gpascii, gate_ver, default_class):
         yield class_(gpascii, index)
 
 
-def enumerate_hardware(gpascii):
+def enumerate_hardware(gpascii, pool=None):
     """
     Returns a list of Gate* instances for all detected hardware
+
+    If a GpasciiPool is specified (e.g., PPComm.pool), each type of gate is
+    enumerated in parallel on its own channel. The instances returned use
+    `gpascii` in either case.
     """
 
     gates = [(1, Gate1), (2, Gate2), (3, Gate3), ('IO', GateIO)]
-    return [inst
-            for gate_ver, default_class in gates
-            for inst in _get_gates(gpascii, gate_ver, default_class)
-            ]
+    if pool is None:
+        return [inst
+                for gate_ver, default_class in gates
+                for inst in _get_gates(gpascii, gate_ver, default_class)
+                ]
+
+    def get_gates(channel, gate):
+        gate_ver, default_class = gate
+        return list(_get_gates(channel, gate_ver, default_class))
+
+    ret = []
+    for instances in pool.map(get_gates, gates):
+        for inst in instances:
+            inst.gpascii = gpascii
+            ret.append(inst)
+
+    return ret
 
 
 def enumerate_address_errors(gpascii):
@@ -14,12 +14,20 @@
 from __future__ import print_function
 import re
 import sys
+import fnmatch
+import math
+import itertools
+import select
+import collections
+import contextlib
+import concurrent.futures
 import time
 import logging
 import threading
-import six
+import uuid
 
 import paramiko
+import numpy as np
 
 from . import const
 from . import config
@@ -59,6 +67,28 @@ class ScriptCancelled(ScriptFailed):
     pass
 
 
+class ProgramDownloadError(GPError):
+    """
+    Errors reported by gpascii while downloading a program
+
+    `errors` is a list of (line number, line, error message), where line
+    numbers start at 1 and are None for errors not attributable to a line
+    of the program.
+    """
+    def __init__(self, errors):
+        self.errors = list(errors)
+
+        messages = []
+        for line_number, line, message in self.errors:
+            if line_number is None:
+                messages.append(message)
+            else:
+                messages.append('line %d (%s): %s' % (line_number, line,
+                                                      message))
+
+        GPError.__init__(self, '\n'.join(messages))
+
+
 PPMAC_MESSAGES = [re.compile(r'.*\/\/ \*\*\* exit'),
                   re.compile('^UnlinkGatherThread:.*'),
                   re.compile(r'^\/\/ \*\*\* EOF'),
@@ -119,14 +149,131 @@ def _wait_for(generator, wait_pattern,
             yield line, None
 
 
+def _parse_value(value, type_=str):
+    """
+    Typecast a value returned from gpascii to type_, taking care of hex values
+    """
+    if value.startswith('$'):
+        # check for a hex value
+        value = int(value[1:], 16)
+
+    return type_(value)
+
+
+_INDEX_RE = re.compile(r'\[([^\[\]]*)\]')
+
+
+def _parse_indices(index):
+    """
+    Parse a range/list index expression (e.g., '1..3,5') into a list of
+    integers
+    """
+    indices = []
+    for item in index.split(','):
+        if '..' in item:
+            low, high = item.split('..')
+            indices.extend(range(int(low), int(high) + 1))
+        else:
+            indices.append(int(item))
+
+    return indices
+
+
+def expand_indices(expr):
+    """
+    Expand the range and list index expressions in a variable name
+
+    Returns: (list of variable names, shape)
+        where shape has one dimension per expanded index
+
+    >> expand_indices('Motor[1..3].ActPos')
+    (['Motor[1].ActPos', 'Motor[2].ActPos', 'Motor[3].ActPos'], (3,))
+    >> expand_indices('Acc24E3[0].Chan[0,1].Dac[0..1]')
+    (['Acc24E3[0].Chan[0].Dac[0]', 'Acc24E3[0].Chan[0].Dac[1]',
+      'Acc24E3[0].Chan[1].Dac[0]', 'Acc24E3[0].Chan[1].Dac[1]'], (2, 2))
+    """
+    groups = []
+    shape = []
+    for i, part in enumerate(_INDEX_RE.split(expr)):
+        if i % 2 == 0:
+            groups.append([part])
+        elif '..' in part or ',' in part:
+            indices = _parse_indices(part)
+            groups.append(['[%d]' % index for index in indices])
+            shape.append(len(indices))
+        else:
+            groups.append(['[%s]' % part])
+
+    names = [''.join(parts) for parts in itertools.product(*groups)]
+    return names, tuple(shape)
+
+
+def _values_equal(requested, actual):
+    """
+    Compare a value written to gpascii with its readback, numerically if
+    possible (allowing for the precision gpascii reports values with),
+    otherwise as case-insensitive strings
+    """
+    requested = str(requested)
+    try:
+        return math.isclose(_parse_value(requested, float),
+                            _parse_value(actual, float),
+                            rel_tol=1e-6, abs_tol=1e-12)
+    except ValueError:
+        return requested.strip().lower() == actual.strip().lower()
+
+
+def _unique_names(names):
+    """
+    Variable names with repeats (ignoring case) removed, in order
+    """
+    seen = set()
+    unique = []
+    for name in names:
+        if name.lower() not in seen:
+            seen.add(name.lower())
+            unique.append(name)
+
+    return unique
+
+
+def _pack_lines(items, max_length, delim=' '):
+    """
+    Pack items into as few lines as possible, each no longer than max_length
+
+    Yields lists of items, one per line
+    """
+    line = []
+    length = 0
+    for item in items:
+        if line and (length + len(delim) + len(item)) > max_length:
+            yield line
+            line = []
+            length = 0
+
+        if line:
+            length += len(delim)
+
+        line.append(item)
+        length += len(item)
+
+    if line:
+        yield line
+
+
 class ShellChannel(object):
     """
     An interactive SSH shell channel
     """
+    # Maximum number of bytes to receive from the channel at once
+    RECV_SIZE = 32768
 
     def __init__(self, comm, command=None, single=False,
                  disable_readline=False, verbose=False):
         self.lock = threading.RLock()
+        self._read_buffer = bytearray()
+        self._read_lines = collections.deque()
+        self._reader = None
         self._comm = comm
         self._client = comm._client
         self._channel = comm._client.invoke_shell()
@@ -188,48 +335,94 @@ class ShellChannel(object):
         """
         Generator which reads lines from the channel, optionally outputting the
         lines to stdout (if verbose=True)
+
+        Blocks on the channel until data arrives (or the timeout expires).
+        Received data is kept in buffers on the channel, so lines not
+        consumed by one reader are available to the next.
+
+        If a ReplyReader thread is running on the channel, the lines it did
+        not match to any request are read instead.
         """
-        channel = self._channel
-        if channel is None:
+        if self._channel is None:
             raise PPCommChannelClosed()
 
         with self.lock:
-            t0 = time.time()
-            buf = ''
-
-            def check_timeout():
-                if timeout is None:
-                    return True
-                return ((time.time() - t0) <= timeout)
+            if self._reader is not None:
+                lines = self._reader.read_timeout(timeout=timeout,
+                                                  verbose=verbose)
+            else:
+                lines = self._read_channel(timeout=timeout, delim=delim,
+                                           verbose=verbose)
 
-            while channel.recv_ready() or check_timeout():
-                if channel.recv_ready():
-                    if six.PY3:
-                        buf += channel.recv(1024).decode('ascii')
-                    else:
-                        buf += channel.recv(1024)
+            for line in lines:
+                yield line
 
-                    lines = buf.split(delim)
-                    if not buf.endswith(delim):
-                        buf = lines[-1]
-                        lines = lines[:-1]
-                    else:
-                        buf = ''
+    def _read_channel(self, timeout=5.0, delim='\r\n', verbose=False):
+        """
+        Generator which reads lines directly from the channel
 
-                    for line in lines:
-                        vlog(verbose, '<- %s' % line)
-                        yield line.rstrip()
+        Unlike read_timeout, the channel lock is not held.
+        """
+        channel = self._channel
+        if channel is None:
+            raise PPCommChannelClosed()
 
-                else:
-                    time.sleep(0.01)
+        bdelim = delim.encode('ascii')
+
+        t0 = time.time()
+        buf = self._read_buffer
+        lines = self._read_lines
+        # Position to start searching for the delimiter, so that partial
+        # lines are not rescanned each time more data is received
+        start = 0
+
+        while True:
+            if lines:
+                line = lines.popleft()
+                vlog(verbose, '<- %s' % line)
+                yield line.rstrip()
+                continue
+
+            # Split off all complete lines at once, leaving only the
+            # trailing partial line in the buffer
+            idx = buf.rfind(bdelim, start)
+            if idx >= 0:
+                lines.extend(buf[:idx].decode('ascii', 'replace')
+                             .split(delim))
+                del buf[:idx + len(bdelim)]
+                start = 0
+                continue
+
+            start = max(0, len(buf) - len(bdelim) + 1)
+
+            if timeout is None:
+                remaining = None
+            else:
+                remaining = max(0.0, timeout - (time.time() - t0))
 
-                if channel.recv_stderr_ready():
-                    line = channel.recv_stderr(1024)
-                    vlog(verbose, '<stderr- %s' % line)
+            if channel.recv_ready() or self._wait_readable(remaining):
+                chunk = channel.recv(self.RECV_SIZE)
+                if not chunk:
+                    raise PPCommChannelClosed()
 
-            if not check_timeout():
+                buf.extend(chunk)
+            elif remaining is not None and remaining <= 0.0:
                 raise TimeoutError('Elapsed %.2f s' % (time.time() - t0))
 
+            if channel.recv_stderr_ready():
+                line = channel.recv_stderr(1024)
+                vlog(verbose, '<stderr- %s' % line)
+
+    def _wait_readable(self, timeout):
+        """
+        Block until the channel has data to be read, up to `timeout` seconds
+        (or indefinitely, if None)
+
+        Returns True if data is ready
+        """
+        readable, _, _ = select.select([self._channel], [], [], timeout)
+        return bool(readable)
+
     def send_line(self, line, delim='\n', sync=False):
         """
         Send a single line of text (with a delimiter at the end)
@@ -247,6 +440,407 @@ class ShellChannel(object):
             self.sync()
 
 
+class GpasciiRequest(object):
+    """
+    A line sent to gpascii, along with the variables expected in reply
+
+    Lines which produce no reply of their own (e.g., commands or assignments)
+    are followed by a query of `fence`, and the request is complete when its
+    value is received.
+
+    `callback(request)` is called upon completion.
+    """
+    def __init__(self, line, names=(), fence=None, callback=None):
+        if fence is not None:
+            fence = fence.lower()
+            names = list(names) + [fence]
+
+        self.line = line
+        self.names = [name.lower() for name in names]
+        self.fence = fence
+        self.values = {}
+        self.error = None
+        self.callback = callback
+        self._remaining = set(self.names)
+
+    @property
+    def lines(self):
+        """
+        The lines to send to gpascii for this request
+        """
+        if self.fence is None:
+            return [self.line]
+        else:
+            return [self.line, self.fence]
+
+    @property
+    def done(self):
+        if self.fence is not None:
+            return self.fence not in self._remaining
+
+        return self.error is not None or not self._remaining
+
+    def get_value(self, name, type_=str):
+        """
+        Get the value of `name`, raising the error received, if any
+        """
+        name = name.lower()
+        if name in self.values:
+            return _parse_value(self.values[name], type_)
+        elif self.error is not None:
+            raise self.error
+        else:
+            raise TimeoutError('No reply for %s' % name)
+
+    def _finish(self):
+        if self.callback is not None:
+            self.callback(self)
+
+
+class ReplyDispatcher(object):
+    """
+    Matches lines received from gpascii to the requests awaiting replies
+
+    gpascii handles lines in order, so replies are attributed to the oldest
+    outstanding request. A reply expected only by a later request means that
+    gpascii has moved past those ahead of it, which are then failed (e.g.,
+    when gpascii echoes a name other than the one queried, such as
+    Motor[2].ActPos for Motor[1+1].ActPos).
+    """
+    def __init__(self, deferred=False):
+        self.pending = collections.deque()
+        # With `deferred` set, completed requests are collected (see
+        # take_completed) instead of having their callbacks called right away
+        self.deferred = deferred
+        self._completed = []
+
+    def add(self, request):
+        self.pending.append(request)
+
+    def _complete(self, request):
+        if self.deferred:
+            self._completed.append(request)
+        else:
+            request._finish()
+
+    def take_completed(self):
+        """
+        Requests completed since the last call, whose callbacks are yet to be
+        called (with `deferred` set)
+        """
+        completed = self._completed
+        self._completed = []
+        return completed
+
+    def remove(self, request, ex=None):
+        """
+        Stop waiting on replies for `request` (e.g., after a timeout), failing
+        it with the exception `ex`
+
+        Returns True if the request was outstanding
+        """
+        try:
+            self.pending.remove(request)
+        except ValueError:
+            return False
+
+        if request.error is None:
+            if ex is None:
+                ex = TimeoutError('No reply to: %s' % request.line)
+            request.error = ex
+        self._complete(request)
+        return True
+
+    def _skip_to(self, name):
+        """
+        Fail the requests ahead of the first one expecting `name`
+
+        Returns that request, or None if no request expects it
+        """
+        for i, request in enumerate(self.pending):
+            if name in request._remaining:
+                break
+        else:
+            return None
+
+        for skipped in range(i):
+            skipped = self.pending.popleft()
+            logger.debug('No reply to %r (received %s)', skipped.line, name)
+            if skipped.error is None:
+                skipped.error = TimeoutError('No reply to: %s' % skipped.line)
+            self._complete(skipped)
+
+        return request
+
+    def feed_line(self, line):
+        """
+        Attribute a received line to the oldest outstanding request expecting
+        it
+
+        Returns True if the line was matched to a request
+        """
+        if not self.pending:
+            return False
+
+        request = self.pending[0]
+        if 'error' in line:
+            if request.error is None:
+                request.error = GPError(line)
+        elif '=' in line:
+            name, value = line.split('=', 1)
+            name = name.lower()
+            if name not in request._remaining:
+                request = self._skip_to(name)
+                if request is None:
+                    return False
+
+            request._remaining.remove(name)
+            if name != request.fence:
+                request.values[name] = value
+        else:
+            return False
+
+        if request.done:
+            self.pending.popleft()
+            self._complete(request)
+
+        return True
+
+    def fail_all(self, ex):
+        """
+        Fail all outstanding requests with the exception `ex`
+        """
+        while self.pending:
+            request = self.pending.popleft()
+            if request.error is None:
+                request.error = ex
+            self._complete(request)
+
+
+class ReplyReader(threading.Thread):
+    """
+    Background thread which reads all output of a channel, passing replies to
+    the outstanding requests of its ReplyDispatcher
+
+    Lines not matched to any request are queued, and may be read with
+    read_timeout as usual.
+    """
+    # Period at which the thread checks if it should stop
+    POLL_PERIOD = 0.1
+
+    def __init__(self, channel):
+        threading.Thread.__init__(self, name='ReplyReader')
+        # channel: the GpasciiChannel to read from
+        self.daemon = True
+        self.dispatcher = ReplyDispatcher(deferred=True)
+        # Guards the dispatcher (see dispatch)
+        self.dispatch_lock = threading.RLock()
+
+        self._gpascii = channel
+        self._unmatched = collections.deque()
+        self._cond = threading.Condition()
+        self._stop_event = threading.Event()
+        self._error = None
+
+    def dispatch(self, method, *args):
+        """
+        Call a method of the dispatcher, then the callbacks of the requests
+        it completed
+
+        The callbacks are called once dispatch_lock is released: they may
+        submit further requests, taking the channel lock, which is held
+        while requests are added to the dispatcher.
+        """
+        with self.dispatch_lock:
+            ret = method(*args)
+            completed = self.dispatcher.take_completed()
+
+        for request in completed:
+            request._finish()
+
+        return ret
+
+    def run(self):
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    for line in self._gpascii._read_channel(
+                            timeout=self.POLL_PERIOD):
+                        matched = self.dispatch(self.dispatcher.feed_line,
+                                                line)
+
+                        if not matched:
+                            with self._cond:
+                                self._unmatched.append(line)
+                                self._cond.notify_all()
+
+                        if self._stop_event.is_set():
+                            break
+                except TimeoutError:
+                    pass
+        except Exception as ex:
+            logger.debug('Reply reader stopped', exc_info=ex)
+            self._error = ex
+        finally:
+            self.dispatch(self.dispatcher.fail_all,
+                          PPCommError('Reply reader stopped'))
+
+            with self._cond:
+                if self._error is None:
+                    self._error = PPCommError('Reply reader stopped')
+                self._cond.notify_all()
+
+    def stop(self):
+        """
+        Stop the thread, returning any unread lines
+        """
+        self._stop_event.set()
+        if self is not threading.current_thread():
+            self.join()
+
+        with self._cond:
+            lines = list(self._unmatched)
+            self._unmatched.clear()
+
+        return lines
+
+    def read_timeout(self, timeout=5.0, verbose=False):
+        """
+        Generator which yields lines not matched to any request
+        """
+        t0 = time.time()
+        while True:
+            with self._cond:
+                while not self._unmatched:
+                    if self._error is not None:
+                        raise self._error
+
+                    if timeout is None:
+                        self._cond.wait()
+                        continue
+
+                    remaining = timeout - (time.time() - t0)
+                    if remaining <= 0.0:
+                        raise TimeoutError('Elapsed %.2f s' %
+                                           (time.time() - t0))
+                    self._cond.wait(remaining)
+
+                line = self._unmatched.popleft()
+
+            vlog(verbose, '<- %s' % line)
+            yield line
+
+
+class VariableCache(object):
+    """
+    Cache of raw variable values read from gpascii, each kept for a
+    time-to-live (TTL) in seconds
+
+    `ttls` maps variable names or patterns with * and ? wildcards (e.g.,
+    'gate3[*].partnum') to TTLs. Exact names take precedence over patterns.
+    A TTL of None keeps the value until it is invalidated, and a TTL of 0
+    disables caching. Variables not in `ttls` use `default_ttl`.
+    """
+    def __init__(self, ttls=None, default_ttl=0.0):
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._names = {}
+        self._patterns = []
+        self._values = {}
+        self._lock = threading.Lock()
+
+        if ttls is not None:
+            for name, ttl in ttls.items():
+                self.set_ttl(name, ttl)
+
+    def set_ttl(self, name, ttl):
+        """
+        Set the TTL for a variable name or pattern
+        """
+        name = name.lower()
+        if '*' in name or '?' in name:
+            # index brackets are escaped, as fnmatch would treat them as sets
+            escaped = re.sub(r'[\[\]]', lambda m: '[%s]' % m.group(0), name)
+            regex = re.compile(fnmatch.translate(escaped))
+            self._patterns = [(pattern, regex_, ttl_)
+                              for pattern, regex_, ttl_ in self._patterns
+                              if pattern != name]
+            self._patterns.append((name, regex, ttl))
+        else:
+            self._names[name] = ttl
+
+    def ttl(self, name):
+        """
+        The TTL for a lower-case variable name
+        """
+        try:
+            return self._names[name]
+        except KeyError:
+            pass
+
+        for pattern, regex, ttl in self._patterns:
+            if regex.match(name):
+                return ttl
+
+        return self.default_ttl
+
+    def get(self, name):
+        """
+        Get the raw value of a lower-case variable name, or None if it is not
+        cached (or has expired)
+        """
+        with self._lock:
+            try:
+                value, expires = self._values[name]
+            except KeyError:
+                pass
+            else:
+                if expires is None or time.time() < expires:
+                    self.hits += 1
+                    return value
+
+                del self._values[name]
+
+            self.misses += 1
+
+    def put(self, name, value):
+        """
+        Cache the raw value of a lower-case variable name, if it has a TTL
+        """
+        ttl = self.ttl(name)
+        if ttl is not None and ttl <= 0.0:
+            return
+
+        if ttl is not None:
+            ttl += time.time()
+
+        with self._lock:
+            self._values[name] = (value, ttl)
+
+    def invalidate(self, name):
+        """
+        Remove a lower-case variable name from the cache
+        """
+        with self._lock:
+            self._values.pop(name, None)
+
+    def flush(self):
+        """
+        Remove all values from the cache
+        """
+        with self._lock:
+            self._values.clear()
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return '<VariableCache %d values hits=%d misses=%d>' % (
+            len(self._values), self.hits, self.misses)
+
+
 class GpasciiChannel(ShellChannel):
     """
     An SSH channel which represents a connection to
@@ -255,17 +849,62 @@ class GpasciiChannel(ShellChannel):
 
     CMD_GPASCII = 'gpascii -2 2>&1'
     EOT = '\04'
+    # Maximum length of a line of packed (space-separated) queries
+    MAX_LINE_LENGTH = 200
+    # Variable queried after commands, marking the end of their output
+    FENCE_VARIABLE = 'Sys.MaxMotors'
+    # Whether gpascii handles range queries (e.g., Motor[1..8].ActPos) itself;
+    # cleared if it reports an error for one
+    _native_ranges = True
+    # Default TTLs for enable_cache (seconds, or None to keep until written).
+    # These only change by writing to them or on reboot. The clock periods
+    # are derived from the gate clock settings, and so are also flushed when
+    # those are written through this channel (or on reset), but a finite TTL
+    # covers changes made by other means.
+    DEFAULT_CACHE_TTLS = {'sys.maxmotors': None,
+                          'sys.maxcoords': None,
+                          'sys.servoperiod': 5.0,
+                          'sys.phaseoverservoperiod': 5.0,
+                          'sys.cputype': None,
+                          'gate1[*].partnum': None,
+                          'gate2[*].partnum': None,
+                          'gate3[*].partnum': None,
+                          'gate3[*].partrev': None,
+                          'gate3[*].parttype': None,
+                          }
+
+    # Size of each write when downloading programs (bytes)
+    DOWNLOAD_CHUNK_SIZE = 16384
+    # Remote file used by download(via_sftp=True), named uniquely per
+    # download so that concurrent downloads do not overwrite each other
+    DOWNLOAD_FILE = '/tmp/gpascii_download_%s.txt'
+
+    _ERROR_LINE_RE = re.compile(r'^(.*?):(\d+):(\d+):\s*(error.*)$')
+    _COORD_RE = re.compile(r'(&(\d+))?#(\d+)->([a-zA-Z0-9]+)')
+    _ASSIGNMENT_RE = re.compile(r'([a-z_][\w.\[\]]*)\s*[-+*/%&|^]?=(?!=)')
+    # Writes to these change derived values (e.g., sys.servoperiod)
+    _CLOCK_SETTING_RE = re.compile(r'^gate\d*\[[^\]]*\]\.'
+                                   r'(phasefreq|servoclockdiv|phaseclockdiv)$')
+    # Reset/reinitialize commands ($$$, $$$***)
+    _RESET_RE = re.compile(r'^\s*\$\$\$')
 
     def __init__(self, comm, command=None, verbose=False):
         if command is None:
             command = self.CMD_GPASCII
 
+        self.cache = None
+        self._lines_sent = 0
+
         ShellChannel.__init__(self, comm, command=command,
                               verbose=verbose)
 
         if not self.wait_for('.*(STDIN Open for ASCII Input)$'):
             raise ValueError('GPASCII startup string not found')
 
+        # Lines sent to gpascii, used to locate errors it reports by line
+        # number (e.g., stdin:12:1: error ...)
+        self._lines_sent = 0
+
     def close(self):
         """
         Close the gpascii connection
@@ -273,12 +912,385 @@ class GpasciiChannel(ShellChannel):
         channel = self._channel
 
         if channel is not None and not channel.closed:
+            self.stop_reader()
             self.sync()
             channel.send(self.EOT)
             self._channel = None
 
     __del__ = close
 
+    @property
+    def pipelined(self):
+        """
+        Whether a background reader thread is demultiplexing replies
+        """
+        return self._reader is not None
+
+    def start_reader(self):
+        """
+        Start a background thread to read replies from gpascii
+
+        Once started, requests may be submitted without waiting for the
+        replies to earlier ones (see `submit_get` and `submit_line`), and
+        get_variable/get_variables send all of their queries before waiting
+        on the replies.
+        """
+        with self.lock:
+            if self._reader is not None:
+                return
+
+            self.sync()
+            self._reader = ReplyReader(self)
+            self._reader.start()
+
+    def stop_reader(self):
+        """
+        Stop the background reader thread, failing any outstanding requests
+        """
+        with self.lock:
+            reader, self._reader = self._reader, None
+            if reader is None:
+                return
+
+            # Lines not yet read by anyone are returned to the channel
+            # buffer, ahead of those the thread had yet to process
+            self._read_lines.extendleft(reversed(reader.stop()))
+
+    def _submit(self, future, request):
+        """
+        Send a request, to be completed by the reader thread
+
+        The request is kept on `future` so that it may be dropped should
+        waiting on the future time out (see _future_result)
+        """
+        future.request = request
+        reader = self._reader
+        if reader is None:
+            raise PPCommError('Reader thread not running (see start_reader)')
+
+        with self.lock:
+            # The request is queued prior to sending, as the reply may
+            # arrive before send_line returns
+            with reader.dispatch_lock:
+                reader.dispatcher.add(request)
+
+            for line in request.lines:
+                self.send_line(line)
+
+    def submit_get(self, var, type_=str):
+        """
+        Query a variable without waiting for the reply
+
+        Returns a concurrent.futures.Future for the value, typecast to type_.
+        Requires the reader thread to be running (see start_reader).
+
+        >> futures = [comm.submit_get('Motor[%d].ActPos' % i, float)
+                      for i in range(1, 9)]
+        >> [future.result(timeout=2.0) for future in futures]
+        """
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+
+        def completed(request):
+            cache = self.cache
+            if cache is not None and var.lower() in request.values:
+                cache.put(var.lower(), request.values[var.lower()])
+
+            try:
+                future.set_result(request.get_value(var, type_))
+            except Exception as ex:
+                future.set_exception(ex)
+
+        self._submit(future, GpasciiRequest(var, [var], callback=completed))
+        return future
+
+    def submit_line(self, line):
+        """
+        Send a line without waiting for gpascii to process it
+
+        Returns a concurrent.futures.Future which completes when the line has
+        been processed, or fails with GPError.
+        Requires the reader thread to be running (see start_reader).
+        """
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+
+        def completed(request):
+            if request.error is not None:
+                future.set_exception(request.error)
+            else:
+                future.set_result(None)
+
+        self._submit(future, GpasciiRequest(line, fence=self.FENCE_VARIABLE,
+                                            callback=completed))
+        return future
+
+    def _submit_packed(self, variables, line=None):
+        """
+        Query several variables in a single line without waiting for the
+        reply
+
+        Returns a concurrent.futures.Future for the completed GpasciiRequest
+        """
+        # A variable queried twice is replied to twice, and only one reply
+        # could be matched to the request
+        variables = _unique_names(variables)
+        if line is None:
+            line = ' '.join(variables)
+
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+        self._submit(future, GpasciiRequest(line, variables,
+                                            callback=future.set_result))
+        return future
+
+    def enable_cache(self, ttls=None, default_ttl=0.0):
+        """
+        Cache variables read by get_variable/get_variables (see VariableCache)
+
+        `ttls` adds to (or overrides) DEFAULT_CACHE_TTLS. Cached values are
+        invalidated when written through this channel, but changes made by
+        other means (e.g., another channel or a motion program) are not
+        seen until the TTL expires or the cache is flushed.
+
+        Returns the VariableCache, which keeps hit/miss counts.
+        """
+        all_ttls = dict(self.DEFAULT_CACHE_TTLS)
+        if ttls is not None:
+            all_ttls.update((name.lower(), ttl) for name, ttl in ttls.items())
+
+        self.cache = VariableCache(all_ttls, default_ttl=default_ttl)
+        return self.cache
+
+    def disable_cache(self):
+        """
+        Stop caching variables
+        """
+        self.cache = None
+
+    def flush_cache(self):
+        """
+        Remove all cached values, if caching is enabled
+        """
+        if self.cache is not None:
+            self.cache.flush()
+
+    def _invalidate_line(self, line):
+        """
+        Invalidate cached values for all variables assigned to in a line
+
+        The whole cache is flushed on a reset, or when the gate clocks are
+        changed.
+        """
+        cache = self.cache
+        if self._RESET_RE.match(line):
+            cache.flush()
+            return
+
+        for name in self._ASSIGNMENT_RE.findall(line.lower()):
+            if '[' in name and not re.match(r'^[^\[]*(\[\d+\][^\[]*)*$',
+                                            name):
+                # The index is an expression, e.g. motor[l1].jogspeed
+                cache.flush()
+                return
+            elif self._CLOCK_SETTING_RE.match(name):
+                cache.flush()
+                return
+
+            cache.invalidate(name)
+
+    def send_line(self, line, delim='\n', sync=False):
+        """
+        Send a single line of text (with a delimiter at the end)
+        """
+        if self.cache is not None and ('=' in line or '$' in line):
+            self._invalidate_line(line)
+
+        with self.lock:
+            self._lines_sent += 1
+            ShellChannel.send_line(self, line, delim=delim)
+
+        if sync:
+            self.sync()
+
+    def send_lines(self, lines, delim='\n'):
+        """
+        Send several lines of text in a single write
+        """
+        channel = self._channel
+        if channel is None:
+            raise PPCommChannelClosed()
+
+        lines = list(lines)
+        if self.cache is not None:
+            for line in lines:
+                if '=' in line or '$' in line:
+                    self._invalidate_line(line)
+
+        with self.lock:
+            vlog(self._verbose, '-> (%d lines)' % len(lines))
+            self._lines_sent += len(lines)
+            channel.sendall(''.join('%s%s' % (line, delim) for line in lines))
+
+    def _drain_errors(self, timeout=0.0):
+        """
+        Read any available output, returning the error lines
+        """
+        errors = []
+        try:
+            for line in self.read_timeout(timeout=timeout):
+                if 'error' in line:
+                    errors.append(line)
+        except TimeoutError:
+            pass
+
+        return errors
+
+    def _locate_errors(self, errors, sent, first_line=1):
+        """
+        Map error lines reported by gpascii back to the lines which caused
+        them
+
+        `sent` is a list of (line number or None, line), in the order they
+        were sent to gpascii, starting at gpascii line number `first_line`.
+        Returns a list of (line number, line, message) for
+        ProgramDownloadError
+        """
+        ret = []
+        for error in errors:
+            m = self._ERROR_LINE_RE.match(error)
+            if m is not None:
+                index = int(m.group(2)) - first_line
+                if 0 <= index < len(sent) and sent[index][0] is not None:
+                    number, line = sent[index]
+                    ret.append((number, line, m.group(4)))
+                    continue
+
+            ret.append((None, None, error))
+
+        return ret
+
+    def download(self, lines, header=(), footer=(), via_sftp=False,
+                 abort_on_error=True, chunk_size=None, timeout=None):
+        """
+        Send many lines to gpascii (e.g., the contents of a motion program)
+        as quickly as possible
+
+        `header` and `footer` lines are sent before and after `lines` (e.g.,
+        'open prog 1' and 'close'). Rather than a round trip per line, the
+        lines are written in chunks of `chunk_size` bytes, checking for errors
+        between chunks. If `abort_on_error` is set, no further chunks are
+        sent after an error (but the footer still is).
+
+        If `via_sftp` is set, all lines are written to a remote file and
+        loaded by a separate gpascii process in one step instead.
+
+        `timeout` is the time to wait for gpascii to finish processing the
+        lines after they are sent, defaulting to 5s plus 1ms per line.
+
+        Raises ProgramDownloadError, with errors located by their line number
+        in `lines`
+        """
+        lines = [line.strip() for line in lines]
+        header = [(None, line) for line in header]
+        body = list(zip(range(1, len(lines) + 1), lines))
+        footer = [(None, line) for line in footer]
+
+        if timeout is None:
+            timeout = 5.0 + 1e-3 * (len(header) + len(body) + len(footer))
+
+        if via_sftp:
+            sent = header + body + footer
+            errors = self._download_sftp([line for number, line in sent])
+            first_line = 1
+        else:
+            errors, sent, first_line = self._download_stream(
+                header + body, footer, abort_on_error=abort_on_error,
+                chunk_size=chunk_size, timeout=timeout)
+
+        errors = self._locate_errors(errors, sent, first_line)
+        if errors:
+            raise ProgramDownloadError(errors)
+
+    def _download_sftp(self, lines):
+        """
+        Write lines to a remote file and load it with gpascii
+
+        Returns the error lines
+        """
+        comm = self._comm
+        filename = self.DOWNLOAD_FILE % uuid.uuid4().hex
+        comm.write_file(filename, ''.join('%s\n' % line for line in lines))
+        try:
+            output = comm.gpascii_file(filename, check_errors=False)
+        finally:
+            comm.remove_file(filename)
+
+        return [line.strip() for line in output if 'error' in line]
+
+    def _download_stream(self, lines, footer, abort_on_error=True,
+                         chunk_size=None, timeout=5.0):
+        """
+        Stream (line number, line) pairs to this gpascii channel
+
+        Returns (error lines, the pairs sent, gpascii line number of the
+        first one)
+        """
+        if chunk_size is None:
+            chunk_size = self.DOWNLOAD_CHUNK_SIZE
+
+        with self.lock:
+            # Errors from before the download are not of interest
+            self._drain_errors()
+            first_line = self._lines_sent + 1
+
+            errors = []
+            sent = []
+            chunk = []
+            size = 0
+            for i, (number, line) in enumerate(lines):
+                chunk.append((number, line))
+                size += len(line) + 1
+                if size < chunk_size and i < len(lines) - 1:
+                    continue
+
+                # The SSH channel window limits how far the writes can get
+                # ahead of gpascii, so take the opportunity to pick up errors
+                self.send_lines(line for number, line in chunk)
+                sent.extend(chunk)
+                chunk = []
+                size = 0
+
+                errors.extend(self._drain_errors())
+                if errors and abort_on_error:
+                    logger.debug('Download aborted after %d lines', i + 1)
+                    break
+
+            if footer:
+                self.send_lines(line for number, line in footer)
+                sent.extend(footer)
+
+            errors.extend(self._fence(timeout=timeout))
+
+        return errors, sent, first_line
+
+    def _future_result(self, future, timeout):
+        """
+        Wait on a future, raising TimeoutError (from this module) on timeout
+
+        A request which times out is no longer waited on by the reader thread,
+        so that it cannot hold up the replies to later requests
+        """
+        try:
+            return future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            ex = TimeoutError('Elapsed %.2f s' % timeout)
+            reader = self._reader
+            request = getattr(future, 'request', None)
+            if reader is not None and request is not None:
+                reader.dispatch(reader.dispatcher.remove, request, ex)
+            raise ex
+
     def set_variable(self, var, value, check=True):
         """
         Set a Power PMAC variable to value
@@ -288,6 +1300,100 @@ class GpasciiChannel(ShellChannel):
         if check:
             return self.get_variable(var)
 
+    def _fence(self, timeout=2.0):
+        """
+        Wait for gpascii to process all lines sent so far
+
+        Returns the error lines received in the meantime
+        """
+        if self._reader is not None:
+            try:
+                self._future_result(self.submit_line(''), timeout)
+            except GPError as ex:
+                return [str(ex)]
+            return []
+
+        fence = self.FENCE_VARIABLE.lower()
+        errors = []
+        with self.lock:
+            self.send_line(fence)
+            for line in self.read_timeout(timeout=timeout):
+                if 'error' in line:
+                    errors.append(line)
+                elif line.lower().startswith(fence + '='):
+                    break
+
+        return errors
+
+    def set_variables(self, values, check=True, timeout=2.0):
+        """
+        Set several Power PMAC variables at once
+
+        `values` is a dictionary (or a sequence of (variable, value) pairs,
+        to set them in a specific order). The assignments are packed into as
+        few lines as possible, followed by a single batched readback if
+        `check` is set.
+
+        Returns a dictionary of the variables which did not read back as
+        requested, {variable: (requested value, actual value or exception)}
+
+        Raises GPError on an assignment error if `check` is not set (with
+        `check` set, variables left unchanged appear in the returned
+        dictionary instead).
+
+        >> comm.set_variables({'Motor[2].Servo.Kp': 10, 'Motor[2].Servo.Kvfb': 5})
+        {}
+        """
+        if hasattr(values, 'items'):
+            values = values.items()
+
+        values = list(values)
+        if not values:
+            return {}
+
+        assignments = ['%s=%s' % (var.lower(), value)
+                       for var, value in values]
+
+        if self._reader is not None:
+            futures = [self.submit_line(' '.join(line))
+                       for line in _pack_lines(assignments,
+                                               self.MAX_LINE_LENGTH)]
+            errors = []
+            for future in futures:
+                try:
+                    self._future_result(future, timeout)
+                except GPError as ex:
+                    errors.append(str(ex))
+        else:
+            with self.lock:
+                for line in _pack_lines(assignments, self.MAX_LINE_LENGTH):
+                    self.send_line(' '.join(line))
+
+                errors = self._fence(timeout=timeout)
+
+        if errors:
+            if not check:
+                raise GPError('; '.join(errors))
+
+            # gpascii skips the remainder of a line after an error, so the
+            # readback shows which assignments took effect
+            logger.warning('Errors setting variables: %s', '; '.join(errors))
+
+        if not check:
+            return {}
+
+        variables = [var for var, value in values]
+        readback = self.get_variables(variables, timeout=timeout,
+                                      error_cb=lambda var, ex: ex)
+
+        diff = {}
+        for (var, requested), actual in zip(values, readback):
+            if (isinstance(actual, Exception) or
+                    not _values_equal(requested, actual)):
+                diff[var] = (requested, actual)
+
+        return diff
+
     def get_variable(self, var, type_=str, timeout=2.0):
         """
         Get a Power PMAC variable, and typecast it to type_
@@ -299,6 +1405,14 @@ class GpasciiChannel(ShellChannel):
         0
         """
         var = var.lower()
+        if self.cache is not None:
+            value = self.cache.get(var)
+            if value is not None:
+                return _parse_value(value, type_)
+
+        if self._reader is not None:
+            return self._future_result(self.submit_get(var, type_), timeout)
+
         with self.lock:
             self.send_line(var)
 
@@ -309,34 +1423,255 @@ class GpasciiChannel(ShellChannel):
                 if '=' in line:
                     vname, value = line.split('=', 1)
                     if var == vname.lower():
-                        if value.startswith('$'):
-                            # check for a hex value
-                            value = int(value[1:], 16)
+                        if self.cache is not None:
+                            self.cache.put(var, value)
+                        return _parse_value(value, type_)
+
+    def _read_packed(self, variables, timeout=2.0, line=None):
+        """
+        Query several variables with a single line sent to gpascii
+
+        Returns: ({lower-case variable name: raw value string},
+                  error line, TimeoutError instance, or None)
+
+        gpascii stops processing the remainder of a line after an error, so
+        any variables that were not read back are left for the caller to
+        handle.
+
+        `line` may be given if it differs from the variable names joined
+        (e.g., a range query)
+        """
+        if line is None:
+            line = ' '.join(variables)
+
+        remaining = set(var.lower() for var in variables)
+        values = {}
+        with self.lock:
+            self.send_line(line)
+
+            try:
+                for line in self.read_timeout(timeout=timeout):
+                    if 'error' in line:
+                        return values, line
+
+                    if '=' in line:
+                        vname, value = line.split('=', 1)
+                        vname = vname.lower()
+                        if vname in remaining:
+                            values[vname] = value
+                            remaining.remove(vname)
+                            if not remaining:
+                                break
+            except TimeoutError as ex:
+                return values, ex
+
+        return values, None
+
+    def _read_submitted(self, future, timeout=2.0):
+        """
+        Wait on a request from _submit_packed
+
+        Returns the same as _read_packed
+        """
+        try:
+            request = self._future_result(future, timeout)
+        except TimeoutError as ex:
+            return {}, ex
+
+        return request.values, request.error
+
+    def _get_variables_batched(self, variables, type_=str, timeout=2.0):
+        """
+        Query variables, packing as many as possible into each gpascii line
+
+        Returns a list of values (or exceptions, for variables which failed)
+        in the same order as `variables`
+        """
+        results = {}
+        cache = self.cache
+        if cache is not None:
+            for var in variables:
+                value = cache.get(var.lower())
+                if value is not None:
+                    try:
+                        results[var.lower()] = _parse_value(value, type_)
+                    except ValueError as ex:
+                        results[var.lower()] = ex
+
+            uncached = [var for var in variables
+                        if var.lower() not in results]
+        else:
+            uncached = variables
+
+        # Each variable is queried once, however many times it was requested,
+        # as gpascii would otherwise send replies that are never read
+        uncached = _unique_names(uncached)
+        packed = list(_pack_lines(uncached, self.MAX_LINE_LENGTH))
+        if self._reader is not None:
+            # Send all lines up front, so that only one round trip is spent
+            # waiting on the replies
+            futures = [self._submit_packed(line_vars) for line_vars in packed]
+            replies = [self._read_submitted(future, timeout)
+                       for future in futures]
+        else:
+            replies = (self._read_packed(line_vars, timeout=timeout)
+                       for line_vars in packed)
+
+        for line_vars, (values, error) in zip(packed, replies):
+            for var, value in values.items():
+                if cache is not None:
+                    cache.put(var, value)
+
+                try:
+                    results[var] = _parse_value(value, type_)
+                except ValueError as ex:
+                    results[var] = ex
+
+            missing = [var for var in line_vars
+                       if var.lower() not in results]
+            if not missing:
+                continue
+
+            if isinstance(error, TimeoutError):
+                for var in missing:
+                    results[var.lower()] = error
+                continue
+
+            if error is not None and self._reader is None:
+                # Clear out any remaining output related to the error
+                try:
+                    self.sync()
+                except GPError:
+                    pass
+
+            # Fall back to reading the remaining variables one at a time, so
+            # that errors can be attributed to the variables that caused them
+            for var in missing:
+                try:
+                    results[var.lower()] = self.get_variable(var, type_=type_,
+                                                             timeout=timeout)
+                except (GPError, TimeoutError) as ex:
+                    results[var.lower()] = ex
+
+        return [results[var.lower()] for var in variables]
+
+    def _get_range(self, expr, variables, timeout=2.0):
+        """
+        Query a range expression (e.g., Motor[1..32].ActPos) natively
+
+        Returns the raw values in the order of `variables` (the expanded
+        expression), or None if they could not all be read back.
+        """
+        if self._reader is not None:
+            values, error = self._read_submitted(
+                self._submit_packed(variables, line=expr), timeout)
+        else:
+            values, error = self._read_packed(variables, timeout=timeout,
+                                              line=expr)
+
+        if len(values) == len(variables):
+            if self.cache is not None:
+                for var, value in values.items():
+                    self.cache.put(var, value)
+
+            return [values[var.lower()] for var in variables]
+
+        if error is not None and not isinstance(error, TimeoutError):
+            if not values:
+                logger.debug('Range queries unsupported (%s)', error)
+                self._native_ranges = False
+
+            if self._reader is None:
+                try:
+                    self.sync()
+                except GPError:
+                    pass
+
+        return None
+
+    def get_array(self, expr, dtype=float, timeout=2.0):
+        """
+        Get an array of values for a range or list index expression
 
-                        return type_(value)
+        A single range (e.g., 'Motor[1..32].ActPos') is queried with one
+        command, if supported by gpascii. Otherwise, as with lists (e.g.,
+        'Motor[3,5,11].HomePos') and multiple ranges, the expression is
+        expanded and queried with as few lines as possible.
+
+        Returns a numpy array of `dtype`, with one dimension per expanded
+        index. Raises the first error encountered, if any.
+
+        >> comm.get_array('Motor[1..4].ActPos')
+        array([ 0. ,  1.5,  0. ,  0. ])
+        """
+        names, shape = expand_indices(expr)
+        dtype = np.dtype(dtype)
+        if dtype.kind in 'iub':
+            type_ = int
+        elif dtype.kind in 'fc':
+            type_ = float
+        else:
+            type_ = str
+
+        ranges = [index for index in _INDEX_RE.findall(expr)
+                  if '..' in index or ',' in index]
+        # (cached variables are left to _get_variables_batched)
+        native = (self._native_ranges and len(ranges) == 1 and
+                  ',' not in ranges[0] and
+                  (self.cache is None or
+                   self.cache.ttl(names[0].lower()) == 0.0))
+
+        values = None
+        if native:
+            values = self._get_range(expr, names, timeout=timeout)
+            if values is not None:
+                values = [_parse_value(value, type_) for value in values]
+
+        if values is None:
+            values = self._get_variables_batched(names, type_=type_,
+                                                 timeout=timeout)
+            for value in values:
+                if isinstance(value, Exception):
+                    raise value
+
+        return np.array(values, dtype=dtype).reshape(shape)
 
     def get_variables(self, variables, type_=str, timeout=0.2,
-                      cb=None, error_cb=None):
+                      cb=None, error_cb=None, batch=True):
         """
         Get Power PMAC variables, typecasting them to type_
 
         Optionally calls a callback per variable to modify its value
 
+        If `batch` is set, as many variables as possible are queried per line
+        sent to gpascii, reducing the number of round trips required.
+
         >> comm.get_variables(['i100', 'i200'], type_=int)
         [0, 1]
         >> comm.get_variables(['i100', 'i200'], type_=int,
                               cb=lambda var, value: value + 1)
         [1, 2]
         """
+        variables = list(variables)
+        if batch:
+            values = self._get_variables_batched(variables, type_=type_,
+                                                 timeout=timeout)
+        else:
+            values = []
+            for var in variables:
+                try:
+                    values.append(self.get_variable(var, type_=type_,
+                                                    timeout=timeout))
+                except (GPError, TimeoutError) as ex:
+                    values.append(ex)
+
         ret = []
-        for var in variables:
-            try:
-                value = self.get_variable(var)
-            except (GPError, TimeoutError) as ex:
+        for var, value in zip(variables, values):
+            if isinstance(value, Exception):
                 if error_cb is None:
-                    ret.append('Error: %s' % (ex, ))
+                    ret.append('Error: %s' % (value, ))
                 else:
-                    ret.append(error_cb(var, ex))
+                    ret.append(error_cb(var, value))
             else:
                 if cb is not None:
                     try:
@@ -379,45 +1714,84 @@ class GpasciiChannel(ShellChannel):
         """
         return 1.0 / self.servo_period
 
+    @property
+    def phase_over_servo(self):
+        """
+        Sys.PhaseOverServoPeriod: the phase period relative to the servo
+        period
+        """
+        return self.get_variable('Sys.PhaseOverServoPeriod', type_=float)
+
+    @property
+    def phase_period(self):
+        """
+        The phase period, in seconds
+        """
+        return self.servo_period * self.phase_over_servo
+
     def get_coord(self, motor):
         """
         Query a motor to determine which coordinate system it's in
         """
+        return self._read_coords([motor]).get(motor, (None, None))
+
+    def _read_coords(self, motors, timeout=2.0):
+        """
+        Query the coordinate system assignments of several motors, packing
+        as many queries as possible into each line
+
+        Returns a dictionary with key=motor, value=(coord, assigned)
+        """
+        motors = list(motors)
+        if not motors:
+            return {}
+
+        queries = ['&0#%d->' % motor for motor in motors]
+        remaining = set(motors)
+        ret = {}
+
         with self.lock:
-            self.send_line('&0#%d->' % motor)
+            for line in _pack_lines(queries, self.MAX_LINE_LENGTH):
+                self.send_line(' '.join(line))
 
-            for line in self.read_timeout():
+            for line in self.read_timeout(timeout=timeout):
                 if 'error' in line:
+                    # Clear out replies to the remaining lines
+                    try:
+                        self.sync()
+                    except GPError:
+                        pass
                     raise GPError(line)
 
-                if '#' not in line:
-                    continue
-
                 # <- &2#1->x
                 # ('&2', '2', '1', 'x')
                 # <- #3->0
                 # (None, None, '3', '0')
+                for m in self._COORD_RE.finditer(line):
+                    _, coord, mnum, assigned = m.groups()
+                    mnum = int(mnum)
+                    if mnum not in remaining:
+                        continue
 
-                m = re.search(r'(&(\d+))?#(\d+)->([a-zA-Z0-9]+)', line)
-                if not m:
-                    continue
-
-                groups = m.groups()
-                _, coord, mnum, assigned = groups
-                if assigned == '0':
-                    assigned = None
-                if int(mnum) == motor:
+                    if assigned == '0':
+                        assigned = None
                     if coord is None:
                         coord = 0
                     else:
                         coord = int(coord)
-                    return coord, assigned
 
-        return None, None
+                    ret[mnum] = (coord, assigned)
+                    remaining.remove(mnum)
 
-    def get_coords(self):
+                if not remaining:
+                    break
+
+        return ret
+
+    def get_coords(self, motors=None):
         """
-        Returns the coordinate system setup
+        Returns the coordinate system setup, optionally only for the motors
+        listed in `motors`
 
         For example:
             {1: {11: 'x'}, 2: {1: 'x', 12: 'y'}}
@@ -425,10 +1799,13 @@ class GpasciiChannel(ShellChannel):
             coordinate system 1, motor 11 is X
             coordinate system 2, motor 1 is X, motor 12 is Y
         """
-        num_motors = self.get_variable('sys.maxmotors', type_=int)
+        if motors is None:
+            num_motors = self.get_variable('sys.maxmotors', type_=int)
+            motors = range(num_motors)
+
         coords = {}
-        for motor in range(num_motors):
-            coord, assigned = self.get_coord(motor)
+        for motor, (coord, assigned) in sorted(self._read_coords(motors)
+                                               .items()):
             if assigned is not None:
                 if coord not in coords:
                     coords[coord] = {}
@@ -436,13 +1813,14 @@ class GpasciiChannel(ShellChannel):
 
         return coords
 
-    def get_motor_coords(self):
+    def get_motor_coords(self, motors=None):
         """
-        Get the coordinate systems motors are assigned to
+        Get the coordinate systems motors are assigned to, optionally only
+        for the motors listed in `motors`
 
         Returns a dictionary with key=motor, value=coordinate system
         """
-        coords = self.get_coords()
+        coords = self.get_coords(motors)
         ret = {}
         for coord, motors in coords.items():
             for motor, axis in motors.items():
@@ -483,8 +1861,11 @@ class GpasciiChannel(ShellChannel):
                 for coord in coords.keys():
                     self.send_line('&%dundefine' % (coord, ))
 
+            all_motors = sorted(set(motor for motors in coords.values()
+                                    for motor in motors))
+
             # Ensure the motors aren't in coordinate systems already
-            motor_to_coord = self.get_motor_coords()
+            motor_to_coord = self.get_motor_coords(all_motors)
             for coord, motors in coords.items():
                 for motor, assigned in motors.items():
                     try:
@@ -511,12 +1892,14 @@ class GpasciiChannel(ShellChannel):
                                       (coord, motor, ex))
 
             if check:
+                # All motors are checked, as those already in a coordinate
+                # system but not in `coords` are still part of it
                 current = self.get_coords()
                 for coord, motors in coords.items():
                     motors = [(num, axis.lower()) for num, axis in
                               motors.items()]
                     motors_current = [(num, axis.lower()) for num, axis in
-                                      current[coord].items()]
+                                      current.get(coord, {}).items()]
                     if set(motors) != set(motors_current):
                         vlog(verbose, motors, motors_current)
                         raise ValueError('Motors in coord system %d differ' %
@@ -643,10 +2026,14 @@ class GpasciiChannel(ShellChannel):
 
     def send_program(self, coord, prog_num, motors={},
                      macros={}, filename=None, script=None, run=False,
-                     verbose=False,
+                     verbose=False, via_sftp=False,
                      **kwargs):
         """
         Send a program and (optionally) run it in a coordinate system.
+
+        The program is downloaded with `download` (optionally `via_sftp`),
+        raising ProgramDownloadError with the script line numbers of any
+        errors.
         """
         self.send_line('&%dabort' % (coord, ))
 
@@ -657,32 +2044,29 @@ class GpasciiChannel(ShellChannel):
         if filename is not None:
             logger.debug('Sending script: %s' % filename)
             with open(filename, 'rt') as f:
-                script = f.readlines()
+                script = f.read().split('\n')
         elif script is None:
             raise ValueError('Must specify script text or filename')
 
         if isinstance(script, (list, tuple)):
             script = list(script)
         else:
-            script = [script]
-
-        script = opening_lines + script + closing_lines
+            script = script.split('\n')
 
         if macros:
             script = '\n'.join(script)
             script = script.format(**macros)
             script = script.split('\n')
 
-        for line in script:
-            if line.rstrip():
-                logger.debug('Script line: %s', line.rstrip())
-            try:
-                self.send_line(line.strip())
-            except GPError as ex:
-                logger.error('Failed to send script: %s', ex)
-                raise
+        logger.debug('Sending program %d (%d lines)', prog_num, len(script))
+        try:
+            self.download(script, header=opening_lines, footer=closing_lines,
+                          via_sftp=via_sftp)
+        except ProgramDownloadError as ex:
+            logger.error('Failed to send script: %s', ex)
+            raise
 
-        self.sync()
+        script = opening_lines + script + closing_lines
 
         if motors:
             self.set_coords({coord: motors},
@@ -790,6 +2174,152 @@ class GpasciiChannel(ShellChannel):
                     raise TimeoutError()
 
 
+class GpasciiPool(object):
+    """
+    A bounded pool of independent gpascii channels on one SSH connection
+
+    Channels are created as needed, up to `size`. A thread checking out a
+    channel it already holds gets the same channel back (checkouts nest), and
+    threads are given the channel they last used whenever it is available.
+
+    >> with comm.pool.channel() as gpascii:
+           gpascii.get_variable('Sys.ServoPeriod')
+    """
+    def __init__(self, comm, size=4, verbose=False):
+        if size < 1:
+            raise ValueError('Pool size must be at least 1')
+
+        self.size = size
+        self._comm = comm
+        self._verbose = verbose
+        self._idle = []
+        self._count = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    @property
+    def count(self):
+        """
+        Number of channels currently open (or being opened)
+        """
+        return self._count
+
+    def checkout(self, timeout=None):
+        """
+        Get a channel from the pool, waiting up to `timeout` seconds for one
+        to become available (or indefinitely, if None)
+        """
+        local = self._local
+        if getattr(local, 'channel', None) is not None:
+            local.depth += 1
+            return local.channel
+
+        t0 = time.time()
+        with self._cond:
+            while not self._idle and self._count >= self.size:
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = timeout - (time.time() - t0)
+                    if remaining <= 0.0:
+                        raise TimeoutError('No gpascii channel available')
+                    self._cond.wait(remaining)
+
+            if self._idle:
+                last = getattr(local, 'last', None)
+                if last in self._idle:
+                    self._idle.remove(last)
+                    channel = last
+                else:
+                    channel = self._idle.pop()
+            else:
+                # Reserve a slot, and open the channel outside of the lock
+                channel = None
+                self._count += 1
+
+        if channel is None:
+            try:
+                channel = self._comm.gpascii_channel(verbose=self._verbose)
+            except:
+                with self._cond:
+                    self._count -= 1
+                    self._cond.notify()
+                raise
+
+        local.channel = local.last = channel
+        local.depth = 1
+        return channel
+
+    def checkin(self, channel):
+        """
+        Return a channel checked out by this thread to the pool
+        """
+        local = self._local
+        if getattr(local, 'channel', None) is not channel:
+            raise ValueError('Channel not checked out by this thread')
+
+        local.depth -= 1
+        if local.depth > 0:
+            return
+
+        local.channel = None
+        with self._cond:
+            if channel._channel is None:
+                # Closed while checked out; allow for a replacement
+                self._count -= 1
+            elif self._closed:
+                # The pool was closed while the channel was checked out
+                self._count -= 1
+                self._close_channel(channel)
+            else:
+                self._idle.append(channel)
+
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def channel(self, timeout=None):
+        """
+        Context manager which checks out a channel, returning it to the pool
+        upon exit
+        """
+        channel = self.checkout(timeout=timeout)
+        try:
+            yield channel
+        finally:
+            self.checkin(channel)
+
+    def map(self, fcn, items, timeout=None):
+        """
+        Call fcn(channel, item) for each item, running in parallel on as many
+        channels as the pool allows
+
+        Returns the results in the order of `items`
+        """
+        def wrapped(item):
+            with self.channel(timeout=timeout) as channel:
+                return fcn(channel, item)
+
+        with concurrent.futures.ThreadPoolExecutor(self.size) as executor:
+            return list(executor.map(wrapped, items))
+
+    def _close_channel(self, channel):
+        try:
+            channel.close()
+        except Exception as ex:
+            logger.debug('Failed to close channel', exc_info=ex)
+
+    def close(self):
+        """
+        Close all idle channels, and those checked out as they are returned
+        """
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                self._count -= 1
+                self._close_channel(self._idle.pop())
+
+
 class PPComm(object):
     """
     Power PMAC Communication via ssh/sftp
@@ -797,7 +2327,8 @@ class PPComm(object):
 
     def __init__(self, host=config.hostname, port=config.port,
                  user=config.username, password=config.password,
-                 fast_gather=False, fast_gather_port=config.fast_gather_port):
+                 fast_gather=False, fast_gather_port=config.fast_gather_port,
+                 pool_size=4):
         self._host = host
         self._port = port
         self._user = user
@@ -806,6 +2337,9 @@ class PPComm(object):
         self._fast_gather = fast_gather and (fast_gather_mod is not None)
         self._fast_gather_port = fast_gather_port
         self._gather_client = None
+        self._pool_size = pool_size
+        self._pool = None
+        self._sftp = None
 
         self._client = paramiko.SSHClient()
         self._client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
@@ -813,12 +2347,12 @@ class PPComm(object):
                              username=self._user, password=self._pass, allow_agent=False, look_for_keys=False)
 
         self.gpascii = self.gpascii_channel()
-        self._sftp = None
 
     def __copy__(self):
         return PPComm(host=self._host, port=self._port, user=self._user,
                       password=self._pass, fast_gather=self._fast_gather,
-                      fast_gather_port=self._fast_gather_port)
+                      fast_gather_port=self._fast_gather_port,
+                      pool_size=self._pool_size)
 
     def gpascii_channel(self, cmd=None, verbose=False):
         """
@@ -827,6 +2361,46 @@ class PPComm(object):
         """
         return GpasciiChannel(self, command=cmd, verbose=verbose)
 
+    @property
+    def pool(self):
+        """
+        Pool of additional gpascii channels, allowing for parallel queries
+        from multiple threads (see GpasciiPool)
+        """
+        if self._pool is None:
+            self._pool = GpasciiPool(self, size=self._pool_size)
+
+        return self._pool
+
+    def close(self):
+        """
+        Close the gpascii channels (including those of the pool), the
+        fast_gather connection, and finally the SSH connection
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+        # (not set if connecting failed)
+        gpascii = getattr(self, 'gpascii', None)
+        if gpascii is not None:
+            self.gpascii = None
+            gpascii.close()
+
+        if self._gather_client is not None:
+            self._gather_client.close()
+            self._gather_client = None
+
+        if self._sftp is not None:
+            self._sftp.close()
+            self._sftp = None
+
+        self._client.close()
+
+    def __del__(self):
+        if hasattr(self, '_client'):
+            self.close()
+
     def gpascii_file(self, filename, check_errors=True, **kwargs):
         """
         Execute a gpascii script by remote filename
@@ -959,7 +2533,8 @@ class PPComm(object):
             return None
 
         if self._gather_client is None:
-            client = self._gather_client = fast_gather_mod.GatherClient()
+            client = self._gather_client = fast_gather_mod.GatherClient(
+                rcvbuf=config.fast_gather_rcvbuf)
             try:
                 client.connect((self._host, self._fast_gather_port))
             except Exception as ex:
@@ -235,14 +235,38 @@ def copy_settings(gpascii, motor_from, motor_to, settings=None, completer=None):
     if settings is None:
         settings = get_settings_variables(completer)
 
-    for setting in settings:
-        from_ = 'Motor[%d].%s' % (motor_from, setting)
-        to_ = 'Motor[%d].%s' % (motor_to, setting)
-
-        old_value = gpascii.get_variable(to_)
-        new_value = gpascii.get_variable(from_)
-        if old_value != new_value:
-            gpascii.set_variable(to_, new_value)
+    settings = list(settings)
+    from_vars = ['Motor[%d].%s' % (motor_from, setting) for setting in settings]
+    to_vars = ['Motor[%d].%s' % (motor_to, setting) for setting in settings]
+
+    def failed(var, ex):
+        print('* Failed to read %s: %s' % (var, ex))
+
+    new_values = gpascii.get_variables(from_vars, error_cb=failed)
+    old_values = gpascii.get_variables(to_vars, error_cb=failed)
+
+    changes = [(to_, new_value, old_value)
+               for to_, new_value, old_value in zip(to_vars, new_values,
+                                                    old_values)
+               if None not in (new_value, old_value) and old_value != new_value]
+
+    diff = gpascii.set_variables([(to_, new_value)
+                                  for to_, new_value, old_value in changes])
+
+    if diff:
+        # gpascii skips the remainder of a packed line after an error, so
+        # retry those not set one per line
+        retry = [(to_, new_value) for to_, new_value, old_value in changes
+                 if to_ in diff]
+        diff = {}
+        for to_, new_value in retry:
+            diff.update(gpascii.set_variables([(to_, new_value)]))
+
+    for to_, new_value, old_value in changes:
+        if to_ in diff:
+            print('* Failed to set %s to %s (read back: %s)' %
+                  (to_, new_value, diff[to_][1]))
+        else:
             print('Set %s to %s (was: %s)' % (to_, new_value, old_value))
 
 BIN_PATH = '/opt/ppmac'
@@ -297,7 +321,7 @@ def plot_custom(columns, data, left_indices=[], right_indices=[],
                 left_colors='bgc', right_colors='rmk',
                 fft=False, fft_remove_dc=True):
 
-    data = np.array(data)
+    data = np.asarray(data)
 
     x_axis = data[:, x_index]
 
@@ -376,8 +400,6 @@ def tune_range(gpascii, script_file, parameter, values, **kwargs):
             print('%s = %s' % (parameter, gpascii.get_variable(parameter)))
 
             addrs, data = custom_tune(gpascii._comm, script_file, **kwargs)
-            data = np.array(data)
-
             rms_ = calc_rms(addrs, data)
             print('\tDesired/actual position error (RMS): %g' % rms_)
             rms_results.append(rms_)
@@ -182,45 +182,82 @@ def tracking_filter(cutoff_freq, damping_ratio=0.7, servo_period=0.4426737494466
     return index1, index2
 
 
-class SaveVariable(object):
+class SaveVariables(object):
     """
-    Context manager which saves the current value of a variable,
-    then restores it after the context exits.
+    Context manager which saves the current values of several variables,
+    then restores them after the context exits.
 
-    The value can be optionally set upon entering the context
-    by specifying `new_value`.
+    The values are read and restored in batches (see
+    GpasciiChannel.set_variables). Variables which fail to be read are not
+    restored. New values can be optionally set upon entering the context by
+    specifying `new_values`, a dictionary.
     """
-    def __init__(self, gpascii, variable, new_value=None, verbose=False):
+    def __init__(self, gpascii, variables, new_values=None, verbose=False):
         self._gpascii = gpascii
-        self._variable = variable
+        self._variables = list(variables)
         self._verbose = verbose
-        self._stored_value = None
-        self._new_value = new_value
+        self._stored_values = None
+        self._new_values = new_values
 
-    @property
-    def current_value(self):
-        return self._gpascii.get_variable(self._variable)
+    def _read(self, type_=str):
+        def failed(var, ex):
+            print('* Failed to read %s: %s' % (var, ex))
+
+        return self._gpascii.get_variables(self._variables, type_=type_,
+                                           error_cb=failed)
 
-    def set_value(self, value):
-        self._gpascii.set_variable(self._variable, value)
+    @property
+    def current_values(self):
+        return self._read()
 
     def __enter__(self):
-        self._stored_value = self.current_value
+        self._stored_values = [(var, value)
+                               for var, value in zip(self._variables,
+                                                     self.current_values)
+                               if value is not None]
         if self._verbose:
-            print('Saving %s = %s' % (self._variable, self._stored_value))
+            for var, value in self._stored_values:
+                print('Saving %s = %s' % (var, value))
 
-        if self._new_value is not None:
+        if self._new_values:
             if self._verbose:
-                print('Setting %s = %s' % (self._variable, self._new_value))
+                for var, value in self._new_values.items():
+                    print('Setting %s = %s' % (var, value))
 
-            self.set_value(self._new_value)
+            self._gpascii.set_variables(self._new_values, check=False)
 
     def __exit__(self, type_, value, traceback):
+        diff = self._gpascii.set_variables(self._stored_values)
         if self._verbose:
-            print('Restoring %s = %s (was %s)' %
-                  (self._variable, self._stored_value, self.current_value))
+            for var, value in self._stored_values:
+                print('Restoring %s = %s' % (var, value))
+
+        for var, (requested, actual) in diff.items():
+            print('* Failed to restore %s = %s (read back: %s)' %
+                  (var, requested, actual))
+
+
+class SaveVariable(SaveVariables):
+    """
+    Context manager which saves the current value of a variable,
+    then restores it after the context exits.
 
-        self.set_value(self._stored_value)
+    The value can be optionally set upon entering the context
+    by specifying `new_value`.
+    """
+    def __init__(self, gpascii, variable, new_value=None, verbose=False):
+        if new_value is not None:
+            new_values = {variable: new_value}
+        else:
+            new_values = None
+
+        SaveVariables.__init__(self, gpascii, [variable],
+                               new_values=new_values, verbose=verbose)
+        self._variable = variable
+
+    @property
+    def current_value(self):
+        return self.current_values[0]
 
 
 class WpKeySave(SaveVariable):
@@ -237,8 +274,9 @@ class WpKeySave(SaveVariable):
                               new_value=self.UNLOCK_VALUE, **kwargs)
 
     @property
-    def current_value(self):
-        return '$%X' % self._gpascii.get_variable(self._variable, type_=int)
+    def current_values(self):
+        return [('$%X' % value if value is not None else None)
+                for value in self._read(type_=int)]
 
 
 def get_caller_module():